@@ -23,6 +23,8 @@ from pyccc.exceptions import *
 from pyccc.job import *
 from pyccc.python import *
 from pyccc.engines import *
+from pyccc.asynchronous import *
+from pyccc.executor import *
 from pyccc.ui import *
 from pyccc.files import *
 
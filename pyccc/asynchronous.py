@@ -0,0 +1,167 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Helpers for the asyncio API (``engine.submit_async``, ``job.wait_async``, etc.).
+
+These are written with futures and callbacks rather than ``async``/``await`` syntax, so that
+this module can still be imported by Python 2 (where the asyncio API isn't available).
+"""
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import inspect
+import threading
+import weakref
+
+__all__ = ['as_completed_async']
+
+_executors = weakref.WeakKeyDictionary()
+_executors_lock = threading.Lock()
+
+
+def get_executor(engine):
+    """ Get the thread pool used to run an engine's blocking calls for the asyncio API
+
+    Args:
+        engine (pyccc.engines.EngineBase): the engine
+
+    Returns:
+        concurrent.futures.ThreadPoolExecutor: pool with up to ``engine.ASYNC_THREADS`` threads
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    with _executors_lock:
+        executor = _executors.get(engine)
+        if executor is None:
+            executor = _executors[engine] = ThreadPoolExecutor(max_workers=engine.ASYNC_THREADS)
+    return executor
+
+
+def run_async(engine, function, *args):
+    """ Run a blocking call in the engine's thread pool
+
+    Returns:
+        asyncio.Future: the function's return value
+    """
+    import asyncio
+    return asyncio.get_event_loop().run_in_executor(get_executor(engine), function, *args)
+
+
+def completed(result):
+    """ Returns:
+        asyncio.Future: a future that has already finished with this result
+    """
+    import asyncio
+    future = asyncio.get_event_loop().create_future()
+    future.set_result(result)
+    return future
+
+
+def then(awaitable, callback):
+    """ Chain a callback onto an awaitable
+
+    Args:
+        awaitable (Awaitable): future or coroutine
+        callback (callable): called with the awaitable's result once it's done. It may return
+            another awaitable, which will also be awaited.
+
+    Returns:
+        asyncio.Future: the callback's result. Exceptions (from either the awaitable or the
+            callback) are propagated.
+    """
+    import asyncio
+
+    source = asyncio.ensure_future(awaitable)
+    target = asyncio.get_event_loop().create_future()
+
+    def _on_done(future):
+        if target.cancelled():
+            return
+        if future.cancelled():
+            target.cancel()
+            return
+        if future.exception() is not None:
+            target.set_exception(future.exception())
+            return
+        try:
+            result = callback(future.result())
+        except Exception as exc:
+            target.set_exception(exc)
+            return
+        if inspect.isawaitable(result):
+            asyncio.ensure_future(result).add_done_callback(_copy_outcome)
+        else:
+            target.set_result(result)
+
+    def _copy_outcome(future):
+        if target.cancelled():
+            return
+        if future.cancelled():
+            target.cancel()
+        elif future.exception() is not None:
+            target.set_exception(future.exception())
+        else:
+            target.set_result(future.result())
+
+    source.add_done_callback(_on_done)
+    return target
+
+
+def as_completed_async(jobs):
+    """ Asynchronously iterate over jobs as they finish
+
+    Examples:
+        >>> async for job in pyccc.as_completed_async(jobs):
+        ...     print(job.stdout)
+
+    Args:
+        jobs (Iterable[pyccc.job.Job]): submitted jobs
+
+    Returns:
+        AsyncIterator[pyccc.job.Job]: the jobs, in the order that they finish. Jobs that failed
+            while being waited on are also yielded; the error will be raised again when their
+            results are accessed.
+    """
+    return _CompletionIterator(jobs)
+
+
+class _CompletionIterator(object):
+    def __init__(self, jobs):
+        import asyncio
+
+        self._queue = asyncio.Queue()
+        self._remaining = 0
+        for job in jobs:
+            self._remaining += 1
+            asyncio.ensure_future(job.wait_async()).add_done_callback(
+                    lambda future, job=job: self._on_done(future, job))
+
+    def _on_done(self, future, job):
+        if not future.cancelled():
+            future.exception()  # it will be raised again when the job's results are accessed
+        self._queue.put_nowait(job)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._remaining == 0:
+            import asyncio
+            future = asyncio.get_event_loop().create_future()
+            future.set_exception(StopAsyncIteration())
+            return future
+        self._remaining -= 1
+        return self._queue.get()
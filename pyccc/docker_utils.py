@@ -16,14 +16,17 @@ from future import standard_library
 standard_library.install_aliases()
 from future.builtins import *
 
+import hashlib
 import json
 import logging
+import time
 import os
 import subprocess
 import io
 import tarfile
 import tempfile
 import gzip
+import threading
 
 import pyccc
 
@@ -31,17 +34,119 @@ from .exceptions import DockerMachineError
 from . import files
 
 
-def create_provisioned_image(client, image, wdir, inputs, pull=False):
+PROVISIONED_IMAGE_REPO = 'pyccc-provisioned'
+
+
+def create_provisioned_image(client, image, wdir, inputs, pull=False, tag=None):
     build_context = create_build_context(image, inputs, wdir)
     with tempfile.NamedTemporaryFile(suffix='.tar.gz', mode='wb') as tfile:
         gzstream = gzip.GzipFile(fileobj=tfile, mode='wb')
         make_tar_stream(build_context, gzstream)
         gzstream.close()
         tfile.flush()
-        imageid = build_dfile_stream(client, tfile.name, pull=pull)
+        imageid = build_dfile_stream(client, tfile.name, pull=pull, tag=tag)
     return imageid
 
 
+def provisioned_image_tag(client, image, wdir, inputs):
+    """ Create a content-addressed tag for a provisioned image.
+
+    The tag is a fingerprint of the base image's ID, the working directory, and the paths and
+    contents of all input files, so identical submissions map to the same image.
+
+    Args:
+        client (docker.APIClient): docker client
+        image (str): base image name
+        wdir (str): working directory inside the image
+        inputs (Mapping[str, pyccc.FileReferenceBase]): input files
+
+    Returns:
+        str: image tag, or None if the base image isn't available on the daemon (in which case
+           the build will need to pull it anyway)
+    """
+    import docker.errors
+
+    try:
+        baseid = client.inspect_image(image)['Id']
+    except docker.errors.NotFound:
+        return None
+
+    hasher = hashlib.sha256()
+    for field in (baseid, wdir):
+        hasher.update(field.encode('utf-8'))
+        hasher.update(b'\0')
+    for path in sorted(inputs):
+        hasher.update(path.encode('utf-8'))
+        hasher.update(b'\0')
+        hasher.update(inputs[path].digest().encode('ascii'))
+        hasher.update(b'\0')
+    return '%s:%s' % (PROVISIONED_IMAGE_REPO, hasher.hexdigest())
+
+
+def prune_provisioned_images(client, max_age=None, max_bytes=None):
+    """ Remove cached provisioned images, oldest first
+
+    Args:
+        client (docker.APIClient): docker client
+        max_age (float): remove images created more than this many seconds ago
+        max_bytes (int): remove the oldest images until the cache's total size is below this
+           value. Each image counts for the space that it doesn't share with other images (so
+           their common base images aren't counted), if the daemon can report it
+
+    Returns:
+        List[str]: tags of the removed images
+    """
+    import docker.errors
+
+    images = sorted(client.images(name=PROVISIONED_IMAGE_REPO),
+                    key=lambda img: img['Created'], reverse=True)
+    if max_bytes is not None:
+        _add_shared_sizes(client, images)
+    now = time.time()
+    total_bytes = 0
+    removed = []
+    for img in images:
+        total_bytes += _unique_image_size(img)
+        if ((max_age is not None and now - img['Created'] > max_age) or
+                (max_bytes is not None and total_bytes > max_bytes)):
+            for tag in img.get('RepoTags') or []:
+                if not tag.startswith(PROVISIONED_IMAGE_REPO + ':'):
+                    continue
+                try:
+                    client.remove_image(tag)
+                except docker.errors.APIError as exc:  # e.g., image is in use
+                    logging.info('Not removing cached image %s: %s' % (tag, exc))
+                else:
+                    removed.append(tag)
+    return removed
+
+
+def _add_shared_sizes(client, images):
+    """ The image list only reports how much of each image is shared with other images if the
+    daemon already calculated it; otherwise, get it from the daemon's disk usage summary.
+    """
+    import docker.errors
+
+    if all(img.get('SharedSize', -1) >= 0 for img in images) or not hasattr(client, 'df'):
+        return
+    try:
+        usage = client.df()
+    except docker.errors.APIError as exc:
+        logging.info('Could not get image sizes from the daemon: %s' % exc)
+        return
+    shared = {img['Id']: img.get('SharedSize', -1) for img in usage.get('Images') or []}
+    for img in images:
+        if shared.get(img['Id'], -1) >= 0:
+            img['SharedSize'] = shared[img['Id']]
+
+
+def _unique_image_size(img):
+    shared = img.get('SharedSize', -1)
+    if shared is not None and shared >= 0:
+        return max(img.get('Size', 0) - shared, 0)
+    return img.get('VirtualSize', img.get('Size', 0))
+
+
 def create_build_context(image, inputs, wdir):
     """
     Creates a tar archive with a dockerfile and a directory called "inputs"
@@ -68,6 +173,32 @@ def create_build_context(image, inputs, wdir):
     return build_context
 
 
+def make_input_archive(inputs, wdir, buffer):
+    """ Write a tar stream that, when extracted at the container's root, installs the input
+    files at their target paths
+
+    Args:
+        inputs (Mapping[str, pyccc.FileReferenceBase]): dict mapping paths to file references
+            (relative paths are relative to ``wdir``)
+        wdir (str): working directory in the container
+        buffer (io.BytesIO): writable binary mode buffer
+
+    Returns:
+        Dict[str, Tuple[int, int]]: absolute paths of all files and directories in the archive,
+           mapped to the size and modification time (in whole seconds) that they'll have in the
+           container (None for directories)
+    """
+    assert os.path.isabs(wdir)
+
+    archive_context = {}
+    for path, obj in inputs.items():
+        if not os.path.isabs(path):
+            path = os.path.join(wdir, path)
+        archive_context[path.lstrip('/')] = obj
+    return {'/' + member.name: None if member.isdir() else (member.size, int(member.mtime))
+            for member in make_tar_stream(archive_context, buffer)}
+
+
 def build_dfile_stream(client, dfilepath, **kwargs):
     # dfilepath is the path to the already .tgz-archived build context
 
@@ -90,6 +221,9 @@ def build_dfile_stream(client, dfilepath, **kwargs):
     except KeyError:
         raise IOError(result)
 
+    if kwargs.get('tag') is not None and reply.split()[:2] == 'Successfully tagged'.split():
+        return client.inspect_image(kwargs['tag'])['Id']
+
     if reply.split()[:2] != 'Successfully built'.split():
         raise IOError('Failed to build image:%s' % reply)
 
@@ -127,6 +261,9 @@ def make_tar_stream(build_context, buffer):
     Args:
         build_context (Mapping[str, pyccc.FileReferenceBase]): dict mapping filenames to file references
         buffer (io.BytesIO): writable binary mode buffer
+
+    Returns:
+        List[tarfile.TarInfo]: all entries written to the archive
     """
     tf = tarfile.TarFile(fileobj=buffer, mode='w')
     for context_path, fileobj in build_context.items():
@@ -134,7 +271,9 @@ def make_tar_stream(build_context, buffer):
             tf.add(fileobj.localpath, arcname=context_path)
         else:
             tar_add_bytes(tf, context_path, fileobj.read('rb'))
+    members = tf.getmembers()
     tf.close()
+    return members
 
 
 def tar_add_bytes(tf, filename, bytestring):
@@ -154,6 +293,173 @@ def tar_add_bytes(tf, filename, bytestring):
     tf.addfile(tarinfo, buff)
 
 
+class IterStream(io.RawIOBase):
+    """ Read-only file-like view of an iterator over byte strings, such as the streamed
+    responses returned by docker-py.
+
+    This allows, e.g., ``tarfile.open(fileobj=IterStream(response), mode='r|')`` to process a
+    tar stream without writing it anywhere first.
+    """
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._leftover:
+            try:
+                self._leftover = next(self._iterator)
+            except StopIteration:
+                return 0
+        nbytes = min(len(buffer), len(self._leftover))
+        buffer[:nbytes] = self._leftover[:nbytes]
+        self._leftover = self._leftover[nbytes:]
+        return nbytes
+
+
+STDOUT_CHANNEL = 1
+STDERR_CHANNEL = 2
+
+
+def stream_logs(client, container, stdout=True, stderr=True, follow=False, since=None,
+                tail=None, chunk_size=files.BLOCKSIZE):
+    """ Stream a container's logs with a single request, keeping track of which channel (stdout
+    or stderr) each piece of output came from.
+
+    Unlike ``client.logs(stream=True)``, which merges the two channels, this reads the daemon's
+    multiplexed stream directly. Containers with a TTY don't have separate channels; all of their
+    output is reported as stdout.
+
+    Args:
+        client (docker.APIClient): docker client
+        container (str): container ID
+        stdout (bool): include stdout
+        stderr (bool): include stderr
+        follow (bool): keep streaming new output until the container stops
+        since (float or datetime.datetime): only include output written after this time (as a
+           UNIX timestamp)
+        tail (int): only include this many lines from the end of the existing logs
+        chunk_size (int): split output into chunks of at most this many bytes
+
+    Returns:
+        Iterator[Tuple[int, bytes]]: ``(channel, data)`` pairs, where channel is
+           ``STDOUT_CHANNEL`` or ``STDERR_CHANNEL``
+    """
+    import datetime
+    import docker.utils
+
+    if isinstance(since, datetime.datetime):
+        since = docker.utils.datetime_to_timestamp(since)
+    logargs = dict(stdout=stdout, stderr=stderr, follow=follow, since=since,
+                   tail='all' if tail is None else tail)
+
+    if not (stdout and stderr):  # only one channel, so the client can demultiplex it for us
+        channel = STDOUT_CHANNEL if stdout else STDERR_CHANNEL
+        return _rechunk(channel, client.logs(container, stream=True, **logargs), chunk_size)
+    if client.inspect_container(container)['Config']['Tty']:
+        return _rechunk(STDOUT_CHANNEL, client.logs(container, stream=True, **logargs),
+                        chunk_size)
+
+    params = {key: int(value) if isinstance(value, bool) else value
+              for key, value in logargs.items() if value is not None}
+    params['timestamps'] = 0
+    response = _raw_request(client, 'get', '/containers/%s/logs' % container,
+                            params=params, stream=True)
+    return _iter_log_frames(response, chunk_size)
+
+
+def stat_container_path(client, container, path):
+    """ Get the size and modification time of a path in a container, without transferring it
+
+    Args:
+        client (docker.APIClient): docker client
+        container (str): container ID
+        path (str): absolute path in the container
+
+    Returns:
+        Tuple[int, int]: the path's size, and its modification time (as a UNIX timestamp, in
+           whole seconds)
+    """
+    import docker.utils
+
+    response = _raw_request(client, 'head', '/containers/%s/archive' % container,
+                            params={'path': path})
+    stat = docker.utils.decode_json_header(response.headers['X-Docker-Container-Path-Stat'])
+    return stat['size'], _parse_timestamp(stat['mtime'])
+
+
+def _parse_timestamp(timestamp):
+    """ Convert an RFC 3339 timestamp from the daemon (e.g., ``2018-01-02T03:04:05.678+01:00``)
+    to a UNIX timestamp in whole seconds
+    """
+    import calendar
+    import re
+
+    seconds = calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+    offset = re.search(r'([+-])(\d\d):(\d\d)$', timestamp)
+    if offset is not None:
+        sign = 1 if offset.group(1) == '+' else -1
+        seconds -= sign * (3600 * int(offset.group(2)) + 60 * int(offset.group(3)))
+    return seconds
+
+
+def _raw_request(client, method, endpoint, **kwargs):
+    """ Make a request to the daemon's API directly, for things docker-py doesn't expose
+    (``client`` is a ``requests.Session``), raising docker-py's exceptions for errors
+    """
+    import docker.errors
+    from requests.exceptions import HTTPError
+
+    url = '%s/v%s%s' % (client.base_url, client.api_version, endpoint)
+    response = getattr(client, method)(url, **kwargs)
+    try:
+        response.raise_for_status()
+    except HTTPError as exc:
+        response.close()
+        raise docker.errors.create_api_error_from_http_exception(exc)
+    return response
+
+
+def _rechunk(channel, stream, chunk_size):
+    for data in stream:
+        for start in range(0, len(data), chunk_size):
+            yield channel, data[start:start + chunk_size]
+
+
+def _iter_log_frames(response, chunk_size):
+    """ Parse the daemon's multiplexed log stream. Each frame has an 8-byte header: the channel,
+    3 bytes of padding, then the payload size as a big-endian uint32.
+    """
+    import struct
+
+    try:
+        while True:
+            header = _read_exactly(response.raw, 8)
+            if len(header) < 8:
+                return
+            channel, size = struct.unpack('>BxxxL', header)
+            while size > 0:
+                data = _read_exactly(response.raw, min(size, chunk_size))
+                if not data:
+                    return
+                size -= len(data)
+                yield channel, data
+    finally:
+        response.close()
+
+
+def _read_exactly(stream, nbytes):
+    data = b''
+    while len(data) < nbytes:
+        chunk = stream.read(nbytes - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
 def docker_machine_env(machine_name):
     try:
         stdout = subprocess.check_output(['docker-machine', 'env', machine_name])
@@ -191,6 +497,42 @@ def get_docker_apiclient(*args, **kwargs):
     return ClientClass(*args, **kwargs)
 
 
+_shared_clients = {}
+_shared_clients_lock = threading.Lock()
+
+
+def get_shared_apiclient(**kwargs):
+    """ Like :func:`get_docker_apiclient`, but returns the same client every time it's called with
+    the same connection arguments, so that concurrent requests (e.g., output files downloaded on
+    several threads) share one connection pool.
+
+    Arguments that aren't plain values (such as a ``TLSConfig``) are compared by identity.
+    """
+    key = tuple(sorted(kwargs.items()))
+    try:
+        hash(key)
+    except TypeError:
+        return get_docker_apiclient(**kwargs)
+
+    with _shared_clients_lock:
+        if key not in _shared_clients:
+            # the key holds references to the arguments, so their ids can't be reused
+            _shared_clients[key] = get_docker_apiclient(**kwargs)
+        return _shared_clients[key]
+
+
+def is_local_client(client):
+    """ Check whether a client talks to the docker daemon over a local unix socket
+
+    Args:
+        client (docker.APIClient): docker client
+
+    Returns:
+        bool: False if the daemon is accessed over the network
+    """
+    return client.base_url in ('http+docker://localunixsocket', 'http+docker://localhost')
+
+
 def kwargs_from_client(client, assert_hostname=False):
     """
     More or less stolen from docker-py's kwargs_from_env
@@ -198,7 +540,7 @@ def kwargs_from_client(client, assert_hostname=False):
     :type client : docker.Client
     """
     from docker import tls
-    if client.base_url in ('http+docker://localunixsocket', 'http+docker://localhost'):
+    if is_local_client(client):
         return {'base_url': 'unix://var/run/docker.sock'}
 
     params = {'base_url': client.base_url}
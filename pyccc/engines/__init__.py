@@ -5,4 +5,9 @@ from future.builtins import *
 
 from .base import *
 from .dockerengine import *
+from .dockerpool import *
 from .subproc import *
+from .processpool import *
+from .scheduler import *
+from .resultcache import *
+from .singleflight import *
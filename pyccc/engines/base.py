@@ -16,7 +16,10 @@ from future import standard_library
 standard_library.install_aliases()
 from future.builtins import *
 from future.utils import PY2
-from pyccc import PythonCall, PythonJob, Job
+import time
+
+from pyccc import PythonCall, PythonJob, Job, status, asynchronous
+from pyccc.files import LocalFile
 
 if PY2:
     from past.builtins import str as native_str
@@ -39,8 +42,16 @@ class EngineBase(object):
              be referenced via absolute path"""
 
 
+    ASYNC_THREADS = 8
+    """int: maximum number of threads used to run blocking engine calls for the asyncio API"""
+
+    DUMP_THREADS = 8
+    """int: maximum number of output files that ``dump_all_outputs`` copies at once"""
+
     hostname = 'not specified'  # this should be overidden in subclass init methods
 
+    default_wdir = None  # working directory for jobs that don't specify one (if the engine has one)
+
     def __call__(self, *args, **kwargs):
         pass
 
@@ -60,14 +71,28 @@ class EngineBase(object):
             return '<%s engine at %s (custom __repr__ failed)>' % (
                 type(self).__name__, hex(id(self)))
 
-    def dump_all_outputs(self, job, target, abspaths=None):
-        """ Default dumping strategy - potentially slow for large numbers of files
+    def dump_all_outputs(self, job, target, abspaths=None, progress=None):
+        """ Default dumping strategy - copies the files in parallel, on up to ``DUMP_THREADS``
+        threads.
+
+        Files that are already present at the destination with the same contents are skipped,
+        so that an interrupted dump can be resumed by calling this again.
 
         Subclasses should offer faster implementations, if available
+
+        Args:
+            job (pyccc.job.Job): job to dump the outputs of
+            target (str): directory to write the outputs to
+            abspaths (str): subdirectory of target to write outputs with absolute paths to
+               (they're skipped if this isn't specified)
+            progress (callable): called as ``progress(outputpath, completed, total)`` after
+               each output has been written (or skipped); always called from the calling thread
         """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         from pathlib import Path
         root = Path(native_str(target))
 
+        destinations = {}
         for outputpath, outputfile in job.get_output().items():
             path = Path(native_str(outputpath))
 
@@ -81,13 +106,66 @@ class EngineBase(object):
             dest = root / path
             if not dest.parent.is_dir():
                 dest.parent.mkdir(parents=True)
-            if dest.is_file():
-                dest.unlink()
+            destinations[outputpath] = (outputfile, dest)
+
+        if not destinations:
+            return
+
+        completed = 0
+        with ThreadPoolExecutor(max_workers=min(self.DUMP_THREADS, len(destinations))) as pool:
+            pending = {pool.submit(self._dump_output, outputfile, dest): outputpath
+                       for outputpath, (outputfile, dest) in destinations.items()}
             try:
-                outputfile.put(str(dest))
-            except IsADirectoryError:
-                if not dest.is_dir():
-                    dest.mkdir(parents=True)
+                for future in as_completed(pending):
+                    future.result()
+                    completed += 1
+                    if progress is not None:
+                        progress(pending[future], completed, len(destinations))
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    @classmethod
+    def _dump_output(cls, outputfile, dest):
+        """ Write a single output file to ``dest`` (a :class:`pathlib.Path`), unless an identical
+        copy is already there
+
+        Returns:
+            bool: False if the file was already present, True otherwise
+        """
+        if cls._is_dumped(outputfile, dest):
+            return False
+        if dest.is_file():
+            dest.unlink()
+        try:
+            outputfile.put(str(dest))
+        except IsADirectoryError:
+            if not dest.is_dir():
+                dest.mkdir(parents=True)
+        return True
+
+    @staticmethod
+    def _is_dumped(outputfile, dest):
+        """ Check whether ``dest`` already holds a copy of ``outputfile``
+
+        The sizes are compared first, when the output's size is known without downloading it.
+        Otherwise, the digests are compared; for remote files, this only downloads the file if
+        it isn't in the local file cache - and then the download is reused to write the copy.
+        """
+        if not dest.is_file():
+            return False
+        try:
+            size = outputfile.size_bytes()
+        except (AttributeError, NotImplementedError, OSError):
+            size = None
+        if size is not None and size != dest.stat().st_size:
+            return False
+        try:
+            digest = outputfile.digest()
+        except (AttributeError, NotImplementedError, IsADirectoryError):
+            return False
+        return digest == LocalFile(str(dest)).digest()
 
     def launch(self, image, command, **kwargs):
         """
@@ -126,6 +204,13 @@ class EngineBase(object):
         raise NotImplementedError()
 
     def _check_job(self, job):
+        # jobs submitted through a wrapper around this engine (e.g., a Scheduler) keep pointing
+        # at the wrapper, so that other threads never bypass it
+        engine = job.engine
+        while isinstance(engine, EngineWrapper):
+            engine = engine.engine
+            if engine is self:
+                return
         job.engine = self
 
     def wait(self, job):
@@ -140,6 +225,75 @@ class EngineBase(object):
         """
         raise NotImplementedError()
 
+    def submit_async(self, job):
+        """ Asynchronous version of :meth:`submit`. By default, the job is submitted from a
+        pool of up to ``ASYNC_THREADS`` threads.
+
+        Returns:
+            asyncio.Future: completes once the job has been submitted
+        """
+        return asynchronous.run_async(self, self.submit, job)
+
+    def wait_async(self, job):
+        """ Asynchronous version of :meth:`wait`. By default, the job is waited on from a pool
+        of up to ``ASYNC_THREADS`` threads; subclasses should override this if they can be
+        notified when jobs finish.
+
+        Returns:
+            asyncio.Future: the job's exit code
+        """
+        return asynchronous.run_async(self, self.wait, job)
+
+    def wait_any(self, jobs, timeout=None, poll_interval=1.0):
+        """ Block until at least one of the jobs has finished
+
+        Args:
+            jobs (Iterable[pyccc.job.Job]): jobs submitted to this engine
+            timeout (float): stop waiting after this many seconds
+            poll_interval (float): how often to check the jobs' statuses (engines that are
+                notified of status changes may check less often)
+
+        Returns:
+            List[pyccc.job.Job]: the jobs that have finished (empty if the timeout expired first)
+        """
+        jobs = list(jobs)
+        return self._wait_for_jobs(jobs, min(1, len(jobs)), timeout, poll_interval)
+
+    def wait_all(self, jobs, timeout=None, poll_interval=1.0):
+        """ Block until all of the jobs have finished
+
+        Args:
+            jobs (Iterable[pyccc.job.Job]): jobs submitted to this engine
+            timeout (float): stop waiting after this many seconds
+            poll_interval (float): how often to check the jobs' statuses (engines that are
+                notified of status changes may check less often)
+
+        Returns:
+            List[pyccc.job.Job]: the jobs that have finished (all of them, unless the timeout
+               expired first)
+        """
+        jobs = list(jobs)
+        return self._wait_for_jobs(jobs, len(jobs), timeout, poll_interval)
+
+    def _wait_for_jobs(self, jobs, count, timeout, poll_interval):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            done = [job for job in jobs if job.status in status.DONE_STATES]
+            if len(done) >= count:
+                return done
+            delay = poll_interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    return done
+            self._sleep_until_status_change(delay)
+
+    def _sleep_until_status_change(self, delay):
+        """ Sleep for up to ``delay`` seconds. Engines that are notified of status changes should
+        return as soon as one happens.
+        """
+        time.sleep(delay)
+
     def get_status(self, job):
         """
         Return a valid job status value from pyccc.status
@@ -178,3 +332,97 @@ class EngineBase(object):
         :return: (final stdout, final stderr)
         """
         raise NotImplementedError()
+
+
+class EngineWrapper(EngineBase):
+    """ Base class for engines that add functionality on top of another engine.
+
+    Unless overridden, all calls are forwarded to the wrapped engine. Jobs launched or submitted
+    through the wrapper keep a reference to the wrapper (as ``job.engine``), so that status
+    checks, waits, and output retrieval all go through it.
+
+    Args:
+        engine (EngineBase): the engine that will actually run the jobs
+    """
+    def __init__(self, engine):
+        self.engine = engine
+
+    @property
+    def USES_IMAGES(self):
+        return self.engine.USES_IMAGES
+
+    @property
+    def ABSPATHS(self):
+        return self.engine.ABSPATHS
+
+    @property
+    def hostname(self):
+        return self.engine.hostname
+
+    @property
+    def default_wdir(self):
+        return self.engine.default_wdir
+
+    def __str__(self):
+        return '%s wrapping %s' % (type(self).__name__, self.engine)
+
+    def launch(self, image=None, command=None, **kwargs):
+        submit = kwargs.pop('submit', True)
+        job = self.engine.launch(image, command, submit=False, **kwargs)
+        job.engine = self
+        if submit and job.image:
+            job.submit()
+        return job
+
+    launch.__doc__ = EngineBase.launch.__doc__
+
+    def get_job(self, jobid):
+        job = self.engine.get_job(jobid)
+        job.engine = self
+        return job
+
+    def submit(self, job):
+        self.engine.submit(job)
+        job.engine = self
+
+    def test_connection(self):
+        return self.engine.test_connection()
+
+    def wait(self, job):
+        return self.engine.wait(job)
+
+    def kill(self, job):
+        return self.engine.kill(job)
+
+    def wait_any(self, jobs, timeout=None, poll_interval=1.0):
+        return self.engine.wait_any(jobs, timeout, poll_interval)
+
+    def wait_all(self, jobs, timeout=None, poll_interval=1.0):
+        return self.engine.wait_all(jobs, timeout, poll_interval)
+
+    def get_status(self, job):
+        return self.engine.get_status(job)
+
+    def get_engine_description(self, job):
+        return self.engine.get_engine_description(job)
+
+    def get_stdoutstream(self, job, **kwargs):
+        return self.engine.get_stdoutstream(job, **kwargs)
+
+    def get_stderrstream(self, job, **kwargs):
+        return self.engine.get_stderrstream(job, **kwargs)
+
+    def get_outputstream(self, job):
+        return self.engine.get_outputstream(job)
+
+    def get_directory(self, job, path):
+        return self.engine.get_directory(job, path)
+
+    def dump_all_outputs(self, job, target, abspaths=None, progress=None):
+        return self.engine.dump_all_outputs(job, target, abspaths, progress)
+
+    def _list_output_files(self, job):
+        return self.engine._list_output_files(job)
+
+    def _get_final_stds(self, job):
+        return self.engine._get_final_stds(job)
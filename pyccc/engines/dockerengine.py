@@ -16,23 +16,55 @@ from future import standard_library
 standard_library.install_aliases()
 from future.builtins import *
 from past.builtins import basestring
-from future.utils import PY2
 
-if PY2:
-    from past.builtins import str as native_str
-else:
-    native_str = str
+import collections
+import logging
+import os
+import posixpath
+import threading
+import time
+import weakref
 
 import docker.errors
 
 from .. import docker_utils as du, DockerMachineError
-from .. import utils, files, status, exceptions
+from .. import utils, files, status, exceptions, asynchronous
 from . import EngineBase
 
 CTR_MODIFIED = 0
 CTR_ADDED = 1
 CTR_DELETED = 2
 
+JOB_LABEL = 'pyccc.job'
+ACTIVE_CONTAINER_STATES = ['running', 'paused', 'restarting']
+WATCHED_EVENTS = ['die', 'oom', 'kill']
+
+INTERNAL_PREFIX = '/tmp/.pyccc_'
+"""str: files that pyccc writes into job containers (which are never outputs) start with this
+(/tmp is writable whatever user the image runs as)"""
+
+MANIFEST_STAMP = INTERNAL_PREFIX + 'stamp'
+MANIFEST_PATH = INTERNAL_PREFIX + 'manifest'
+RUN_SCRIPT = (  # the stamp is backdated, since file times can be coarser than "-newer" needs
+    'touch -d @$(($(date +%s) - 1)) {stamp} 2>/dev/null || touch {stamp} 2>/dev/null; '
+    'sh -c "$0"; status=$?; ')
+LIST_OUTPUTS_SCRIPT = (  # the manifest only appears if it's complete
+    '(rm -rf {manifest}.tmp && mkdir {manifest}.tmp && '
+    'find {wdir} -type f -newer {stamp} -print0 > {manifest}.tmp/outputs && '
+    'find {wdir} ! -type d ! -newer {stamp} -print0 > {manifest}.tmp/others && '
+    'mv {manifest}.tmp {manifest}) 2>/dev/null; ')
+MANIFEST_SCRIPT = RUN_SCRIPT + LIST_OUTPUTS_SCRIPT + 'exit $status'
+
+COMPRESSED_OUTPUTS_PATH = INTERNAL_PREFIX + 'outputs.tar'
+COMPRESSED_OUTPUTS_LIST = INTERNAL_PREFIX + 'outputs.list'
+COMPRESS_OUTPUTS_SCRIPT = (  # the job still succeeds if the image can't create the archive
+    '(cd {wdir} && find . -type f -newer {stamp} {filters}> {filelist} && '
+    'tar cf - -T {filelist} | {compressor} > {archive}) 2>/dev/null || rm -f {archive}; '
+    'rm -f {filelist}; ')
+COMPRESSORS = {'gzip': ('gzip -c', 'gz'),
+               'xz': ('xz -c', 'xz')}
+"""dict: command to compress the archive, and the tarfile compression mode to read it"""
+
 
 class Docker(EngineBase):
     """ A compute engine - uses a docker server to run jobs
@@ -40,23 +72,111 @@ class Docker(EngineBase):
     USES_IMAGES = True
     ABSPATHS = True
 
-    BULK_OUTPUT_FILE_THRESHOLD = 5
-    """int: threshold for determining whether to copy files in bulk or one at a time.
-    Not a whole lot of justification for this number, just a rough heuristic
+    ARCHIVE_SPOOL_BYTES = 2**24
+    """int: input archives larger than this are spooled to disk rather than held in memory"""
+
+    BULK_OUTPUT_MAX_EXTRA_BYTES = 2**26
+    """int: never download a directory of output files in bulk if it also contains more than this
+    many bytes of other files, however fast the transfer is estimated to be
     """
 
-    def __init__(self, client=None, workingdir='/workingdir'):
+    STAGING_MODES = ('archive', 'image')
+
+    OUTPUT_DISCOVERY_MODES = ('diff', 'workdir-diff', 'archive', 'manifest')
+
+    IMAGE_CACHE_MAX_AGE = 7 * 24 * 3600
+    """float: default for ``image_cache_max_age`` (one week)"""
+
+    IMAGE_CACHE_MAX_BYTES = 2**33
+    """int: default for ``image_cache_max_bytes``"""
+
+    def __init__(self, client=None, workingdir='/workingdir', staging='archive',
+                 cache_images=True, image_cache_max_age=IMAGE_CACHE_MAX_AGE,
+                 image_cache_max_bytes=IMAGE_CACHE_MAX_BYTES,
+                 status_ttl=1.0, watch_events=False, output_discovery='diff',
+                 compress_outputs=None):
         """ Initialization:
 
         Args:
             client (docker.Client): a docker-py client. If not passed, we will try to create the
                 client from the job's environmental varaibles
             workingdir (str): default working directory to create in the containers
+            staging (str): how input files get into the container. ``'archive'`` (default)
+                creates the container from the base image and uploads the inputs into it
+                directly; ``'image'`` builds a new image containing the inputs. If the
+                archive upload fails, the engine falls back to building an image.
+            cache_images (bool): reuse provisioned images for jobs with the same base image,
+                working directory and inputs. Cached images are tagged in the
+                ``pyccc-provisioned`` repository, so they persist between sessions
+            image_cache_max_age (float): evict cached images older than this (in seconds;
+                default: one week). Pass None to keep them regardless of age
+            image_cache_max_bytes (int): evict the oldest cached images once the cache
+                exceeds this size (default: 8 GiB), not counting the layers they share with
+                other images, such as their base images. Pass None for no limit
+            status_ttl (float): job statuses are cached for this many seconds. When a cached
+                status expires, the statuses of all running jobs are refreshed with a single
+                request to the daemon.
+            watch_events (bool): listen to the daemon's event stream (over a single connection,
+                from a background thread started when the first job is submitted). Jobs are
+                marked as finished, their ``on_status_update`` and ``when_finished`` callbacks
+                are called, and anything waiting on them is woken up, as soon as their
+                containers exit. The connection and thread stay open until :meth:`close` is
+                called, so this is off by default.
+            output_discovery (str): how the job's output files are found once it finishes:
+                 * ``'diff'`` (default): every file the job created or changed anywhere in
+                   the container, from ``client.diff``
+                 * ``'workdir-diff'``: like ``'diff'``, but only files in the working directory
+                 * ``'archive'``: files in the working directory that were written after the
+                   container started, by scanning the headers of a single archive of the
+                   working directory (its contents are transferred, but not stored)
+                 * ``'manifest'``: files in the working directory that were written after the
+                   job started, as listed by ``find`` inside the container once the command
+                   exits (it's written to ``/tmp``). The listing scales with the number of
+                   files in the working directory, but the image needs ``sh``, ``touch`` and
+                   ``find``; if it can't be written, ``'workdir-diff'`` is used instead
+                ``client.diff`` walks the container's entire filesystem layer, so the other modes
+                can be much faster for jobs that also write outside the working directory (e.g.,
+                by installing packages).
+            compress_outputs (str): when the job's command exits, pack the output files in its
+                working directory into a compressed archive inside the container (``'gzip'`` or
+                ``'xz'``), which :meth:`dump_all_outputs` then streams instead of the
+                uncompressed files (outputs that are fetched individually are still copied as
+                usual). By default (None), ``'gzip'`` is used if the daemon isn't on a local unix
+                socket, where the transfer is cheap enough that creating the archive isn't worth
+                it; pass False to never compress. The archive is created with ``find``, ``tar``
+                and the compressor in the image; if that fails, the files are downloaded as usual.
         """
 
         self.client = self.connect_to_docker(client)
         self.default_wdir = workingdir
         self.hostname = self.client.base_url
+        if staging not in self.STAGING_MODES:
+            raise ValueError('Staging mode must be one of %s' % (self.STAGING_MODES,))
+        self.staging = staging
+        if output_discovery not in self.OUTPUT_DISCOVERY_MODES:
+            raise ValueError('Output discovery mode must be one of %s' %
+                             (self.OUTPUT_DISCOVERY_MODES,))
+        self.output_discovery = output_discovery
+        if compress_outputs and compress_outputs not in COMPRESSORS:
+            raise ValueError('Output compression must be one of %s' % (tuple(COMPRESSORS),))
+        self.compress_outputs = compress_outputs
+        self.cache_images = cache_images
+        self.image_cache_max_age = image_cache_max_age
+        self.image_cache_max_bytes = image_cache_max_bytes
+        self.status_ttl = status_ttl
+        self.watch_events = watch_events
+        self.transfer_stats = files.TransferStats.for_client(self.client)
+        self._status_cache = {}  # container id -> (status, time checked)
+        self._tracked_containers = set()  # running containers that have our label
+        self._init_event_listener()
+
+    def _init_event_listener(self):
+        self._jobs = weakref.WeakValueDictionary()  # container id -> job
+        self._status_changed = threading.Condition()
+        self._event_stream = None
+        self._event_thread = None
+        self._callback_executor = None
+        self._async_waiters = {}  # container id -> [(event loop, future)]
 
     def connect_to_docker(self, client=None):
         if isinstance(client, basestring):
@@ -72,8 +192,15 @@ class Docker(EngineBase):
         newdict = self.__dict__.copy()
         if 'client' in newdict:
             newdict['client'] = None
+        for key in ('_jobs', '_status_changed', '_event_stream', '_event_thread',
+                    '_callback_executor', '_async_waiters'):
+            newdict.pop(key, None)
         return newdict
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_event_listener()
+
     def test_connection(self):
         version = self.client.version()
         return version
@@ -109,6 +236,8 @@ class Docker(EngineBase):
 
         if len(cmd) == 3 and cmd[0:2] == ['sh', '-c']:
             cmd = cmd[2]
+        elif len(cmd) == 4 and cmd[0:2] == ['sh', '-c']:  # wrapped by _generate_command
+            cmd = cmd[3]
         elif entrypoint is not None:
             cmd = entrypoint + cmd
 
@@ -119,6 +248,8 @@ class Docker(EngineBase):
         job.env = jobdata['Config']['Env']
         job.workingdir = jobdata['Config']['WorkingDir']
         job.rundata.container = jobdata
+        if JOB_LABEL in (jobdata['Config'].get('Labels') or {}):
+            self._tracked_containers.add(jobdata['Id'])
 
         return job
 
@@ -132,20 +263,165 @@ class Docker(EngineBase):
 
         if job.workingdir is None:
             job.workingdir = self.default_wdir
-        job.imageid = du.create_provisioned_image(self.client, job.image,
-                                                  job.workingdir, job.inputs)
+        job.rundata.output_discovery = self.output_discovery
+        job.rundata.compress_outputs = self._output_compression(job)
 
         container_args = self._generate_container_args(job)
 
-        job.rundata.container = self.client.create_container(job.imageid, **container_args)
-        self.client.start(job.rundata.container)
+        if not (self.staging == 'archive' and self._create_staged_container(job, container_args)):
+            job.imageid = self._provision_image(job)
+            job.rundata.container = self.client.create_container(job.imageid, **container_args)
+
         job.rundata.containerid = job.rundata.container['Id']
         job.jobid = job.rundata.containerid
+        if self.watch_events:
+            self.start_event_listener()
+        self._jobs[job.rundata.containerid] = job
+        self.client.start(job.rundata.container)
+
+        # Only track the container once it's started - refresh_statuses would otherwise see it as
+        # finished, since created containers aren't active.
+        with self._status_changed:
+            cached = self._status_cache.get(job.rundata.containerid)
+            if cached is None or cached[0] not in status.DONE_STATES:
+                self._tracked_containers.add(job.rundata.containerid)
+
+    def _create_staged_container(self, job, container_args):
+        """ Create the job's container directly from its base image, then upload the inputs
+        into it with a single ``put_archive`` call.
+
+        Returns:
+            bool: True if the container was created and staged, False if the inputs couldn't be
+               uploaded (the caller should fall back to building a provisioned image)
+
+        Note:
+            Because the inputs are written to the container's own filesystem layer, they show up
+            in ``client.diff``. Their paths, sizes and modification times are recorded in
+            ``job.rundata.staged_paths`` so that they aren't reported as outputs unless the job
+            changes them.
+        """
+        import tempfile
+
+        if not hasattr(self.client, 'put_archive'):  # docker-py < 2
+            return False
+
+        try:
+            container = self.client.create_container(job.image, **container_args)
+        except docker.errors.ImageNotFound:
+            repo, tag = docker.utils.parse_repository_tag(job.image)
+            self.client.pull(repo, tag=tag or 'latest')
+            container = self.client.create_container(job.image, **container_args)
+
+        staged = False
+        try:
+            if job.inputs:
+                with tempfile.SpooledTemporaryFile(max_size=self.ARCHIVE_SPOOL_BYTES) as buffer:
+                    staged_paths = du.make_input_archive(job.inputs, job.workingdir, buffer)
+                    buffer.seek(0)
+                    try:
+                        self.client.put_archive(container, '/', buffer)
+                    except docker.errors.APIError:
+                        return False
+                job.rundata.staged_paths = staged_paths
+            job.imageid = self.client.inspect_image(job.image)['Id']
+            staged = True
+        finally:
+            if not staged:  # don't leave the container behind, whatever went wrong
+                try:
+                    self.client.remove_container(container, force=True)
+                except docker.errors.APIError as exc:
+                    logging.warning('Could not remove container %s: %s' % (container['Id'], exc))
+
+        job.rundata.container = container
+        return True
+
+    def _provision_image(self, job):
+        """ Return the ID of an image with the job's inputs installed, building it only if
+        there isn't already a cached copy
+        """
+        tag = None
+        if self.cache_images:
+            tag = du.provisioned_image_tag(self.client, job.image, job.workingdir, job.inputs)
+            if tag is not None:
+                try:
+                    return self.client.inspect_image(tag)['Id']
+                except docker.errors.NotFound:
+                    pass
+
+        imageid = du.create_provisioned_image(self.client, job.image,
+                                              job.workingdir, job.inputs, tag=tag)
+        if tag is not None and (self.image_cache_max_age is not None or
+                                self.image_cache_max_bytes is not None):
+            self.prune_image_cache()
+        return imageid
+
+    def prune_image_cache(self, max_age=None, max_bytes=None):
+        """ Remove cached provisioned images from the docker daemon, oldest first
+
+        Args:
+            max_age (float): remove images older than this (in seconds)
+                (default: ``self.image_cache_max_age``)
+            max_bytes (int): maximum total size of the cache (default:
+                ``self.image_cache_max_bytes``). Pass 0 to clear the cache.
+
+        Returns:
+            List[str]: tags of the removed images
+        """
+        if max_age is None:
+            max_age = self.image_cache_max_age
+        if max_bytes is None:
+            max_bytes = self.image_cache_max_bytes
+        return du.prune_provisioned_images(self.client, max_age=max_age, max_bytes=max_bytes)
+
+    def _output_compression(self, job):
+        """ Returns:
+            str: how the job's outputs should be compressed (a key of ``COMPRESSORS``), or None
+        """
+        if self.compress_outputs is None:
+            compression = None if du.is_local_client(self.client) else 'gzip'
+        else:
+            compression = self.compress_outputs or None
+        if compression and job.outputs is not None and not self._relative_patterns(job):
+            return None  # none of the outputs would be in the archive
+        return compression
+
+    @staticmethod
+    def _relative_patterns(job):
+        return [pattern for pattern in (job.outputs or ()) if not posixpath.isabs(pattern)]
+
+    def _generate_command(self, job):
+        """ Wrap the job's command in a script that lists and/or compresses its output files
+        once it exits (if needed - see ``output_discovery`` and ``compress_outputs``)
+        """
+        import shlex
+
+        after = []
+        if job.rundata.get('output_discovery') == 'manifest':
+            after.append(LIST_OUTPUTS_SCRIPT.format(stamp=MANIFEST_STAMP, manifest=MANIFEST_PATH,
+                                                    wdir=job.workingdir))
+        compression = job.rundata.get('compress_outputs')
+        if compression:
+            filters = ''
+            if job.outputs is not None:
+                filters = '\\( %s \\) ' % ' -o '.join(
+                        '-path %s' % shlex.quote('./' + pattern)
+                        for pattern in self._relative_patterns(job))
+            after.append(COMPRESS_OUTPUTS_SCRIPT.format(
+                    wdir=shlex.quote(job.workingdir), stamp=MANIFEST_STAMP, filters=filters,
+                    filelist=COMPRESSED_OUTPUTS_LIST, compressor=COMPRESSORS[compression][0],
+                    archive=COMPRESSED_OUTPUTS_PATH + '.' + COMPRESSORS[compression][1]))
+
+        if not after:
+            return "sh -c '%s'" % job.command
+        script = RUN_SCRIPT.format(stamp=MANIFEST_STAMP) + ''.join(after) + 'exit $status'
+        return ['sh', '-c', script, job.command]
 
     def _generate_container_args(self, job):
-        container_args = dict(command="sh -c '%s'" % job.command,
+        command = self._generate_command(job)
+        container_args = dict(command=command,
                               working_dir=job.workingdir,
-                              environment={'PYTHONIOENCODING':'utf-8'})
+                              environment={'PYTHONIOENCODING':'utf-8'},
+                              labels={JOB_LABEL: 'true'})
 
         if job.env:
             container_args['environment'].update(job.env)
@@ -177,7 +453,13 @@ class Docker(EngineBase):
         return container_args
 
     def wait(self, job):
+        if self._events_cover(job.rundata.containerid):
+            self._wait_for_jobs([job], 1, None, poll_interval=1.0)
+        if 'exitcode' in job.rundata:  # reported by the event stream
+            return job.rundata.exitcode
+
         stat = self.client.wait(job.rundata.container)
+        self._set_status(job.rundata.containerid, status.FINISHED)
         if isinstance(stat, int):  # i.e., docker<3
             return stat
         else:  # i.e., docker>=3
@@ -185,73 +467,250 @@ class Docker(EngineBase):
 
     def kill(self, job):
         self.client.kill(job.rundata.container)
+        self._status_cache.pop(job.rundata.containerid, None)
 
     def get_status(self, job):
-        inspect = self.client.inspect_container(job.rundata.containerid)
-        if inspect['State']['Running']:
-            return status.RUNNING
+        """ Return the job's status, from the cache if it's less than ``self.status_ttl``
+        seconds old (or if the event listener will tell us when it changes)
+        """
+        containerid = job.rundata.containerid
+        cached = self._status_cache.get(containerid)
+        if cached is not None and (cached[0] in status.DONE_STATES or
+                                   time.time() - cached[1] <= self.status_ttl):
+            return cached[0]
+        if self._events_cover(containerid):
+            return status.RUNNING if cached is None else cached[0]
+
+        if containerid in self._tracked_containers:
+            self.refresh_statuses()
         else:
-            return status.FINISHED
+            inspect = self.client.inspect_container(containerid)
+            self._set_status(containerid,
+                             status.RUNNING if inspect['State']['Running']
+                             else status.FINISHED)
+        return self._status_cache[containerid][0]
 
-    def get_directory(self, job, path):
-        docker_host = du.kwargs_from_client(self.client)
-        remotedir = files.DockerArchive(docker_host, job.rundata.containerid, path)
-        return remotedir
+    def refresh_statuses(self):
+        """ Update the cached statuses of all running jobs submitted through this engine, using a
+        single request to the daemon
+        """
+        tracked = list(self._tracked_containers)
+        active = self.client.containers(all=True,
+                                        filters={'label': JOB_LABEL,
+                                                 'status': ACTIVE_CONTAINER_STATES},
+                                        quiet=True)
+        active_ids = set(container['Id'] for container in active)
+        for containerid in tracked:
+            if containerid in active_ids:
+                self._set_status(containerid, status.RUNNING)
+            else:
+                self._set_status(containerid, status.FINISHED)
 
-    def dump_all_outputs(self, job, target, abspaths=None):
-        """ Specialized dumping strategy - copy the entire working directory, then discard
-        the input files that came along for the ride.
+    def _set_status(self, containerid, stat):
+        with self._status_changed:
+            self._status_cache[containerid] = (stat, time.time())
+            if stat in status.DONE_STATES:
+                self._tracked_containers.discard(containerid)
+                self._status_changed.notify_all()
+                self._wake_async_waiters(self._async_waiters.pop(containerid, ()))
 
-        Not used if there are absolute paths
+    def start_event_listener(self):
+        """ Start listening for containers exiting, using a single connection to the daemon's
+        event stream. Called automatically when a job is submitted if ``self.watch_events`` is set.
 
-        This is slow and wasteful if there are big input files
+        The statuses of all running jobs are refreshed once the stream is open, so that no exits
+        are missed.
         """
-        import os
-        import shutil
-        from pathlib import Path
-
-        root = Path(native_str(target))
-        true_outputs = job.get_output()
-
-        if abspaths or len(true_outputs) < self.BULK_OUTPUT_FILE_THRESHOLD:
-            return super().dump_all_outputs(job, root, abspaths)
-
-        stagingdir = root / Path(native_str(job.workingdir)).name
-        workdir = job.get_directory(job.workingdir)
-        if not root.is_dir():
-            root.mkdir(parents=False)
-        if stagingdir.exists():
-            if PY2:
-                raise IOError('Path % exists' % stagingdir)
-            else:
-                raise FileExistsError(stagingdir)
-        workdir.put(str(root))
-        assert stagingdir.is_dir()
-        assert root in stagingdir.parents
+        with self._status_changed:
+            if self._event_thread is not None:
+                return
+            self._open_event_stream()
+            self._event_thread = threading.Thread(target=self._listen_for_events,
+                                                  name='pyccc docker event listener')
+            self._event_thread.daemon = True
+            self._event_thread.start()
 
-        for pathstr in true_outputs:
-            if os.path.isabs(pathstr):
-                continue
-            destpath = root / pathstr
-            currpath = stagingdir / pathstr
-            if not destpath.parent.is_dir():
-                destpath.parent.mkdir(parents=True)
-            currpath.rename(destpath)
+    def stop_event_listener(self):
+        """ Stop listening to the daemon's event stream; statuses will be polled instead
+        """
+        with self._status_changed:
+            stream, self._event_stream = self._event_stream, None
+            self._event_thread = None
+            self._status_changed.notify_all()
+            waiters, self._async_waiters = self._async_waiters, {}
+            for containerwaiters in waiters.values():
+                self._wake_async_waiters(containerwaiters)
+        if stream is not None and hasattr(stream, 'close'):
+            stream.close()
+        executor, self._callback_executor = self._callback_executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
 
-        shutil.rmtree(str(stagingdir))
+    def close(self):
+        """ Stop this engine's background threads (the event listener, if it was started). Jobs
+        can still be submitted and checked; their statuses will be polled.
+        """
+        self.watch_events = False
+        self.stop_event_listener()
 
-    def _list_output_files(self, job):
-        docker_diff = self.client.diff(job.rundata.container)
-        if docker_diff is None:
-            return {}
+    def _open_event_stream(self):
+        """ Subscribe to exit events for pyccc containers, then catch up on any that were
+        missed before the subscription started
+        """
+        # the stream ties up its connection, so it gets a client of its own
+        client = du.get_docker_apiclient(**du.kwargs_from_client(self.client))
+        self._event_stream = client.events(decode=True,
+                                           filters={'type': 'container',
+                                                    'event': WATCHED_EVENTS,
+                                                    'label': JOB_LABEL})
+        if self._tracked_containers:
+            self.refresh_statuses()
 
-        changed_files = [f['Path'] for f in docker_diff
-                         if f['Kind'] in (CTR_MODIFIED, CTR_ADDED)]
-        file_paths = utils.remove_directories(changed_files)
+    def _events_cover(self, containerid):
+        """ Whether we'll be notified when this container exits
+        """
+        return self._event_thread is not None and containerid in self._tracked_containers
+
+    def _listen_for_events(self):
+        thread = threading.current_thread()
+        retry_delay = 0.5
+        while self._event_thread is thread:
+            stream = self._event_stream
+            try:
+                for event in stream:
+                    self._handle_event(event)
+                    retry_delay = 0.5
+            except Exception as exc:
+                if self._event_thread is not thread:
+                    return
+                logging.warning('Lost connection to the docker event stream: %s' % exc)
+
+            if self._event_thread is not thread:
+                return
+            time.sleep(retry_delay)
+            retry_delay = min(2 * retry_delay, 30.0)
+            try:
+                with self._status_changed:
+                    if self._event_thread is thread:
+                        self._open_event_stream()
+            except Exception as exc:
+                logging.warning('Failed to reconnect to the docker event stream: %s' % exc)
+
+    def _handle_event(self, event):
+        containerid = event.get('id')
+        action = event.get('Action', event.get('status'))
+        job = self._jobs.get(containerid)
+        if job is not None:
+            job.rundata.setdefault('container_events', []).append(action)
+        if action != 'die':
+            return
+
+        if job is not None:
+            attributes = event.get('Actor', {}).get('Attributes', {})
+            if 'exitCode' in attributes:
+                job.rundata.exitcode = int(attributes['exitCode'])
+        if job is not None or containerid in self._tracked_containers:
+            self._set_status(containerid, status.FINISHED)
+
+        if job is not None and (job.on_status_update is not None or
+                                job.when_finished is not None):
+            if self._callback_executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._callback_executor = ThreadPoolExecutor(max_workers=1)
+            self._callback_executor.submit(self._run_callbacks, job)
+
+    @staticmethod
+    def _run_callbacks(job):
+        """ Called (in a separate thread from the event listener) once a job has finished
+        """
+        try:
+            if job.on_status_update is not None:
+                job.on_status_update(job)
+            if job.when_finished is not None:
+                job._ensure_finished()
+        except Exception:
+            logging.exception('Callback for job %s failed' % job.jobid)
+
+    def wait_async(self, job):
+        """ Wait for the job without blocking a thread, if the event listener is running
+        """
+        import asyncio
+
+        containerid = job.rundata.containerid
+        with self._status_changed:
+            if not self._events_cover(containerid):
+                return super().wait_async(job)
+            loop = asyncio.get_event_loop()
+            exited = loop.create_future()
+            self._async_waiters.setdefault(containerid, []).append((loop, exited))
+
+        def _get_exitcode(_):
+            if 'exitcode' in job.rundata:
+                return job.rundata.exitcode
+            return asynchronous.run_async(self, self.wait, job)
+
+        return asynchronous.then(exited, _get_exitcode)
+
+    @staticmethod
+    def _wake_async_waiters(waiters):
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(_set_result_if_pending, future, None)
+            except RuntimeError:  # the loop has been closed
+                pass
+
+    def wait_any(self, jobs, timeout=None, poll_interval=1.0):
+        if self.watch_events:
+            self.start_event_listener()
+        return super().wait_any(jobs, timeout, poll_interval)
+
+    def wait_all(self, jobs, timeout=None, poll_interval=1.0):
+        if self.watch_events:
+            self.start_event_listener()
+        return super().wait_all(jobs, timeout, poll_interval)
+
+    def _wait_for_jobs(self, jobs, count, timeout, poll_interval):
+        # holding the lock while checking statuses means that no notifications are missed
+        with self._status_changed:
+            return super()._wait_for_jobs(jobs, count, timeout, poll_interval)
+
+    def _sleep_until_status_change(self, delay):
+        self._status_changed.wait(delay)
+
+    def get_directory(self, job, path):
         docker_host = du.kwargs_from_client(self.client)
+        remotedir = files.DockerArchive(docker_host, job.rundata.containerid, path,
+                                        version=self._filesystem_version(job))
+        return remotedir
 
-        output_files = {}
+    def _filesystem_version(self, job):
+        """ Returns:
+            str: identifies the state of the job container's filesystem once it can no longer
+               change (i.e., when the container finished), or None while it's running
+        """
+        state = self.client.inspect_container(job.rundata.containerid)['State']
+        return None if state['Running'] else state['FinishedAt']
+
+    def _list_output_files(self, job):
+        mode = job.rundata.get('output_discovery', 'diff')
+        sizes = {}
+        if mode in ('diff', 'workdir-diff'):
+            file_paths, added_paths = self._diff_outputs(job, workdir_only=(mode != 'diff'))
+            unchanged = self._unchanged_staged_paths(job, file_paths)
+            file_paths = [path for path in file_paths if path not in unchanged]
+        elif mode == 'archive':
+            file_paths, added_paths, sizes = self._scan_outputs(job)
+        elif mode == 'manifest':
+            file_paths, added_paths = self._read_output_manifest(job)
+        else:
+            raise ValueError('Unknown output discovery mode "%s"' % mode)
+
+        relative_paths = {}
+        undeclared_paths = []
         for filename in file_paths:
+            if filename.startswith(INTERNAL_PREFIX):
+                continue
+
             # Return relative localpath unless it's not under the working directory
             if filename.strip()[0] != '/':
                 relative_path = '%s/%s' % (job.workingdir, filename)
@@ -262,11 +721,367 @@ class Docker(EngineBase):
             else:
                 relative_path = filename
 
-            remotefile = files.LazyDockerCopy(docker_host, job.rundata.containerid, filename)
+            if job.declares_output(relative_path):
+                relative_paths[filename] = relative_path
+            else:
+                undeclared_paths.append(filename)
+
+        docker_host = du.kwargs_from_client(self.client)
+        version = self._filesystem_version(job)
+        store = self._get_output_store(job, docker_host, list(relative_paths), added_paths,
+                                       other_paths=undeclared_paths, sizes=sizes,
+                                       version=version)
+
+        output_files = {}
+        for filename, relative_path in relative_paths.items():
+            remotefile = files.LazyDockerCopy(docker_host, job.rundata.containerid, filename,
+                                              store=store, stats=self.transfer_stats,
+                                              version=version)
             output_files[relative_path] = remotefile
         return output_files
 
+    def dump_all_outputs(self, job, target, abspaths=None, progress=None):
+        if job.rundata.get('compress_outputs'):
+            self._download_compressed_outputs(job)
+        return super(Docker, self).dump_all_outputs(job, target, abspaths, progress)
+
+    def _download_compressed_outputs(self, job):
+        """ Download the output files in the job's working directory from the compressed archive
+        that was created when it exited (see ``compress_outputs``). Files that aren't in the
+        archive are left to be fetched as usual.
+        """
+        cache = files.get_file_cache()
+        prefix = job.workingdir.rstrip('/') + '/'
+        pending = [f for f in job.get_output().values()
+                   if isinstance(f, files.LazyDockerCopy) and not f._fetched
+                   and f.containerpath.startswith(prefix)
+                   and (f._cache_key() is None or cache.lookup(f._cache_key()) is None)]
+        if not pending:
+            return
+
+        extension = COMPRESSORS[job.rundata.compress_outputs][1]
+        store = files.DockerCompressedOutputStore(
+                du.kwargs_from_client(self.client), job.rundata.containerid,
+                '%s.%s' % (COMPRESSED_OUTPUTS_PATH, extension), prefix.rstrip('/'),
+                [f.containerpath for f in pending], compression=extension,
+                version=pending[0].version)
+        for remotefile in pending:
+            remotefile.download_from(store)
+
+    def _unchanged_staged_paths(self, job, paths, stats=None):
+        """ Find the input files (staged by :meth:`_create_staged_container`) that the job didn't
+        change: they have the same size and modification time as when they were staged.
+
+        Args:
+            paths (List[str]): paths to check (others are ignored)
+            stats (Mapping[str, Tuple[int, int]]): current sizes and modification times of the
+               paths, if known; otherwise, they're requested from the daemon
+
+        Returns:
+            Set[str]: paths of the unchanged inputs
+        """
+        staged = job.rundata.get('staged_paths') or {}
+        unchanged = set()
+        for path in paths:
+            if path not in staged:
+                continue
+            if staged[path] is None:  # a directory
+                unchanged.add(path)
+                continue
+            current = (stats or {}).get(path)
+            if current is None:
+                try:
+                    current = du.stat_container_path(self.client, job.rundata.containerid, path)
+                except docker.errors.NotFound:
+                    continue
+            if tuple(current) == tuple(staged[path]):
+                unchanged.add(path)
+        return unchanged
+
+    def _diff_outputs(self, job, workdir_only):
+        """ Find output files with ``client.diff``
+
+        Returns:
+            Tuple[List[str], Set[str]]: paths of the changed files, and paths that were added to
+               the container (see :meth:`_get_output_store`)
+        """
+        docker_diff = self.client.diff(job.rundata.container)
+        if docker_diff is None:
+            return [], set()
+
+        if workdir_only:
+            prefix = job.workingdir.rstrip('/') + '/'
+            docker_diff = [f for f in docker_diff if f['Path'].startswith(prefix)]
+        changed_files = [f['Path'] for f in docker_diff
+                         if f['Kind'] in (CTR_MODIFIED, CTR_ADDED)]
+        added_paths = set(f['Path'] for f in docker_diff if f['Kind'] == CTR_ADDED)
+        return utils.remove_directories(changed_files), added_paths
+
+    def _scan_outputs(self, job):
+        """ Find output files by reading the file headers from an archive of the working
+        directory: outputs are files modified after the container started.
+
+        Returns:
+            Tuple[List[str], Set[str], Dict[str, int]]: paths of the output files, directories
+               that only contain inputs and outputs (see :meth:`_get_output_store`), and the
+               sizes of the files in the working directory
+        """
+        import calendar
+        import tarfile
+
+        started = self.client.inspect_container(job.rundata.containerid)['State']['StartedAt']
+        starttime = calendar.timegm(time.strptime(started[:19], '%Y-%m-%dT%H:%M:%S'))
+        staged_paths = job.rundata.get('staged_paths') or {}
+        workingdir = job.workingdir.rstrip('/')
+        parent = posixpath.dirname(workingdir)
+
+        file_paths = []
+        sizes = {}
+        other_dirs = set()  # directories that contain files that aren't inputs or outputs
+        stream = _get_archive_stream(self.client, job.rundata.containerid, workingdir)
+        try:
+            with tarfile.open(fileobj=du.IterStream(stream), mode='r|') as tf:
+                all_dirs = set()
+                for member in tf:
+                    path = posixpath.join(parent, posixpath.normpath(member.name))
+                    if member.isdir():
+                        all_dirs.add(path)
+                        continue
+                    sizes[path] = member.size
+                    stat = {path: (member.size, int(member.mtime))}
+                    if path in staged_paths and self._unchanged_staged_paths(job, [path], stat):
+                        continue
+                    if member.isfile() and member.mtime >= starttime:
+                        file_paths.append(path)
+                    else:
+                        other_dirs.update(_parent_dirs(path))
+        finally:
+            stream.close()
+        return file_paths, all_dirs - other_dirs, sizes
+
+    def _read_output_manifest(self, job):
+        """ Read the lists of output files, and of the other files in the working directory,
+        written by ``find`` inside the container (see ``MANIFEST_SCRIPT``). If the image couldn't
+        write them (e.g., it has no ``find``), the outputs are found with ``client.diff``
+        instead.
+
+        Returns:
+            Tuple[List[str], Set[str]]: paths of the output files, and directories that only
+               contain inputs and outputs (see :meth:`_get_output_store`)
+        """
+        import tarfile
+
+        try:
+            stream = _get_archive_stream(self.client, job.rundata.containerid, MANIFEST_PATH)
+        except docker.errors.NotFound:
+            logging.info('No output manifest for job %s; diffing its container instead' %
+                         job.jobid)
+            return self._diff_outputs(job, workdir_only=True)
+
+        manifest = {}
+        try:
+            with tarfile.open(fileobj=du.IterStream(stream), mode='r|') as tf:
+                for member in tf:
+                    if member.isfile():
+                        contents = tf.extractfile(member).read().decode('utf-8')
+                        manifest[posixpath.basename(member.name)] = contents.split('\0')
+        finally:
+            stream.close()
+
+        # inputs may have been written just before the job started; inputs that were staged in
+        # the container's own layer are still outputs if the job changed them
+        staged_paths = job.rundata.get('staged_paths') or {}
+        input_paths = set(posixpath.join(job.workingdir, path) for path in (job.inputs or {}))
+        input_paths.update(staged_paths)
+        outputs = [path for path in manifest.get('outputs', ()) if path]
+        unchanged = self._unchanged_staged_paths(job, outputs)
+        file_paths = [path for path in outputs
+                      if path not in unchanged and (path in staged_paths or
+                                                    path not in input_paths)]
+        other_dirs = set(directory for path in manifest.get('others', ())
+                         if path and path not in input_paths
+                         for directory in _parent_dirs(path))
+        workingdir = job.workingdir.rstrip('/')
+        added_paths = set(directory for path in file_paths for directory in _parent_dirs(path)
+                          if directory.startswith(workingdir) and directory not in other_dirs)
+        return file_paths, added_paths
+
+    def _get_output_store(self, job, docker_host, file_paths, added_paths, other_paths=(),
+                          sizes=None, version=None):
+        """ Plan how the job's output files should be downloaded: one at a time, or in bulk, with
+        archives of some of the directories that contain them.
+
+        Only directories that the job created (i.e., that were added to the container's
+        filesystem) can be archived, since anything else may also contain files from the image.
+        Archiving a directory replaces a request per output file with a single request, but the
+        archive also transfers everything else in the directory - input files, and any other
+        files the job wrote (e.g., outputs that weren't declared) - which is skipped when
+        extracting. So the choice ranges from per-file copies, through archives of small
+        directories that only hold outputs, to an archive of the whole working directory.
+
+        The directories are chosen to minimize the estimated download time, using the
+        per-request latency and throughput measured for this engine (see ``transfer_stats``).
+        Files of unknown size count as too large to transfer unnecessarily, and directories
+        with more than ``BULK_OUTPUT_MAX_EXTRA_BYTES`` of other files are never archived.
+
+        Args:
+            job (pyccc.job.Job): the job
+            docker_host (dict): connection arguments for the docker client
+            file_paths (List[str]): absolute paths of the output files
+            added_paths (Set[str]): paths that were added to the container's filesystem
+            other_paths (Iterable[str]): absolute paths of other files written by the job
+            sizes (Mapping[str, int]): sizes of files in the container, where known
+            version (str): version of the container's filesystem (see
+               :class:`pyccc.files.LazyDockerCopy`)
+
+        Returns:
+            pyccc.files.DockerOutputStore: store to fetch the outputs from, or None to fetch
+               them one at a time
+        """
+        sizes = sizes or {}
+        extra_bytes = collections.Counter()  # bytes of other files under each directory
+        other_sizes = [(path, sizes.get(path, float('inf'))) for path in other_paths]
+        for path, ref in (job.inputs or {}).items():
+            path = posixpath.join(job.workingdir, path)
+            try:
+                size = ref.size_bytes()
+            except (AttributeError, NotImplementedError, OSError):  # size not known locally
+                size = float('inf')
+            other_sizes.append((path, size))
+        for path, size in other_sizes:
+            for directory in _parent_dirs(path):
+                extra_bytes[directory] += size
+
+        num_outputs = collections.Counter()  # output files under each candidate directory
+        for path in file_paths:
+            for directory in _parent_dirs(path):
+                if directory in added_paths:
+                    num_outputs[directory] += 1
+
+        def savings(directory):  # time saved by archiving instead of copying file-by-file
+            if extra_bytes[directory] > self.BULK_OUTPUT_MAX_EXTRA_BYTES:
+                return float('-inf')
+            return (self.transfer_stats.estimate(num_outputs[directory], 0) -
+                    self.transfer_stats.estimate(1, extra_bytes[directory]))
+
+        # Pick the set of non-overlapping directories that saves the most time: working from
+        # the bottom up, archive each directory if that beats the best plan for its
+        # subdirectories
+        best = {}  # directory -> (time saved, directories to archive)
+        children = collections.defaultdict(list)
+        for directory in sorted(num_outputs, key=len, reverse=True):
+            from_children = (sum(best[child][0] for child in children[directory]),
+                             [d for child in children[directory] for d in best[child][1]])
+            own = savings(directory)
+            best[directory] = (own, [directory]) if own > from_children[0] else from_children
+            parents = [d for d in _parent_dirs(directory) if d in num_outputs]
+            if parents:
+                children[parents[-1]].append(directory)
+            elif best[directory][0] > 0:
+                children[None].append(directory)
+
+        archives = collections.defaultdict(list)
+        selected = set(d for root in children[None] for d in best[root][1])
+        for path in file_paths:
+            for directory in _parent_dirs(path):
+                if directory in selected:
+                    archives[directory].append(path)
+                    break
+
+        if not archives:
+            return None
+        return files.DockerOutputStore(docker_host, job.rundata.containerid, archives,
+                                       stats=self.transfer_stats, version=version)
+
+    def get_stdoutstream(self, job, follow=True, since=None, tail=None):
+        """ Iterate over lines of the job's stdout
+
+        Args:
+            follow (bool): keep iterating as new output is written, until the job finishes
+               (otherwise, stop at the end of the output written so far)
+            since (float or datetime.datetime): only include output written after this time (as a
+               UNIX timestamp)
+            tail (int): only include this many lines of the output that was already written
+
+        Returns:
+            Iterator[str]: lines of stdout
+        """
+        return self._follow_logs(job, du.STDOUT_CHANNEL, follow, since, tail)
+
+    def get_stderrstream(self, job, follow=True, since=None, tail=None):
+        """ Iterate over lines of the job's stderr (see :meth:`get_stdoutstream`)
+
+        Returns:
+            Iterator[str]: lines of stderr
+        """
+        return self._follow_logs(job, du.STDERR_CHANNEL, follow, since, tail)
+
+    def _follow_logs(self, job, channel, follow, since, tail):
+        stream = du.stream_logs(self.client, job.rundata.containerid,
+                                stdout=(channel == du.STDOUT_CHANNEL),
+                                stderr=(channel == du.STDERR_CHANNEL),
+                                follow=follow, since=since, tail=tail)
+        return _iter_lines(data for _, data in stream)
+
     def _get_final_stds(self, job):
-        stdout = self.client.logs(job.rundata.container, stdout=True, stderr=False)
-        stderr = self.client.logs(job.rundata.container, stdout=False, stderr=True)
-        return stdout.decode('utf-8'), stderr.decode('utf-8')
+        """ Download stdout and stderr with a single request, spooling them into the file cache
+        as they arrive (see :func:`pyccc.docker_utils.stream_logs`)
+        """
+        cache = files.get_file_cache()
+        source = '%s (%s)' % (du.kwargs_from_client(self.client), job.rundata.containerid)
+        keys = ['docker-logs %s %s' % (name, source) for name in ('stdout', 'stderr')]
+        digests = [cache.lookup(key) for key in keys]
+        pinned = False
+        if None in digests:
+            with cache.tempfile(mode='wb') as stdout, cache.tempfile(mode='wb') as stderr:
+                spools = {du.STDOUT_CHANNEL: stdout, du.STDERR_CHANNEL: stderr}
+                try:
+                    for channel, data in du.stream_logs(self.client, job.rundata.containerid):
+                        spools.get(channel, stdout).write(data)
+                except Exception:
+                    for spool in (stdout, stderr):
+                        spool.close()
+                        os.unlink(spool.name)
+                    raise
+            digests = [cache.add(spool.name, source=key, pin=True)
+                       for spool, key in zip((stdout, stderr), keys)]
+            pinned = True
+
+        return tuple(files.CachedFile.from_cache(digest, '%s of %s' % (name, source),
+                                                 'Docker container logs', encoded_with='utf-8',
+                                                 pinned=pinned)
+                     for digest, name in zip(digests, ('stdout', 'stderr')))
+
+
+def _iter_lines(chunks):
+    """ Split a stream of UTF-8 encoded bytes into lines of text
+    """
+    partial = b''
+    for data in chunks:
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8') + '\n'
+    if partial:
+        yield partial.decode('utf-8')
+
+
+def _get_archive_stream(client, containerid, path):
+    request, meta = client.get_archive(containerid, path)
+    return request
+
+
+def _parent_dirs(path):
+    """ All directories containing a path, starting at the top (but excluding the root)
+
+    Examples:
+        >>> _parent_dirs('/a/b/c.txt')
+        ['/a', '/a/b']
+    """
+    fields = path.rstrip('/').split('/')
+    return ['/'.join(fields[:i]) for i in range(2, len(fields))]
+
+
+def _set_result_if_pending(future, result):
+    if not future.done():
+        future.set_result(result)
@@ -0,0 +1,446 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import docker.errors
+
+from .. import docker_utils as du
+from .. import files, status
+from .dockerengine import Docker, _iter_lines
+
+__all__ = ['DockerPool']
+
+# Runs the job command (passed as $0) in its own directory, with its stdout and stderr sent to
+# files next to that directory. The timestamp file lets us find files that the job changed; as in
+# the Docker engine's RUN_SCRIPT, it's backdated, since file times can be coarser than "-newer"
+# needs.
+# The command runs in a new session (if the image has ``setsid``), so that its process ID, which
+# is written to the pid file, is also the ID of the process group of everything it starts.
+EXEC_SCRIPT = ('mkdir -p {d} && cd {d} && '
+               '{{ touch -d @$(($(date +%s) - 1)) {d}.stamp 2>/dev/null || touch {d}.stamp; }} && '
+               'if command -v setsid > /dev/null; then s=setsid; else s=; fi && '
+               '{{ $s sh -c "$0" > {d}.stdout 2> {d}.stderr & echo $! > {d}.pid; wait $!; }}')
+
+# Kills a job's process group (or just the job's own process, if it isn't a group leader)
+KILL_SCRIPT = 'p=$(cat {d}.pid) && {{ kill -s TERM -- -$p 2> /dev/null || kill -s TERM $p; }}'
+
+# Prints the contents of one of a job's output files ($0) starting from a byte offset ($1).
+# If $2 is "follow", keeps polling for new output until the job's process exits, and reads the
+# file once more afterwards so that nothing written just before the end is missed.
+FOLLOW_SCRIPT = ('i=0; while [ ! -f {d}.pid ] && [ $i -lt 50 ]; do sleep 0.1; i=$((i+1)); done; '
+                 'off=$1; while :; do '
+                 'kill -0 $(cat {d}.pid) 2>/dev/null && running=1 || running=; '
+                 'size=$( (wc -c < "$0") 2>/dev/null || echo 0); '
+                 'if [ $size -gt $off ]; then '
+                 'tail -c +$((off+1)) "$0" | head -c $((size-off)); off=$size; fi; '
+                 '[ -n "$running" ] && [ "$2" = follow ] || break; sleep 0.2; done')
+
+
+class _PooledContainer(object):
+    def __init__(self, containerid, image, imageid):
+        self.id = containerid
+        self.image = image
+        self.imageid = imageid
+        self.active = 0
+        self.jobs_run = 0
+        self.retired = False
+        self.starting = containerid is None  # a reserved slot whose container is being started
+
+
+class DockerPool(Docker):
+    """ Runs jobs in a pool of long-lived containers instead of creating a new container for each
+    job.
+
+    Up to ``pool_size`` containers are started for each image, and left running. Each job
+    runs via ``docker exec`` in a new directory (under ``/pyccc-jobs``) in one of these containers;
+    its outputs are the files it creates or modifies in that directory. Containers are retired
+    after running ``max_jobs_per_container`` jobs, or once they stop running, and replaced with
+    fresh ones.
+
+    Jobs that need their own container - those that set a working directory, mount volumes or
+    the docker socket, or have inputs at absolute paths - run the same way as they would with the
+    :class:`Docker` engine.
+
+    Note:
+        Retired containers are stopped once their last job finishes, but aren't removed (so that
+        their jobs' outputs are still available) until :meth:`shutdown` is called.
+
+    Args:
+        pool_size (int): maximum number of containers to run per image
+        max_jobs_per_container (int): retire each container after it has run this many jobs
+        poll_interval (float): maximum time between status checks while waiting for a job
+        **kwargs: all other arguments are passed to :class:`Docker`
+    """
+    POOL_ROOT = '/pyccc-jobs'
+
+    def __init__(self, client=None, pool_size=4, max_jobs_per_container=50, poll_interval=1.0,
+                 **kwargs):
+        super().__init__(client=client, **kwargs)
+        self.pool_size = pool_size
+        self.max_jobs_per_container = max_jobs_per_container
+        self.poll_interval = poll_interval
+        self._init_pool_lock()
+        self._pools = {}
+
+    def _init_pool_lock(self):
+        self._pool_lock = threading.Lock()
+        self._pool_changed = threading.Condition(self._pool_lock)  # a container finished starting
+
+    def __getstate__(self):
+        """ The pool itself isn't pickled
+        """
+        state = super().__getstate__()
+        state['_pools'] = {}
+        state['_pool_lock'] = state['_pool_changed'] = None
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._init_pool_lock()
+
+    def shutdown(self):
+        """ Remove all of this engine's pooled containers (including retired ones).
+        Outputs from pooled jobs will no longer be accessible.
+        """
+        with self._pool_lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for container in pool:
+                if container.id is None:  # still starting
+                    continue
+                try:
+                    self.client.remove_container(container.id, force=True)
+                except docker.errors.NotFound:
+                    pass
+
+    def prestart(self, image, count=None):
+        """ Start pooled containers for an image ahead of time
+
+        Args:
+            image (str): image name
+            count (int): number of containers to have running (default: ``self.pool_size``)
+        """
+        if count is None:
+            count = self.pool_size
+        with self._pool_lock:
+            pool = self._pools.setdefault(image, [])
+            missing = count - len([c for c in pool if not c.retired])
+            reserved = [self._reserve(pool, image) for i in range(missing)]
+        for container in reserved:
+            self._start_reserved(pool, container)
+
+    def _is_pooled(self, job):
+        return job.rundata.get('execid') is not None
+
+    def _can_pool(self, job):
+        if job.workingdir is not None or job.withdocker:
+            return False
+        if job.engine_options.get('mount_docker_socket') or job.engine_options.get('volumes'):
+            return False
+        return not any(os.path.isabs(path) for path in job.inputs)
+
+    @staticmethod
+    def _reserve(pool, image):
+        """ Reserve a slot in the pool for a new container. Must be called with the pool lock held;
+        the container must then be started with :meth:`_start_reserved` (without the lock).
+        """
+        container = _PooledContainer(None, image, None)
+        pool.append(container)
+        return container
+
+    def _start_reserved(self, pool, container):
+        """ Start the container for a reserved slot, then let any jobs waiting for it run. If it
+        can't be started, the slot is given up.
+        """
+        try:
+            containerid, imageid = self._start_container(container.image)
+        except Exception:
+            with self._pool_changed:
+                if container in pool:
+                    pool.remove(container)
+                container.starting = False
+                self._pool_changed.notify_all()
+            raise
+        with self._pool_changed:
+            container.id, container.imageid = containerid, imageid
+            container.starting = False
+            self._pool_changed.notify_all()
+
+    def _start_container(self, image):
+        """ Create and start a new idle container
+
+        Returns:
+            Tuple[str, str]: the container's ID and its image's ID
+        """
+        args = dict(command=['sh', '-c', 'while true; do sleep 3600; done'],
+                    labels={'pyccc.pool': 'true'})
+        try:
+            container = self.client.create_container(image, **args)
+        except docker.errors.ImageNotFound:
+            repo, tag = docker.utils.parse_repository_tag(image)
+            self.client.pull(repo, tag=tag or 'latest')
+            container = self.client.create_container(image, **args)
+        self.client.start(container)
+        return container['Id'], self.client.inspect_image(image)['Id']
+
+    def _acquire(self, image):
+        """ Get the least busy container for this image, starting a new one if there's room.
+
+        New containers are started without holding the pool lock, so that other jobs can be
+        submitted (and released) in the meantime; jobs that are assigned to a container that's
+        still starting wait for it.
+        """
+        while True:
+            with self._pool_lock:
+                pool = self._pools.setdefault(image, [])
+                candidates = [c for c in pool if not c.retired]
+                idle = [c for c in candidates if c.active == 0]
+                start = False
+                if idle:
+                    container = idle[0]
+                elif len(candidates) < self.pool_size:
+                    container = self._reserve(pool, image)
+                    start = True
+                else:
+                    container = min(candidates, key=lambda c: c.active)
+                container.active += 1
+                container.jobs_run += 1
+                if container.jobs_run >= self.max_jobs_per_container:
+                    container.retired = True
+
+            if start:
+                self._start_reserved(pool, container)
+                return container
+            with self._pool_changed:
+                while container.starting:
+                    self._pool_changed.wait()
+                if container.id is not None:
+                    return container
+                container.active -= 1  # it couldn't be started, so try again
+                container.jobs_run -= 1
+
+    def _unacquire(self, container):
+        """ Undo :meth:`_acquire` for a job that won't run in the container after all
+        """
+        with self._pool_lock:
+            container.active -= 1
+            container.jobs_run -= 1
+
+    def _release(self, job):
+        """ Called once a pooled job is done; stops its container if it was retired and is idle
+        """
+        container = job.rundata.pooled_container
+        with self._pool_lock:
+            if job.rundata.get('released'):
+                return
+            job.rundata.released = True
+            container.active -= 1
+            stop = container.retired and container.active == 0
+        if stop:
+            self.client.stop(container.id, timeout=1)
+
+    def _retire_if_stopped(self, container):
+        if not self.client.inspect_container(container.id)['State']['Running']:
+            container.retired = True
+            return True
+        return False
+
+    def _forget_pooled_run(self, job):
+        """ Clear what the pool filled in when the job was last submitted, so that it can be
+        resubmitted (possibly to a different container)
+        """
+        self._release(job)
+        job.workingdir = None  # it was assigned by the pool
+        for key in ('pooled_container', 'container', 'containerid', 'execid', 'released',
+                    'staged_paths'):
+            job.rundata.pop(key, None)
+
+    def submit(self, job):
+        if job.rundata.get('pooled_container') is not None:  # resubmitted
+            self._forget_pooled_run(job)
+        if not self._can_pool(job):
+            return super().submit(job)
+
+        self._check_job(job)
+        while True:
+            container = self._acquire(job.image)
+            if not self._retire_if_stopped(container):
+                break
+            self._unacquire(container)
+
+        jobdir = '%s/%s' % (self.POOL_ROOT, uuid.uuid4().hex)
+        job.workingdir = jobdir
+        job.imageid = container.imageid
+        if job.inputs:
+            with tempfile.SpooledTemporaryFile(max_size=self.ARCHIVE_SPOOL_BYTES) as buffer:
+                job.rundata.staged_paths = du.make_input_archive(job.inputs, jobdir, buffer)
+                buffer.seek(0)
+                self.client.put_archive(container.id, '/', buffer)
+
+        environment = {'PYTHONIOENCODING': 'utf-8'}
+        environment.update(job.env)
+        execinfo = self.client.exec_create(container.id,
+                                           ['sh', '-c', EXEC_SCRIPT.format(d=jobdir),
+                                            job.command],
+                                           environment=environment)
+        self.client.exec_start(execinfo['Id'], detach=True)
+
+        job.rundata.pooled_container = container
+        job.rundata.container = {'Id': container.id}
+        job.rundata.containerid = container.id
+        job.rundata.execid = job.jobid = execinfo['Id']
+
+    def get_status(self, job):
+        if not self._is_pooled(job):
+            return super().get_status(job)
+        if self.client.exec_inspect(job.rundata.execid)['Running']:
+            return status.RUNNING
+        self._release(job)
+        return status.FINISHED
+
+    def wait(self, job):
+        if not self._is_pooled(job):
+            return super().wait(job)
+
+        interval = 0.05
+        while True:
+            info = self.client.exec_inspect(job.rundata.execid)
+            if not info['Running']:
+                break
+            time.sleep(interval)
+            interval = min(2 * interval, self.poll_interval)
+
+        self._release(job)
+        if info['ExitCode'] in (126, 127):  # the container itself may be broken
+            self._retire_if_stopped(job.rundata.pooled_container)
+        return info['ExitCode']
+
+    def kill(self, job):
+        if not self._is_pooled(job):
+            return super().kill(job)
+        execinfo = self.client.exec_create(job.rundata.containerid,
+                                           ['sh', '-c', KILL_SCRIPT.format(d=job.workingdir)])
+        self.client.exec_start(execinfo['Id'])
+
+    def _list_output_files(self, job):
+        if not self._is_pooled(job):
+            return super()._list_output_files(job)
+
+        if self.client.inspect_container(job.rundata.containerid)['State']['Running']:
+            paths, stats = self._find_changed_files(job), None
+        else:
+            paths, stats = self._scan_changed_files(job)
+        unchanged = self._unchanged_staged_paths(job, paths, stats)  # just-uploaded inputs
+
+        docker_host = du.kwargs_from_client(self.client)
+        prefix = job.workingdir + '/'
+        return {path[len(prefix):]: files.LazyDockerCopy(docker_host, job.rundata.containerid,
+                                                         path, stats=self.transfer_stats)
+                for path in paths
+                if path.startswith(prefix) and path not in unchanged
+                and job.declares_output(path[len(prefix):])}
+
+    def _find_changed_files(self, job):
+        """ List files modified after the job started (i.e., newer than its stamp file), using
+        ``find`` inside the (running) container
+        """
+        execinfo = self.client.exec_create(job.rundata.containerid,
+                                           ['find', job.workingdir, '-type', 'f',
+                                            '-newer', job.workingdir + '.stamp'],
+                                           stderr=False)
+        output = self.client.exec_start(execinfo['Id'])
+        return output.decode('utf-8').splitlines()
+
+    def _scan_changed_files(self, job):
+        """ List files modified after the job started by reading the file headers from an archive
+        of the job's directory (for containers that are no longer running). Uses the same
+        comparison as ``find -newer`` in :meth:`_find_changed_files`.
+
+        Returns:
+            Tuple[List[str], Dict[str, Tuple[int, int]]]: paths of the changed files, and the
+               sizes and modification times of all files in the directory
+        """
+        import tarfile
+
+        request, meta = self.client.get_archive(job.rundata.containerid,
+                                                job.workingdir + '.stamp')
+        with tarfile.open(fileobj=du.IterStream(request), mode='r|') as tf:
+            stamptime = next(iter(tf)).mtime
+
+        request, meta = self.client.get_archive(job.rundata.containerid, job.workingdir)
+        parent = os.path.dirname(job.workingdir)
+        paths = []
+        stats = {}
+        with tarfile.open(fileobj=du.IterStream(request), mode='r|') as tf:
+            for member in tf:
+                if not member.isfile():
+                    continue
+                path = '%s/%s' % (parent, member.name)
+                stats[path] = (member.size, int(member.mtime))
+                if member.mtime > stamptime:
+                    paths.append(path)
+        return paths, stats
+
+    def get_stdoutstream(self, job, follow=True, since=None, tail=None):
+        if not self._is_pooled(job):
+            return super().get_stdoutstream(job, follow=follow, since=since, tail=tail)
+        return self._follow_file(job, job.workingdir + '.stdout', follow, since, tail)
+
+    def get_stderrstream(self, job, follow=True, since=None, tail=None):
+        if not self._is_pooled(job):
+            return super().get_stderrstream(job, follow=follow, since=since, tail=tail)
+        return self._follow_file(job, job.workingdir + '.stderr', follow, since, tail)
+
+    def _follow_file(self, job, path, follow, since, tail):
+        """ Stream one of a pooled job's output files, using ``docker exec`` to read it (see
+        ``FOLLOW_SCRIPT``)
+        """
+        if since is not None:
+            raise NotImplementedError("Pooled jobs' output isn't timestamped, so it can't be "
+                                      "filtered with 'since'")
+        offset = 0 if tail is None else self._tail_offset(job, path, tail)
+        execinfo = self.client.exec_create(job.rundata.containerid,
+                                           ['sh', '-c', FOLLOW_SCRIPT.format(d=job.workingdir),
+                                            path, str(offset), 'follow' if follow else 'once'],
+                                           stderr=False)
+        return _iter_lines(self.client.exec_start(execinfo['Id'], stream=True))
+
+    def _tail_offset(self, job, path, tail):
+        """ Byte offset of the last ``tail`` lines of a file in the job's container
+        """
+        execinfo = self.client.exec_create(job.rundata.containerid,
+                                           ['sh', '-c',
+                                            'echo $(( $(wc -c < "$0") - $(tail -n $1 "$0" | '
+                                            'wc -c) ))', path, str(tail)],
+                                           stderr=False)
+        output = self.client.exec_start(execinfo['Id']).decode('utf-8').strip()
+        return int(output) if output.lstrip('-').isdigit() else 0
+
+    def _get_final_stds(self, job):
+        if not self._is_pooled(job):
+            return super()._get_final_stds(job)
+        docker_host = du.kwargs_from_client(self.client)
+        return (files.LazyDockerCopy(docker_host, job.rundata.containerid,
+                                     job.workingdir + '.stdout'),
+                files.LazyDockerCopy(docker_host, job.rundata.containerid,
+                                     job.workingdir + '.stderr'))
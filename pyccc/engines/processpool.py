@@ -0,0 +1,321 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import os
+import signal
+import sys
+import threading
+
+from .. import status, exceptions, asynchronous
+from ..python import PythonJob
+from .subproc import Subprocess
+
+__all__ = ['ProcessPool']
+
+
+class ProcessPool(Subprocess):
+    """ Runs PythonJobs in a pool of long-lived local worker processes.
+
+    Instead of starting a new interpreter for each job, the workers run each job's ``run_job.py``
+    in-process, in the job's own directory. Modules listed in ``preload`` are imported once
+    when each worker starts, so jobs that use them don't pay for the import. Function results,
+    exceptions, and updated objects are written to the same files as they are for a
+    :class:`Subprocess` job.
+
+    Jobs that aren't PythonJobs, or that request a different interpreter, are run as regular
+    subprocesses.
+
+    Note:
+        Workers are started with the "forkserver" method where it's available. Jobs share a
+        worker's interpreter state, so functions that monkeypatch modules or leak global state
+        can affect later jobs; use ``max_jobs_per_worker`` to recycle workers periodically.
+        Killing a running job terminates the worker that's running it; the pool starts a
+        new worker in its place.
+
+    Args:
+        max_workers (int): number of worker processes (default: number of CPUs)
+        preload (List[str]): modules to import in each worker when it starts
+        max_jobs_per_worker (int): replace each worker after it has run this many jobs
+        staging (Sequence[str]): see :class:`Subprocess`
+    """
+    def __init__(self, max_workers=None, preload=(), max_jobs_per_worker=None, staging=None):
+        super().__init__(staging=staging)
+        self.max_workers = max_workers
+        self.preload = list(preload)
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self._init_pool()
+
+    def _init_pool(self):
+        self._pool = None
+        self._futures = {}  # job id -> concurrent.futures.Future for the job's exit code
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """ The worker pool isn't pickled
+        """
+        state = self.__dict__.copy()
+        for key in ('_pool', '_futures', '_lock'):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_pool()
+
+    @property
+    def pool(self):
+        """ multiprocessing.pool.Pool: the worker pool (started on first use)
+        """
+        with self._lock:
+            if self._pool is None:
+                import multiprocessing
+
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                else:
+                    context = multiprocessing.get_context()
+                self._pool = context.Pool(processes=self.max_workers,
+                                          initializer=_preload_modules,
+                                          initargs=(self.preload,),
+                                          maxtasksperchild=self.max_jobs_per_worker)
+            return self._pool
+
+    def shutdown(self, wait=True):
+        """ Stop the worker processes. A new pool will be started if more jobs are submitted.
+        """
+        from concurrent.futures import wait as wait_for_futures
+
+        with self._lock:
+            pool, self._pool = self._pool, None
+            futures = list(self._futures.values())
+        if pool is not None:
+            pool.close()
+            if wait:
+                # Pool.join would wait forever for the results of killed jobs
+                wait_for_futures(futures)
+                pool.terminate()
+                pool.join()
+
+    def get_engine_description(self, job):
+        if not self._is_pooled(job):
+            return super().get_engine_description(job)
+        return 'Local process pool job %s' % job.jobid
+
+    def _is_pooled(self, job):
+        return job.rundata.get('pooled', False)
+
+    def _future(self, job):
+        try:
+            return self._futures[job.jobid]
+        except KeyError:
+            raise exceptions.EngineError(job, 'Job %s is not running in this process pool' %
+                                         job.jobid)
+
+    @staticmethod
+    def _control_paths(job):
+        """ Returns:
+            Tuple[str, str]: paths of the files where the worker writes its PID when it starts
+               the job, and that marks the job as killed (next to the job's stdout)
+        """
+        controldir = os.path.dirname(job.rundata.stdoutpath)
+        return os.path.join(controldir, 'worker.pid'), os.path.join(controldir, 'killed')
+
+    def submit(self, job):
+        if not isinstance(job, PythonJob) or job.interpreter not in (
+                'python%d' % sys.version_info.major,
+                'python%d.%d' % sys.version_info[:2]):
+            return super().submit(job)
+
+        from concurrent.futures import Future
+
+        self._check_job(job)
+        self._stage_job(job)
+        env = {'PYTHONIOENCODING': 'utf-8'}
+        env.update(job.env)
+        job.jobid = os.path.basename(job.rundata.localdir)
+        job.rundata.pooled = True
+        future = self._futures[job.jobid] = Future()
+        pidpath, killedpath = self._control_paths(job)
+        lock = self._lock
+        self.pool.apply_async(_run_pooled_job,
+                              (job.rundata.localdir, job.rundata.stdoutpath,
+                               job.rundata.stderrpath, env, pidpath, killedpath),
+                              callback=lambda exitcode: _resolve(future, lock, result=exitcode),
+                              error_callback=lambda exc: _resolve(future, lock, exception=exc))
+        return job.jobid
+
+    def get_status(self, job):
+        if not self._is_pooled(job):
+            return super().get_status(job)
+
+        future = self._future(job)
+        if future.cancelled():
+            return status.KILLED
+        elif future.done():
+            if future.exception() is not None:
+                return status.ERROR
+            return status.FINISHED
+        elif os.path.exists(self._control_paths(job)[0]):
+            return status.RUNNING
+        else:
+            return status.QUEUED
+
+    def wait(self, job):
+        if not self._is_pooled(job):
+            return super().wait(job)
+
+        from concurrent.futures import CancelledError
+        try:
+            return self._future(job).result()
+        except CancelledError:
+            return None
+        except Exception as exc:
+            raise exceptions.EngineError(job, 'Worker process failed: %s' % exc)
+
+    def wait_async(self, job):
+        if not self._is_pooled(job):
+            return super().wait_async(job)
+
+        import asyncio
+        finished = asyncio.wrap_future(self._future(job))
+        finished.add_done_callback(lambda f: f.cancelled() or f.exception())  # see self.wait
+        return asynchronous.then(asyncio.wait([finished]), lambda _: self.wait(job))
+
+    def kill(self, job):
+        if not self._is_pooled(job):
+            return super().kill(job)
+
+        future = self._future(job)
+        with self._lock:  # so the pool can't resolve the future while we're killing the job
+            if future.done():
+                return
+
+            # The marker is written before checking for the PID file, and the worker writes the
+            # PID file before checking for the marker - so either the worker won't start the
+            # job, or we'll find the PID of the worker that's running it
+            pidpath, killedpath = self._control_paths(job)
+            with open(killedpath, 'w'):
+                pass
+            if os.path.exists(pidpath):
+                with open(pidpath) as pidfile:
+                    pid = int(pidfile.read())
+                try:
+                    os.kill(pid, signal.SIGTERM)  # the pool replaces the worker
+                except OSError:  # it already exited
+                    pass
+            if future.cancel():
+                future.set_running_or_notify_cancel()  # wakes up anything waiting on the future
+
+
+def _resolve(future, lock, result=None, exception=None):
+    """ Complete a job's future when the pool reports the result (unless it was killed). This
+    runs in the pool's result handler thread, so it must not raise.
+    """
+    with lock:
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+def _preload_modules(modules):
+    for modname in modules:
+        __import__(modname)
+
+
+def _run_pooled_job(workdir, stdoutpath, stderrpath, env, pidpath, killedpath):
+    """ Run a job's ``run_job.py`` in this worker process, as if it had been run with
+    ``python run_job.py`` in ``workdir``
+
+    The worker's PID is written to ``pidpath`` first, so that the job can be killed; the job
+    isn't run if it was killed before it started (i.e., ``killedpath`` exists).
+
+    Returns:
+        int: the job's exit code (None if it was killed before starting)
+    """
+    import io
+    import runpy
+    import traceback
+
+    with open(pidpath + '.tmp', 'w') as pidfile:
+        pidfile.write(str(os.getpid()))
+    os.rename(pidpath + '.tmp', pidpath)  # so the PID file is never seen half-written
+    if os.path.exists(killedpath):
+        return None
+
+    saved_cwd = os.getcwd()
+    saved_path = list(sys.path)
+    saved_environ = os.environ.copy()
+    saved_modules = set(sys.modules)
+    saved_fds = []
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for fd, path in ((1, stdoutpath), (2, stderrpath)):
+        saved_fds.append((fd, os.dup(fd)))
+        with io.open(path, 'ab') as outfile:
+            os.dup2(outfile.fileno(), fd)
+    sys.stdout = io.open(1, 'w', encoding='utf-8', closefd=False, buffering=1)
+    sys.stderr = io.open(2, 'w', encoding='utf-8', closefd=False, buffering=1)
+
+    try:
+        os.chdir(workdir)
+        sys.path.insert(0, workdir)
+        os.environ.update(env)
+        try:
+            runpy.run_path('run_job.py', run_name='__main__')
+        except SystemExit as exc:
+            if exc.code is None:
+                exitcode = 0
+            elif isinstance(exc.code, int):
+                exitcode = exc.code
+            else:
+                print(exc.code, file=sys.stderr)
+                exitcode = 1
+        except BaseException:
+            traceback.print_exc()
+            exitcode = 1
+        else:
+            exitcode = 0
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        for fd, saved in saved_fds:
+            os.dup2(saved, fd)
+            os.close(saved)
+
+        os.chdir(saved_cwd)
+        sys.path[:] = saved_path
+        os.environ.clear()
+        os.environ.update(saved_environ)
+
+        # Forget the job's own modules (source.py and the placeholder modules created while
+        # unpickling), but keep any real packages it imported for use by later jobs
+        for modname in set(sys.modules) - saved_modules:
+            module = sys.modules[modname]
+            modfile = getattr(module, '__file__', None)
+            if (getattr(module, '__spec__', None) is None or
+                    (modfile and os.path.abspath(modfile).startswith(workdir))):
+                del sys.modules[modname]
+
+    return exitcode
@@ -0,0 +1,305 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+from past.builtins import basestring
+
+import io
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from .. import files, status
+from .base import EngineBase, EngineWrapper
+
+__all__ = ['ResultCache']
+
+ENTRY_FILE = 'entry.json'
+
+
+def _default_cache_dir():
+    cachehome = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cachehome, 'pyccc', 'results')
+
+
+class ResultCache(EngineWrapper):
+    """ Stores the results of finished jobs on disk, and reuses them for identical jobs instead of
+    running them again.
+
+    Jobs are identified by :meth:`pyccc.Job.fingerprint` (their image, command, environment,
+    working directory and input file contents). When a job with a cached fingerprint is
+    submitted, it's immediately marked as finished, and its outputs, stdout and stderr (and so
+    ``function_result``, for PythonJobs) are read from the cache; the underlying engine is
+    never contacted. Otherwise, the job runs normally, and its results are stored once it
+    finishes.
+
+    Only jobs that exit with code 0 are cached. Once the cache grows past ``max_bytes``, the
+    least recently used entries are evicted.
+
+    Args:
+        engine (pyccc.engines.EngineBase): engine to run jobs that aren't in the cache
+        path (str): cache directory (default: ``$XDG_CACHE_HOME/pyccc/results``)
+        max_bytes (int): maximum total size of the cached results (default: 1 GiB)
+    """
+    def __init__(self, engine, path=None, max_bytes=2**30):
+        super().__init__(engine)
+        self.path = path if path is not None else _default_cache_dir()
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _entrydir(self, fingerprint):
+        return os.path.join(self.path, fingerprint)
+
+    def lookup(self, fingerprint):
+        """ Get a cache entry, and mark it as recently used
+
+        Args:
+            fingerprint (str): job fingerprint
+
+        Returns:
+            dict: entry metadata, or None if there's no entry for this fingerprint
+        """
+        entryfile = os.path.join(self._entrydir(fingerprint), ENTRY_FILE)
+        try:
+            with io.open(entryfile, 'r', encoding='utf-8') as entrystream:
+                entry = json.load(entrystream)
+            os.utime(entryfile, None)
+        except (IOError, OSError, ValueError):
+            return None
+        entry['path'] = self._entrydir(fingerprint)
+        return entry
+
+    def lookup_metadata(self, fingerprint):
+        """ Get a cache entry without marking it as used
+
+        Returns:
+            dict: entry metadata (including its ``last_used`` time), or None if there's no entry
+        """
+        entryfile = os.path.join(self._entrydir(fingerprint), ENTRY_FILE)
+        try:
+            with io.open(entryfile, 'r', encoding='utf-8') as entrystream:
+                entry = json.load(entrystream)
+            entry['last_used'] = os.path.getmtime(entryfile)
+        except (IOError, OSError, ValueError):
+            return None
+        entry['fingerprint'] = fingerprint
+        return entry
+
+    def invalidate(self, job_or_fingerprint):
+        """ Remove a job's cached results, if present
+
+        Args:
+            job_or_fingerprint (pyccc.job.Job or str): the job, or its fingerprint
+        """
+        if isinstance(job_or_fingerprint, basestring):
+            fingerprint = job_or_fingerprint
+        else:  # once submitted, the engine may have filled in parts of the job (e.g., workingdir)
+            fingerprint = (job_or_fingerprint.rundata.get('fingerprint') or
+                           job_or_fingerprint.fingerprint())
+        shutil.rmtree(self._entrydir(fingerprint), ignore_errors=True)
+
+    def clear(self):
+        """ Remove all cached results
+        """
+        for name in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def prune(self, max_bytes=None):
+        """ Evict the least recently used entries until the cache is no larger than ``max_bytes``
+
+        Args:
+            max_bytes (int): target size (default: ``self.max_bytes``)
+
+        Returns:
+            List[str]: fingerprints of the evicted entries
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = []
+        for fingerprint in os.listdir(self.path):
+            entry = self.lookup_metadata(fingerprint)
+            if entry is not None:
+                entries.append(entry)
+        entries.sort(key=lambda entry: entry['last_used'])
+
+        total = sum(entry['bytes'] for entry in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_bytes:
+                break
+            self.invalidate(entry['fingerprint'])
+            total -= entry['bytes']
+            evicted.append(entry['fingerprint'])
+        return evicted
+
+    def _is_cached(self, job):
+        return job.rundata.get('cache_entry') is not None
+
+    def submit(self, job):
+        self._check_job(job)
+        fingerprint = job.rundata.fingerprint = job.fingerprint()
+        entry = self.lookup(fingerprint)
+        if entry is None:
+            return super().submit(job)
+        job.rundata.cache_entry = entry
+        job.jobid = 'cached:%s' % fingerprint
+
+    def get_status(self, job):
+        if self._is_cached(job):
+            return status.FINISHED
+        return self.engine.get_status(job)
+
+    def wait(self, job):
+        if self._is_cached(job):
+            return job.rundata.cache_entry['exitcode']
+        return self.engine.wait(job)
+
+    def kill(self, job):
+        if not self._is_cached(job):
+            return self.engine.kill(job)
+
+    def get_engine_description(self, job):
+        if self._is_cached(job):
+            return 'Cached result %s' % job.rundata.cache_entry['path']
+        return self.engine.get_engine_description(job)
+
+    def get_stdoutstream(self, job, **kwargs):
+        if self._is_cached(job):
+            return iter(self._cached_stds(job)[0])
+        return self.engine.get_stdoutstream(job, **kwargs)
+
+    def get_stderrstream(self, job, **kwargs):
+        if self._is_cached(job):
+            return iter(self._cached_stds(job)[1])
+        return self.engine.get_stderrstream(job, **kwargs)
+
+    def get_directory(self, job, path):
+        if not self._is_cached(job):
+            return self.engine.get_directory(job, path)
+        return files.LocalDirectoryReference(
+                os.path.join(job.rundata.cache_entry['path'], self._storage_path(job, path)))
+
+    def dump_all_outputs(self, job, target, abspaths=None, progress=None):
+        if self._is_cached(job):
+            return EngineBase.dump_all_outputs(self, job, target, abspaths, progress)
+        return self.engine.dump_all_outputs(job, target, abspaths, progress)
+
+    def _list_output_files(self, job):
+        if not self._is_cached(job):
+            return self.engine._list_output_files(job)
+        entry = job.rundata.cache_entry
+        return {path: files.LocalFile(os.path.join(entry['path'], self._storage_path(job, path)))
+                for path in entry['outputs']}
+
+    def _get_final_stds(self, job):
+        if self._is_cached(job):
+            return self._cached_stds(job)
+
+        stds = self.engine._get_final_stds(job)
+        # Job._ensure_finished lists the output files before asking for stdout and stderr, so
+        # everything we need to store is available now
+        if job.rundata.get('fingerprint') and job._output_files is not None:
+            try:
+                self._store(job, job._output_files, stds)
+            except Exception as exc:
+                logging.warning('Failed to cache results for job %s: %s' % (job.jobid, exc))
+        return stds
+
+    @staticmethod
+    def _cached_stds(job):
+        entrypath = job.rundata.cache_entry['path']
+        return (files.LocalFile(os.path.join(entrypath, 'stdout'), encoded_with='utf-8'),
+                files.LocalFile(os.path.join(entrypath, 'stderr'), encoded_with='utf-8'))
+
+    @staticmethod
+    def _storage_path(job, path):
+        """ Where an output path is stored within a cache entry
+        """
+        if os.path.isabs(path):
+            workingdir = (job.workingdir or '').rstrip('/')
+            if workingdir and (path == workingdir or path.startswith(workingdir + '/')):
+                return os.path.join('outputs', path[len(workingdir) + 1:])
+            return os.path.join('abspaths', path.lstrip('/'))
+        return os.path.join('outputs', path)
+
+    def _store(self, job, outputs, stds):
+        """ Write a finished job's results to a new cache entry. The entry is assembled in a
+        temporary directory, then moved into place, so that it's never seen half-written.
+
+        Results that are too big to cache are skipped without copying them all: first by their
+        sizes, where those are already known, then by stopping as soon as the copies go over.
+        """
+        exitcode = self.engine.wait(job)
+        if exitcode != 0:
+            return
+
+        refs = list(stds) + list(outputs.values())
+        if self.max_bytes is not None and sum(_known_size(ref) for ref in refs) > self.max_bytes:
+            return
+
+        fingerprint = job.rundata.fingerprint
+        tempdir = os.path.join(self.path, '.tmp-%s' % uuid.uuid4().hex)
+        os.mkdir(tempdir)
+        try:
+            targets = [(os.path.join(tempdir, name), std)
+                       for name, std in zip(('stdout', 'stderr'), stds)]
+            targets.extend((os.path.join(tempdir, self._storage_path(job, path)), ref)
+                           for path, ref in outputs.items())
+            nbytes = 0
+            for target, ref in targets:
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                if isinstance(ref, basestring):
+                    with io.open(target, 'w', encoding='utf-8') as outfile:
+                        outfile.write(ref)
+                else:
+                    ref.put(target)
+                nbytes += os.path.getsize(target)
+                if self.max_bytes is not None and nbytes > self.max_bytes:
+                    return
+
+            entry = {'exitcode': exitcode,
+                     'outputs': sorted(outputs),
+                     'bytes': nbytes,
+                     'created': time.time()}
+            with io.open(os.path.join(tempdir, ENTRY_FILE), 'w', encoding='utf-8') as entryfile:
+                entryfile.write(json.dumps(entry))
+
+            try:
+                os.rename(tempdir, self._entrydir(fingerprint))
+            except OSError:  # someone else cached this job first
+                return
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+        if self.max_bytes is not None:
+            self.prune()
+
+
+def _known_size(ref):
+    """ Size of a job's stdout, stderr or output file, if it's known without downloading it
+    (otherwise 0)
+    """
+    if isinstance(ref, basestring):
+        return len(ref.encode('utf-8'))
+    try:
+        return ref.size_bytes()
+    except (NotImplementedError, OSError, IOError):
+        return 0
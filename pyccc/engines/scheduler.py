@@ -0,0 +1,216 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import threading
+
+from .. import status, exceptions
+from .base import EngineWrapper
+
+__all__ = ['Scheduler']
+
+SUBMITTING = 'submitting'  # internal state: admitted, but engine.submit hasn't returned yet
+
+
+class Scheduler(EngineWrapper):
+    """ Holds jobs in a client-side queue, and only submits them to the underlying engine
+    when there's enough capacity to run them.
+
+    Each job occupies ``job.numcpus`` slots from the time it's submitted to the underlying
+    engine until it finishes. Queued jobs report the status ``Queued``. Jobs are admitted in order
+    of priority (set via ``engine_options={'priority': N}``, higher first), then in order of
+    submission. A job that needs more slots than the scheduler has will run by itself.
+
+    Args:
+        engine (pyccc.engines.EngineBase): engine to run the jobs
+        maxcpus (int): number of CPU slots available (default: the number of CPUs on this machine)
+        poll_interval (float): how often (in seconds) to check running jobs for completion
+    """
+    def __init__(self, engine, maxcpus=None, poll_interval=1.0):
+        super().__init__(engine)
+        if maxcpus is None:
+            maxcpus = multiprocessing.cpu_count()
+        self.maxcpus = maxcpus
+        self.poll_interval = poll_interval
+        self._init_queue()
+
+    def _init_queue(self):
+        self._queue = []  # heap of (-priority, submission order, job)
+        self._running = []
+        self._submitting = []
+        self._cpus_in_use = 0
+        self._counter = itertools.count()
+        self._lock = threading.Condition()
+        self._dispatcher = None
+
+    def __getstate__(self):
+        """ The queue and its threads aren't pickled
+        """
+        state = self.__dict__.copy()
+        for key in ('_queue', '_running', '_submitting', '_cpus_in_use', '_counter', '_lock',
+                    '_dispatcher'):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_queue()
+
+    @property
+    def cpus_in_use(self):
+        """ int: number of slots currently occupied by running (or starting) jobs
+        """
+        return self._cpus_in_use
+
+    @property
+    def queued_jobs(self):
+        """ List[pyccc.job.Job]: jobs waiting to be submitted, in the order they'll be admitted
+        """
+        with self._lock:
+            return [job for _, _, job in sorted(self._queue)]
+
+    def submit(self, job):
+        self._check_job(job)
+        priority = job.engine_options.get('priority', 0)
+        with self._lock:
+            job.rundata.scheduler_state = status.QUEUED
+            heapq.heappush(self._queue, (-priority, next(self._counter), job))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch)
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+        self._admit()
+
+    def get_status(self, job):
+        state = job.rundata.get('scheduler_state')
+        if state == SUBMITTING:
+            return status.QUEUED
+        elif state in (status.QUEUED, status.ERROR, status.KILLED):
+            return state
+        stat = self.engine.get_status(job)
+        if stat in status.DONE_STATES:
+            self._release(job)
+        return stat
+
+    def wait(self, job):
+        with self._lock:
+            while job.rundata.scheduler_state in (status.QUEUED, SUBMITTING):
+                self._lock.wait()
+        if job.rundata.scheduler_state == status.ERROR:
+            raise exceptions.EngineError(job, 'Failed to submit job: %s' %
+                                         job.rundata.scheduler_error)
+        elif job.rundata.scheduler_state == status.KILLED:
+            return None
+
+        returncode = self.engine.wait(job)
+        self._release(job)
+        return returncode
+
+    def kill(self, job):
+        with self._lock:
+            while job.rundata.scheduler_state == SUBMITTING:
+                self._lock.wait()
+            if job.rundata.scheduler_state == status.QUEUED:
+                self._queue = [entry for entry in self._queue if entry[2] is not job]
+                heapq.heapify(self._queue)
+                job.rundata.scheduler_state = status.KILLED
+                self._lock.notify_all()
+                return
+        self.engine.kill(job)
+        self._release(job)
+
+    def _admit(self):
+        """ Take jobs from the front of the queue until we run out of slots, and submit them.
+
+        The jobs are taken off the queue (and their slots reserved) with the lock held, but
+        they're submitted after releasing it, so that a slow submission doesn't hold up anything
+        else. Must be called without the lock held.
+        """
+        while True:
+            admitted = []
+            with self._lock:
+                while self._queue:
+                    job = self._queue[0][2]
+                    if ((self._running or self._submitting) and
+                            self._cpus_in_use + job.numcpus > self.maxcpus):
+                        break
+                    heapq.heappop(self._queue)
+                    job.rundata.scheduler_state = SUBMITTING
+                    self._submitting.append(job)
+                    self._cpus_in_use += job.numcpus
+                    admitted.append(job)
+            if not admitted:
+                return
+
+            failed = False
+            for job in admitted:
+                error = None
+                try:
+                    self.engine.submit(job)
+                except Exception as exc:
+                    error = exc
+                finally:
+                    job.engine = self
+
+                with self._lock:
+                    self._submitting.remove(job)
+                    if error is None:
+                        job.rundata.scheduler_state = status.RUNNING
+                        self._running.append(job)
+                    else:
+                        job.rundata.scheduler_state = status.ERROR
+                        job.rundata.scheduler_error = error
+                        self._cpus_in_use -= job.numcpus
+                        failed = True
+                    self._lock.notify_all()
+
+            if not failed:  # otherwise, the freed slots may let more jobs in
+                return
+
+    def _release(self, job):
+        """ Free the slots held by a finished job, and admit the next jobs in the queue
+        """
+        with self._lock:
+            if job not in self._running:
+                return
+            self._running.remove(job)
+            self._cpus_in_use -= job.numcpus
+        self._admit()
+
+    def _dispatch(self):
+        """ Background loop that watches running jobs, and releases their slots when they finish
+        """
+        while True:
+            with self._lock:
+                if not self._queue and not self._running and not self._submitting:
+                    self._dispatcher = None
+                    return
+                self._lock.wait(self.poll_interval)
+                running = list(self._running)
+
+            for job in running:
+                try:
+                    stat = self.engine.get_status(job)
+                except Exception as exc:
+                    logging.warning('Failed to get status for job %s: %s' % (job.jobid, exc))
+                    continue
+                if stat in status.DONE_STATES:
+                    self._release(job)
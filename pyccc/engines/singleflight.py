@@ -0,0 +1,169 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import threading
+
+from .. import status
+from .base import EngineWrapper
+
+__all__ = ['SingleFlight']
+
+
+class SingleFlight(EngineWrapper):
+    """ Runs identical jobs only once if they're submitted while the first one is still queued or
+    running.
+
+    When a job is submitted with the same fingerprint (see :meth:`pyccc.Job.fingerprint`) as a
+    job that hasn't finished yet, it isn't sent to the underlying engine. Instead, it's
+    attached to the running job (its "leader"), and reports the leader's status, exit code,
+    stdout, stderr and output files.
+
+    Jobs submitted after the leader has finished run normally (use
+    :class:`pyccc.engines.ResultCache` to reuse finished jobs).
+
+    Note:
+        Killing an attached job detaches it without affecting the leader. Killing the leader
+        stops it for every job attached to it.
+
+    Args:
+        engine (pyccc.engines.EngineBase): engine to run the jobs
+    """
+    def __init__(self, engine):
+        super().__init__(engine)
+        self._init_inflight()
+
+    def _init_inflight(self):
+        self._inflight = {}  # fingerprint -> leader job
+        self._submitting = set()  # fingerprints of leaders that are still being submitted
+        self._lock = threading.Condition()
+
+    def __getstate__(self):
+        """ In-flight jobs aren't pickled
+        """
+        state = self.__dict__.copy()
+        for key in ('_inflight', '_submitting', '_lock'):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_inflight()
+
+    @property
+    def inflight_jobs(self):
+        """ List[pyccc.job.Job]: jobs that new duplicate submissions will be attached to
+        """
+        with self._lock:
+            return list(self._inflight.values())
+
+    def submit(self, job):
+        """ Submit the job to the underlying engine, or attach it to an identical job that's
+        still running.
+
+        The lock is only held to look up and reserve fingerprints, not while talking to the
+        engine. Duplicates of a job that's still being submitted wait for its submission to
+        finish (and take its place if it fails).
+        """
+        self._check_job(job)
+        fingerprint = job.fingerprint()
+        while True:
+            with self._lock:
+                while fingerprint in self._submitting:
+                    self._lock.wait()
+                leader = self._inflight.get(fingerprint)
+                if leader is None:
+                    self._submitting.add(fingerprint)
+                    break
+
+            if self.engine.get_status(leader) not in status.DONE_STATES:
+                job.rundata.leader = leader
+                job.workingdir = leader.workingdir
+                job.jobid = leader.jobid
+                return
+            self._release(leader)
+
+        job.rundata.fingerprint = fingerprint
+        try:
+            self.engine.submit(job)
+        except Exception:
+            with self._lock:
+                self._submitting.discard(fingerprint)
+                self._lock.notify_all()
+            raise
+        job.engine = self
+        with self._lock:
+            self._inflight[fingerprint] = job
+            self._submitting.discard(fingerprint)
+            self._lock.notify_all()
+
+    def _runner(self, job):
+        """ The job that's actually running on the underlying engine
+        """
+        return job.rundata.get('leader', job)
+
+    def _release(self, job):
+        fingerprint = job.rundata.get('fingerprint')
+        with self._lock:
+            if self._inflight.get(fingerprint) is job:
+                del self._inflight[fingerprint]
+
+    def get_status(self, job):
+        if job.rundata.get('detached'):
+            return status.KILLED
+        stat = self.engine.get_status(self._runner(job))
+        if stat in status.DONE_STATES:
+            self._release(self._runner(job))
+        return stat
+
+    def wait(self, job):
+        if job.rundata.get('detached'):
+            return None
+        returncode = self.engine.wait(self._runner(job))
+        self._release(self._runner(job))
+        return returncode
+
+    def kill(self, job):
+        if 'leader' in job.rundata:
+            job.rundata.detached = True
+        else:
+            self.engine.kill(job)
+            self._release(job)
+
+    def get_engine_description(self, job):
+        return self.engine.get_engine_description(self._runner(job))
+
+    def get_stdoutstream(self, job, **kwargs):
+        return self.engine.get_stdoutstream(self._runner(job), **kwargs)
+
+    def get_stderrstream(self, job, **kwargs):
+        return self.engine.get_stderrstream(self._runner(job), **kwargs)
+
+    def get_outputstream(self, job):
+        return self.engine.get_outputstream(self._runner(job))
+
+    def get_directory(self, job, path):
+        return self.engine.get_directory(self._runner(job), path)
+
+    def dump_all_outputs(self, job, target, abspaths=None, progress=None):
+        return self.engine.dump_all_outputs(self._runner(job), target, abspaths, progress)
+
+    def _list_output_files(self, job):
+        return self.engine._list_output_files(self._runner(job))
+
+    def _get_final_stds(self, job):
+        return self.engine._get_final_stds(self._runner(job))
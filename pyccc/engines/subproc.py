@@ -17,24 +17,49 @@ standard_library.install_aliases()
 from future.builtins import *
 
 import os
+import shutil
 import subprocess
 import locale
+import time
 
-from pyccc import utils as utils, files, exceptions
+from pyccc import utils as utils, files, exceptions, asynchronous
 from . import EngineBase, status
 
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    from scandir import scandir
+
 
 class Subprocess(EngineBase):
     """Just runs a job locally in a subprocess.
-    For now, don't return anything until job completes"""
+
+    The job's stdout and stderr are written directly to files (outside of the job's working
+    directory), so they can't fill up a pipe buffer, and can be followed while the job runs via
+    ``job.get_stdout_stream()`` and ``job.get_stderr_stream()``.
+
+    Args:
+        staging (Sequence[str]): methods to try, in order, when staging local input files and
+            directories into the job's directory (see :func:`pyccc.files.stage_file`). By default,
+            files are reflinked or copied in-kernel where possible. Read-only files can also be
+            hard-linked or symlinked by asking for ``'hardlink'`` or ``'symlink'``, but then the
+            job can modify the originals if it makes them writable.
+    """
 
     hostname = 'local'
     USES_IMAGES = False
     ABSPATHS = False
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    TAIL_INTERVAL = 0.1
+    """float: how often (in seconds) live output streams check for new output"""
+
+    def __init__(self, staging=None):
+        super().__init__()
         self.term_encoding = locale.getpreferredencoding()
+        self.staging = utils.if_not_none(staging, files.DEFAULT_STAGING)
+        for method in self.staging:
+            if method not in files.STAGING_METHODS:
+                raise ValueError('Unknown staging method "%s"' % method)
 
     def get_status(self, job):
         if job.rundata.subproc.poll() is None:
@@ -64,26 +89,59 @@ class Subprocess(EngineBase):
 
     def submit(self, job):
         self._check_job(job)
+        subenv = self._stage_job(job)
+
+        with open(job.rundata.stdoutpath, 'wb') as stdout, \
+                open(job.rundata.stderrpath, 'wb') as stderr:
+            job.rundata.subproc = subprocess.Popen(job.command,
+                                                   shell=True,
+                                                   cwd=job.rundata.localdir,
+                                                   stdout=stdout,
+                                                   stderr=stderr,
+                                                   env=subenv)
+        job.jobid = job.rundata.subproc.pid
+        return job.rundata.subproc.pid
+
+    def _stage_job(self, job):
+        """ Create the job's directory and stage its inputs, and choose paths for its stdout and
+        stderr
+
+        Returns:
+            dict: environment variables for the job
+        """
         job.rundata.localdir = utils.make_local_temp_dir()
 
         assert os.path.isabs(job.rundata.localdir)
         if job.inputs:
             for filename, f in job.inputs.items():
                 targetpath = self._check_file_is_under_workingdir(filename, job.rundata.localdir)
-                f.put(targetpath)
+                self._stage_input(f, targetpath)
+        job.rundata.input_manifest = {path: self._file_signature(stat)
+                                      for path, stat in self._scan_files(job.rundata.localdir)}
 
         subenv = os.environ.copy()
         subenv['PYTHONIOENCODING'] = 'utf-8'
         if job.env:
             subenv.update(job.env)
-        job.rundata.subproc = subprocess.Popen(job.command,
-                                               shell=True,
-                                               cwd=job.rundata.localdir,
-                                               stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE,
-                                               env=subenv)
-        job.jobid = job.rundata.subproc.pid
-        return job.rundata.subproc.pid
+
+        stdsdir = utils.make_local_temp_dir()
+        job.rundata.stdoutpath = os.path.join(stdsdir, 'stdout')
+        job.rundata.stderrpath = os.path.join(stdsdir, 'stderr')
+        return subenv
+
+    def _stage_input(self, fileref, targetpath):
+        """ Stage a local file or directory without copying it, if possible; other file
+        references are just written to the target path
+        """
+        localpath = getattr(fileref, 'localpath', None)
+        if isinstance(fileref, files.LocalDirectoryReference):
+            files.stage_directory(localpath, files.get_target_path(targetpath, localpath),
+                                  self.staging)
+        elif localpath is not None and os.path.isfile(localpath):
+            files.stage_file(localpath, files.get_target_path(targetpath, localpath),
+                             self.staging)
+        else:
+            fileref.put(targetpath)
 
     @staticmethod
     def _check_file_is_under_workingdir(filename, wdir):
@@ -106,21 +164,151 @@ class Subprocess(EngineBase):
     def wait(self, job):
         return job.rundata.subproc.wait()
 
+    def wait_async(self, job):
+        """ Wait for the job's process without blocking a thread: the event loop watches a
+        pidfd for the process (on Linux 5.3+ with Python 3.9+; otherwise, falls back to waiting in
+        a thread)
+        """
+        import asyncio
+
+        process = job.rundata.subproc
+        if process.poll() is not None:
+            return asynchronous.completed(process.returncode)
+
+        try:
+            pidfd = os.pidfd_open(process.pid)
+        except (AttributeError, OSError):  # not supported, or the process just exited
+            return super().wait_async(job)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def _on_exit():
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+            if not future.cancelled():
+                future.set_result(process.wait())
+
+        try:
+            loop.add_reader(pidfd, _on_exit)
+        except NotImplementedError:  # e.g., event loops that can't watch file descriptors
+            os.close(pidfd)
+            return super().wait_async(job)
+        return future
+
     def get_directory(self, job, path):
         targetpath = self._check_file_is_under_workingdir(path, job.rundata.localdir)
         return files.LocalDirectoryReference(targetpath)
 
     def _list_output_files(self, job, dirpath=None):
-        from pathlib import Path
+        """ List files that were created or modified by the job.
+
+        Input files are only included if their size, modification time or inode changed since
+        they were staged, and only files that match the job's declared ``outputs`` are included.
+        """
         if dirpath is None:
             dirpath = job.rundata.localdir
-        filenames = {str(f.relative_to(dirpath)): files.LocalFile(str(f.absolute()))
-                     for f in Path(dirpath).glob('**/*')
-                     if f.is_file() and not f.is_symlink()}
+            manifest = job.rundata.get('input_manifest', {})
+        else:
+            manifest = {}
+
+        filenames = {}
+        for path, stat in self._scan_files(dirpath, stat_paths=manifest):
+            if not job.declares_output(path):
+                continue
+            if stat is not None and self._file_signature(stat) == manifest[path]:
+                continue
+            filenames[path] = files.LocalFile(os.path.join(os.path.abspath(dirpath), path),
+                                              check_exists=False)
         return filenames
 
+    @staticmethod
+    def _scan_files(dirpath, stat_paths=None):
+        """ Walk a directory tree, without following symlinks
+
+        Args:
+            dirpath (str): root of the tree
+            stat_paths (Container[str]): only stat the files at these paths (by default, all
+               files are stat'ed)
+
+        Yields:
+            Tuple[str, os.stat_result]: path of each regular file (relative to ``dirpath``) and
+               its stat result (or None if it's not in ``stat_paths``)
+        """
+        subdirs = ['']
+        while subdirs:
+            reldir = subdirs.pop()
+            for entry in scandir(os.path.join(dirpath, reldir)):
+                relpath = os.path.join(reldir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relpath)
+                elif entry.is_file(follow_symlinks=False):
+                    if stat_paths is None or relpath in stat_paths:
+                        yield relpath, entry.stat(follow_symlinks=False)
+                    else:
+                        yield relpath, None
+
+    @staticmethod
+    def _file_signature(stat):
+        return stat.st_size, stat.st_mtime, stat.st_ino
+
+    def get_stdoutstream(self, job):
+        """ Iterate over lines of the job's stdout as they are written
+
+        Returns:
+            Iterator[str]: lines of stdout; finishes once the job is done
+        """
+        return self._follow(job, job.rundata.stdoutpath)
+
+    def get_stderrstream(self, job):
+        """ Iterate over lines of the job's stderr as they are written
+
+        Returns:
+            Iterator[str]: lines of stderr; finishes once the job is done
+        """
+        return self._follow(job, job.rundata.stderrpath)
+
+    def _follow(self, job, path):
+        with open(path, 'rb') as stream:
+            partial = b''
+            while True:
+                line = stream.readline()
+                if line:
+                    partial += line
+                    if partial.endswith(b'\n'):
+                        yield partial.decode('utf-8')
+                        partial = b''
+                elif self.get_status(job) not in status.DONE_STATES:
+                    time.sleep(self.TAIL_INTERVAL)
+                else:
+                    partial += stream.read()
+                    for line in partial.splitlines(True):
+                        yield line.decode('utf-8')
+                    return
+
     def _get_final_stds(self, job):
-        strings = []
-        for fileobj in (job.rundata.subproc.stdout, job.rundata.subproc.stderr):
-            strings.append(fileobj.read().decode('utf-8'))
-        return strings
+        """ Move the job's stdout and stderr into the file cache, and remove the temporary
+        directory they were written to
+        """
+        cache = files.get_file_cache()
+        moved = 'stdsdigests' in job.rundata  # already called for this job (e.g., by a duplicate)
+        if not moved:
+            stdsdir = os.path.dirname(job.rundata.stdoutpath)
+            digests = []
+            for name in ('stdout', 'stderr'):
+                with open(job.rundata[name + 'path'], 'rb') as infile, \
+                        cache.tempfile(mode='wb') as tmp:
+                    shutil.copyfileobj(infile, tmp)
+                digests.append(cache.add(tmp.name, pin=True))
+            job.rundata.stdsdigests = digests
+
+        stds = []
+        for name, digest in zip(('stdout', 'stderr'), job.rundata.stdsdigests):
+            ref = files.CachedFile.from_cache(digest, '%s of %s' % (name, job.command),
+                                              'Local subprocess', encoded_with='utf-8',
+                                              pinned=not moved)
+            job.rundata[name + 'path'] = ref.localpath  # for streams opened after this
+            stds.append(ref)
+        if not moved:
+            shutil.rmtree(stdsdir, ignore_errors=True)
+        return tuple(stds)
@@ -0,0 +1,153 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import collections
+import logging
+import threading
+import time
+from concurrent import futures
+
+from .python import PythonCall
+
+__all__ = ['Executor']
+
+
+class Executor(futures.Executor):
+    """ Runs python function calls as pyccc jobs, through the standard
+    :class:`concurrent.futures.Executor` interface.
+
+    Each call to :meth:`submit` creates a :class:`pyccc.PythonJob`, and returns a regular
+    :class:`concurrent.futures.Future` for its result (the job itself is available as
+    ``future.job`` once it has been submitted). ``map`` and ``concurrent.futures.as_completed``
+    work as usual.
+
+    Jobs are submitted and collected by a single background thread, which uses the engine's
+    ``wait_any`` to find out when jobs finish - there isn't a thread per job.
+
+    Examples:
+        >>> with pyccc.Executor(pyccc.Docker(), 'python:3.6-slim', max_workers=20) as executor:
+        ...     results = list(executor.map(my_function, inputs))
+
+    Args:
+        engine (pyccc.engines.EngineBase): engine to run the jobs
+        image (str): image to run the functions in (ignored by engines that don't use images)
+        max_workers (int): maximum number of jobs to run at once (default: no limit)
+        poll_interval (float): how often to check running jobs (engines that are notified when
+            jobs finish may check less often)
+        **job_kwargs: additional arguments for each job (e.g., ``interpreter``, ``numcpus``)
+    """
+    def __init__(self, engine, image=None, max_workers=None, poll_interval=1.0, **job_kwargs):
+        if max_workers is not None and max_workers <= 0:
+            raise ValueError('max_workers must be greater than 0')
+        self.engine = engine
+        self.image = image
+        self.max_workers = max_workers
+        self.poll_interval = poll_interval
+        self.job_kwargs = job_kwargs
+
+        self._pending = collections.deque()  # (future, PythonCall) waiting to be submitted
+        self._running = {}  # job -> future
+        self._lock = threading.Condition()
+        self._shutdown = False
+        self._monitor = None
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+            future = futures.Future()
+            self._pending.append((future, PythonCall(fn, *args, **kwargs)))
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._run_monitor,
+                                                 name='pyccc executor monitor')
+                self._monitor.daemon = True
+                self._monitor.start()
+            self._lock.notify_all()
+        return future
+
+    submit.__doc__ = futures.Executor.submit.__doc__
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        """ Stop accepting new calls.
+
+        Args:
+            wait (bool): block until all submitted calls have finished
+            cancel_futures (bool): cancel calls that haven't been submitted to the engine yet
+        """
+        with self._lock:
+            self._shutdown = True
+            if cancel_futures:
+                while self._pending:
+                    future, _ = self._pending.popleft()
+                    future.cancel()
+            monitor = self._monitor
+            self._lock.notify_all()
+        if wait and monitor is not None:
+            monitor.join()
+
+    def _run_monitor(self):
+        """ Background loop that submits pending calls when there's room, and resolves the
+        futures of finished jobs
+        """
+        while True:
+            with self._lock:
+                while not self._running and not self._pending:
+                    if self._shutdown:
+                        self._monitor = None
+                        return
+                    self._lock.wait()
+                calls = []
+                while self._pending and (self.max_workers is None or
+                                         len(self._running) + len(calls) < self.max_workers):
+                    calls.append(self._pending.popleft())
+
+            for future, call in calls:
+                self._launch(future, call)
+            if not self._running:
+                continue
+
+            try:
+                finished = self.engine.wait_any(list(self._running), timeout=self.poll_interval,
+                                                poll_interval=self.poll_interval)
+            except Exception as exc:
+                logging.warning('Failed to check job statuses: %s' % exc)
+                time.sleep(self.poll_interval)
+                continue
+            for job in finished:
+                self._resolve(job, self._running.pop(job))
+
+    def _launch(self, future, call):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            job = self.engine.launch(self.image, call, submit=False, **self.job_kwargs)
+            job.submit()
+        except Exception as exc:
+            future.set_exception(exc)
+            return
+        future.job = job
+        self._running[job] = future
+
+    @staticmethod
+    def _resolve(job, future):
+        try:
+            result = job.function_result
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
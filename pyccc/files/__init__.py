@@ -6,6 +6,7 @@ from future.builtins import *
 from .base import *
 from .bytecontainer import *
 from .stringcontainer import *
+from .cache import *
 from .localfiles import *
 from .remotefiles import *
 from .directory import *
@@ -30,6 +30,8 @@ ENCODING = sys.getdefaultencoding()
 if ENCODING == 'ascii':
     ENCODING = 'utf-8'
 
+BLOCKSIZE = 2**20
+
 
 def get_tempfile(**kwargs):
     if not os.path.exists(CACHEDIR):
@@ -98,6 +100,7 @@ class FileReferenceBase(object):
      * __iter__(): equivalent of iter(self.open())
      * read(mode, encoding): equivalent of self.open(mode, encoding).read()
      * put(filename): create a local copy of this file and return a reference to it
+     * digest(): hash of the file's contents
     """
     REMOTE = False
 
@@ -139,6 +142,19 @@ class FileReferenceBase(object):
         """
         return self.open(mode=mode, encoding=encoding).read()
 
+    def digest(self):
+        """ Compute a hash of this file's contents
+
+        Returns:
+            str: hex-encoded sha256 digest of the file's bytes
+        """
+        import hashlib
+        hasher = hashlib.sha256()
+        with self.open('rb') as infile:
+            for chunk in iter(lambda: infile.read(BLOCKSIZE), b''):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
     def cache(self):
         """ Create a locally cached copy of this file and return a reference to it
 
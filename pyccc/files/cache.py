@@ -0,0 +1,224 @@
+# Copyright 2016-2018 Autodesk Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import print_function, unicode_literals, absolute_import, division
+from future import standard_library
+standard_library.install_aliases()
+from future.builtins import *
+
+import collections
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from .base import CACHEDIR, BLOCKSIZE
+
+__all__ = ['FileCache', 'get_file_cache']
+
+DEFAULT_CACHE_MAX_BYTES = 2**32
+
+
+class FileCache(object):
+    """ A size-capped, content-addressed store for local copies of remote files.
+
+    Files are stored under ``objects/`` by the sha256 digest of their contents, so identical
+    content is only stored once. An index (under ``index/``) maps source identifiers (e.g., a
+    file's location in a docker container) to digests, so that a file that was already
+    downloaded - in this session or an earlier one - doesn't need to be fetched again.
+
+    Once the cache grows past ``max_bytes``, the least recently used files are evicted. Files
+    that are pinned (i.e., referenced by a live :class:`pyccc.files.CachedFile` in this process)
+    are never evicted.
+
+    Args:
+        path (str): root directory of the cache
+        max_bytes (int): size budget for the cached files
+    """
+    def __init__(self, path=CACHEDIR, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._pins = collections.Counter()
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    def _dir(self, name):
+        path = os.path.join(self.path, name)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        return path
+
+    def object_path(self, digest):
+        """ Returns:
+            str: path where the file with this digest is (or would be) stored
+        """
+        return os.path.join(self._dir('objects'), digest[:2], digest)
+
+    def _index_path(self, source):
+        key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        return os.path.join(self._dir('index'), key)
+
+    def tempfile(self, **kwargs):
+        """ Create a temporary file on the same filesystem as the cache, to be added with
+        :meth:`add`
+
+        Returns:
+            tempfile.NamedTemporaryFile: open file handle (the file is not deleted on close)
+        """
+        return tempfile.NamedTemporaryFile(dir=self._dir('tmp'), delete=False, **kwargs)
+
+    def add(self, path, source=None, pin=False):
+        """ Move a file into the cache
+
+        Args:
+            path (str): file to add. It is moved (not copied) into the cache, so it should be on
+                the same filesystem (see :meth:`tempfile`)
+            source (str): identifier for where the file came from; if given, later calls to
+                :meth:`lookup` with this source will find it
+            pin (bool): pin the file (before the cache is pruned to make room for it)
+
+        Returns:
+            str: digest of the file's contents
+        """
+        hasher = hashlib.sha256()
+        with io.open(path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(BLOCKSIZE), b''):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+
+        target = self.object_path(digest)
+        try:
+            os.utime(target, None)
+        except OSError:  # not cached yet
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            size = os.path.getsize(path)
+            os.rename(path, target)
+            with self._lock:
+                if self._total_bytes is not None:
+                    self._total_bytes += size
+        else:  # we already have this content
+            os.unlink(path)
+
+        if pin:
+            self.pin(digest)
+        if source is not None:
+            self._write_index(source, digest)
+        if self._total_bytes is None or self._total_bytes > self.max_bytes:
+            self.prune()
+        return digest
+
+    def _write_index(self, source, digest):
+        indexpath = self._index_path(source)
+        with self.tempfile(mode='w') as indexfile:
+            indexfile.write(digest)
+        os.rename(indexfile.name, indexpath)  # atomically replaces any older entry
+
+    def lookup(self, source):
+        """ Find a previously cached copy of a file by its source
+
+        Args:
+            source (str): source identifier that was passed to :meth:`add`
+
+        Returns:
+            str: digest of the cached file, or None if it isn't in the cache
+        """
+        indexpath = self._index_path(source)
+        try:
+            with io.open(indexpath, 'r') as indexfile:
+                digest = indexfile.read().strip()
+            os.utime(self.object_path(digest), None)
+        except (IOError, OSError):  # not indexed, or evicted
+            return None
+        return digest
+
+    def pin(self, digest):
+        """ Protect a file from eviction (until it's unpinned as many times as it was pinned)
+        """
+        with self._lock:
+            self._pins[digest] += 1
+
+    def unpin(self, digest):
+        with self._lock:
+            self._pins[digest] -= 1
+            if self._pins[digest] <= 0:
+                del self._pins[digest]
+
+    def _scan(self):
+        """ Returns:
+            List[Tuple[float, int, str]]: (last used time, size, digest) for every cached file
+        """
+        objects = []
+        objdir = self._dir('objects')
+        for prefix in os.listdir(objdir):
+            subdir = os.path.join(objdir, prefix)
+            for digest in os.listdir(subdir):
+                try:
+                    stat = os.stat(os.path.join(subdir, digest))
+                except OSError:  # removed by another process
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, digest))
+        return objects
+
+    def size_bytes(self):
+        """ Returns:
+            int: total size of the cached files
+        """
+        return sum(size for _, size, _ in self._scan())
+
+    def prune(self, max_bytes=None):
+        """ Evict the least recently used (unpinned) files until the cache fits in ``max_bytes``
+
+        Args:
+            max_bytes (int): target size (default: ``self.max_bytes``)
+
+        Returns:
+            List[str]: digests of the evicted files
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        objects = sorted(self._scan())
+        total = sum(size for _, size, _ in objects)
+        evicted = []
+        with self._lock:
+            for _, size, digest in objects:
+                if total <= max_bytes:
+                    break
+                if digest in self._pins:
+                    continue
+                try:
+                    os.unlink(self.object_path(digest))
+                except OSError:
+                    pass
+                total -= size
+                evicted.append(digest)
+            self._total_bytes = total
+        return evicted
+
+
+_default_cache = None
+
+
+def get_file_cache():
+    """ Returns:
+        FileCache: the cache used for downloaded files (at ``pyccc.files.CACHEDIR``)
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FileCache()
+    return _default_cache
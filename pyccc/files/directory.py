@@ -15,8 +15,8 @@ import os
 import tarfile
 import shutil
 
-from .remotefiles import LazyDockerCopy
-from . import get_target_path
+from .remotefiles import LazyDockerCopy, _docker_cache_key
+from . import get_target_path, get_file_cache, LocalFile
 
 
 class DirectoryReference(object):
@@ -45,6 +45,24 @@ class LocalDirectoryReference(DirectoryReference):
         target = get_target_path(destination, self.localpath)
         shutil.copytree(self.localpath, target)
 
+    def digest(self):
+        """ Compute a hash of this directory's layout and file contents
+
+        Returns:
+            str: hex-encoded sha256 digest
+        """
+        import hashlib
+        hasher = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(self.localpath):
+            dirnames.sort()
+            relpath = os.path.relpath(dirpath, self.localpath)
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                hasher.update(os.path.join(relpath, filename).encode('utf-8'))
+                if os.path.isfile(path):
+                    hasher.update(LocalFile(path).digest().encode('ascii'))
+        return hasher.hexdigest()
+
 
 class DirectoryArchive(DirectoryReference):
     """A tar (or tar.gz) archive of a directory
@@ -73,26 +91,47 @@ class DirectoryArchive(DirectoryReference):
             https://stackoverflow.com/a/8261083/1958900
         """
         target = get_target_path(destination, self.dirname)
-        valid_paths = (self.dirname, './%s' % self.dirname)
+        with tarfile.open(self.archive_path, 'r|*') as tf:
+            self._extract_stream(tf, target)
 
-        with tarfile.open(self.archive_path, 'r:*') as tf:
-            members = []
-            for tarinfo in tf:
-                # Get only files under the directory `self.dirname`
-                pathsplit = os.path.normpath(tarinfo.path).split(os.sep)
-                if pathsplit[0] not in valid_paths:
-                    print('WARNING: skipped file "%s" in archive; not in directory "%s"' %
-                          (tarinfo.path, self.dirname))
-                    continue
-                if len(pathsplit) == 1:
-                    continue
-                tarinfo.name = os.path.join(*pathsplit[1:])
-                members.append(tarinfo)
-
-            if not members:
-                raise ValueError("No files under path directory '%s' in this tarfile")
-
-            tf.extractall(target, members)
+    def _extract_stream(self, tf, target):
+        """ Extract the directory's files from a tarfile, in a single pass (so ``tf`` can be
+        opened in streaming mode)
+        """
+        valid_paths = (self.dirname, './%s' % self.dirname)
+        directories = []
+        for tarinfo in tf:
+            # Get only files under the directory `self.dirname`
+            pathsplit = os.path.normpath(tarinfo.path).split(os.sep)
+            if pathsplit[0] not in valid_paths:
+                print('WARNING: skipped file "%s" in archive; not in directory "%s"' %
+                      (tarinfo.path, self.dirname))
+                continue
+            if len(pathsplit) == 1:
+                continue
+            tarinfo.name = os.path.join(*pathsplit[1:])
+            if tarinfo.isdir():
+                # like TarFile.extractall, set directory permissions after their contents exist
+                path = os.path.join(target, tarinfo.name)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, tarinfo.mode))
+            else:
+                tf.extract(tarinfo, target)
+
+        for path, mode in reversed(directories):
+            os.chmod(path, mode)
+
+        if not os.path.isdir(target):
+            raise ValueError("No files under path directory '%s' in this tarfile" % self.dirname)
+
+    def digest(self):
+        """ Compute a hash of the archive file
+
+        Returns:
+            str: hex-encoded sha256 digest
+        """
+        return LocalFile(self.archive_path).digest()
 
 
 class DockerArchive(DirectoryArchive, LazyDockerCopy):
@@ -111,19 +150,44 @@ class DockerArchive(DirectoryArchive, LazyDockerCopy):
     def put(self, destination):
         """ Copy the referenced directory to this path
 
+        If the archive hasn't been downloaded yet, it's extracted directly from the container
+        as it's streamed, without storing a local copy.
+
         Args:
             destination (str): path to put this directory (which must NOT already exist)
         """
-        if not self._fetched:
-            self._fetch()
-        DirectoryArchive.put(self, destination)
+        if self._fetched or (self._cache_key() is not None and
+                             get_file_cache().lookup(self._cache_key()) is not None):
+            self.download()
+            return DirectoryArchive.put(self, destination)
+
+        from .. import docker_utils as du
+        target = get_target_path(destination, self.dirname)
+        stream = self._get_tarstream()
+        try:
+            with tarfile.open(fileobj=du.IterStream(stream), mode='r|') as tf:
+                self._extract_stream(tf, target)
+        finally:
+            stream.close()
+
+    def digest(self):
+        self.download()
+        return DirectoryArchive.digest(self)
+
+    digest.__doc__ = DirectoryArchive.digest.__doc__
+
+    def _cache_key(self):
+        return _docker_cache_key('docker-archive', self.source, self.version)
 
-    put.__doc__ = DirectoryArchive.put.__doc__
+    def _set_cached(self, digest, pinned=False):
+        super()._set_cached(digest, pinned)
+        self.archive_path = self.localpath
 
     def _fetch(self):
-        self.archive_path = self._open_tmpfile()
+        self._open_tmpfile()
         stream = self._get_tarstream()
         for d in stream:
             self.tmpfile.write(d)
         stream.close()
         self.tmpfile.close()
+        self._cache_tmpfile(self._cache_key())
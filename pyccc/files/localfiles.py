@@ -21,7 +21,11 @@ import os
 import shutil
 import socket
 
-from . import BytesContainer, StringContainer, get_tempfile, get_target_path
+from . import BytesContainer, StringContainer, get_target_path, get_file_cache
+
+STAGING_METHODS = ('hardlink', 'symlink', 'reflink', 'copy_file_range', 'copy')
+DEFAULT_STAGING = ('reflink', 'copy_file_range', 'copy')
+FICLONE = 0x40049409  # from linux/fs.h
 
 
 class FileContainer(BytesContainer):
@@ -78,7 +82,7 @@ class LocalFile(FileContainer):
         target = get_target_path(filename, self.source)
         if encoding is not None:
             raise ValueError('Cannot encode as %s - this file is already encoded')
-        shutil.copy(self.localpath, target)
+        stage_file(self.localpath, target, methods=('reflink', 'copy_file_range', 'copy'))
         return LocalFile(target)
 
     def open(self, mode='r', encoding=None):
@@ -101,26 +105,218 @@ class LocalFile(FileContainer):
 
 class CachedFile(LocalFile):
     """
-    Store a copy of the file in a caching directory; delete it if this goes out of scope.
+    Store a copy of the file in the local file cache (see :class:`pyccc.files.FileCache`). The
+    cached copy is protected from eviction for as long as this object exists: each instance
+    (including copies) holds its own pin on it, and releases it when it's deleted.
     If pickled, the file gets slurped into memory.
     """
     def __init__(self, filecontainer):
         self.source = filecontainer.source
         self.sourcetype = filecontainer.sourcetype
-        self.localpath = self._open_tmpfile()
-        filecontainer.put(self.localpath)
+        self._open_tmpfile()
+        self.tmpfile.close()
+        filecontainer.put(self.tmpfile.name)
+        self._cache_tmpfile()
+
+    @classmethod
+    def from_cache(cls, digest, source, sourcetype, encoded_with=None, pinned=False):
+        """ Create a reference to a file that's already in the file cache
+
+        Args:
+            digest (str): digest of the cached file
+            source (str): where the file came from
+            sourcetype (str): description of the source
+            encoded_with (str): encoding of the file
+            pinned (bool): the caller already pinned the file, and hands the pin over to the new
+               reference
+        """
+        fileref = cls.__new__(cls)
+        fileref.source = source
+        fileref.sourcetype = sourcetype
+        fileref.encoded_with = encoded_with
+        fileref._set_cached(digest, pinned=pinned)
+        return fileref
 
     def _open_tmpfile(self, **kwargs):
         """
-        Open a temporary, unique file in CACHEDIR (/tmp/cyborgcache) by default.
+        Open a temporary, unique file in the file cache's directory.
         Leave it open, assign file handle to self.tmpfile
 
         **kwargs are passed to tempfile.NamedTemporaryFile
         """
-        self.tmpfile = get_tempfile(**kwargs)
+        self.tmpfile = get_file_cache().tempfile(**kwargs)
         path = self.tmpfile.name
         return path
 
+    def _cache_tmpfile(self, source=None):
+        """ Move the (closed) temporary file into the file cache, and point this reference at
+        the cached copy
+
+        Args:
+            source (str): index the cached file under this source identifier
+        """
+        self._set_cached(get_file_cache().add(self.tmpfile.name, source=source, pin=True),
+                         pinned=True)
+
+    def _set_cached(self, digest, pinned=False):
+        cache = get_file_cache()
+        if not pinned:
+            cache.pin(digest)
+        self._release_pin()
+        self._cached_digest = digest
+        self._pinned = True
+        self.localpath = cache.object_path(digest)
+
+    def _release_pin(self):
+        if getattr(self, '_pinned', False):
+            self._pinned = False
+            get_file_cache().unpin(self._cached_digest)
+
+    def __copy__(self):
+        fileref = self.__class__.__new__(self.__class__)
+        fileref.__setstate__(self.__getstate__())
+        return fileref
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_pinned', None)  # the pin belongs to this instance
+        state.pop('tmpfile', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if getattr(self, '_cached_digest', None) is not None:
+            get_file_cache().pin(self._cached_digest)
+            self._pinned = True
+
+    def __del__(self):
+        self._release_pin()
+
+    def digest(self):
+        if getattr(self, '_cached_digest', None) is not None:
+            return self._cached_digest
+        return super().digest()
+
+    digest.__doc__ = LocalFile.digest.__doc__
+
     def __str__(self):
         return 'Cached file from %s @ %s' % (self.source, self.localpath)
 
+
+
+def stage_file(source, target, methods=DEFAULT_STAGING):
+    """ Make the file at ``target`` match ``source``, using the cheapest method that works.
+
+    Methods are tried in the order given:
+     * ``hardlink``: hard link to the source (only if the source is read-only)
+     * ``symlink``: symbolic link to the source (only if the source is read-only)
+     * ``reflink``: copy-on-write clone, on filesystems that support it (btrfs, XFS, ...)
+     * ``copy_file_range``: in-kernel copy via ``os.copy_file_range`` or ``os.sendfile``
+     * ``copy``: regular copy
+
+    ``hardlink`` and ``symlink`` aren't used by default (see ``DEFAULT_STAGING``): the staged
+    file IS the source file, so a job that makes it writable (or writes to it as root) changes
+    the original.
+
+    Args:
+        source (str): path to an existing file
+        target (str): path to create (must not already exist)
+        methods (Sequence[str]): methods to try
+
+    Returns:
+        str: the method that was used
+
+    Raises:
+        OSError: if none of the methods worked
+    """
+    existed = os.path.lexists(target)
+    for method in methods:
+        try:
+            if _STAGERS[method](source, target):
+                return method
+        except (OSError, IOError):
+            if not existed and os.path.lexists(target):  # only clean up what we created
+                os.unlink(target)
+    raise OSError('Could not stage %s to %s using any of %s' % (source, target, methods))
+
+
+def stage_directory(source, target, methods=DEFAULT_STAGING):
+    """ Recreate the directory tree at ``source`` at path ``target``, staging each file with
+    :func:`stage_file`.
+
+    As with ``shutil.copytree``, symbolic links in the source tree are followed, and ``target``
+    must not already exist.
+    """
+    os.mkdir(target)
+    for dirpath, dirnames, filenames in os.walk(source, followlinks=True):
+        destdir = os.path.join(target, os.path.relpath(dirpath, source))
+        for dirname in dirnames:
+            os.mkdir(os.path.join(destdir, dirname))
+        for filename in filenames:
+            stage_file(os.path.realpath(os.path.join(dirpath, filename)),
+                       os.path.join(destdir, filename),
+                       methods)
+
+
+def _is_readonly(path):
+    import stat
+    return not os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _stage_hardlink(source, target):
+    if not _is_readonly(source):
+        return False
+    os.link(source, target)
+    return True
+
+
+def _stage_symlink(source, target):
+    if not _is_readonly(source):
+        return False
+    os.symlink(os.path.abspath(source), target)
+    return True
+
+
+def _stage_reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+        fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    shutil.copymode(source, target)
+    return True
+
+
+def _stage_copy_file_range(source, target):
+    copy = getattr(os, 'copy_file_range', None)
+    if copy is None:
+        copy = getattr(os, 'sendfile', None)
+        if copy is None:
+            return False
+
+    with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+        remaining = os.fstat(infile.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            if copy is os.sendfile:
+                ncopied = copy(outfile.fileno(), infile.fileno(), offset, remaining)
+            else:
+                ncopied = copy(infile.fileno(), outfile.fileno(), remaining)
+            if ncopied == 0:
+                break
+            offset += ncopied
+            remaining -= ncopied
+    if remaining > 0:  # e.g., the source shrank while we were copying it
+        raise OSError('Only copied %d of %d bytes from %s' % (offset, offset + remaining, source))
+    shutil.copymode(source, target)
+    return True
+
+
+def _stage_copy(source, target):
+    shutil.copy(source, target)
+    return True
+
+
+_STAGERS = {'hardlink': _stage_hardlink,
+            'symlink': _stage_symlink,
+            'reflink': _stage_reflink,
+            'copy_file_range': _stage_copy_file_range,
+            'copy': _stage_copy}
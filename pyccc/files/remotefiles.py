@@ -13,8 +13,6 @@
 # limitations under the License.
 from __future__ import print_function, unicode_literals, absolute_import, division
 
-import tempfile
-
 import requests
 from future import standard_library
 standard_library.install_aliases()
@@ -22,9 +20,13 @@ from future.builtins import *
 
 import os
 import io
+import posixpath
+import shutil
 import tarfile
+import threading
+import time
 
-from . import CachedFile
+from . import CachedFile, get_file_cache
 from .. import exceptions
 
 
@@ -63,9 +65,21 @@ class LazyFetcherBase(CachedFile):
 
     def download(self):
         if not self._fetched:
-            self._fetch()
+            digest = None
+            if self._cache_key() is not None:
+                digest = get_file_cache().lookup(self._cache_key())
+            if digest is not None:
+                self._set_cached(digest)
+            else:
+                self._fetch()
             self._fetched = True
 
+    def _cache_key(self):
+        """ Subclasses can return a string that uniquely identifies this file's (unchanging)
+        contents, so that copies of it can be found in the file cache without fetching it again
+        """
+        return None
+
     def _fetch(self):
         raise NotImplemented("_fetch needs to be implemented by subclass")
 
@@ -97,7 +111,7 @@ class HttpContainer(LazyFetcherBase):
         request = requests.get(self.source)
         self.tmpfile.write(request.content)
         self.tmpfile.close()
-        self.localpath = self.tmpfile.name
+        self._cache_tmpfile()  # not indexed by URL - the content at a URL can change
         self._fetched = True
 
 
@@ -105,61 +119,438 @@ class LazyDockerCopy(LazyFetcherBase):
     """
     Lazily copies the file from the worker.
     This is, of course, problematic if the worker is not accessible from the client.
+
+    Args:
+        dockerhost (dict): connection arguments for the docker client
+        containerid (str): container to copy the file from
+        containerpath (str): absolute path of the file in the container
+        store (DockerOutputStore): fetch the file as part of this bulk download, if possible
+        stats (TransferStats): record how long the download takes here
+        version (str): identifies the state of the container's filesystem (e.g., the time the
+           container finished). The file is only indexed in the file cache if this is given,
+           since files in a running container can still change.
     """
-    def __init__(self, dockerhost, containerid, containerpath):
-        self.source = "%s (%s)://%s" % (dockerhost, containerid, containerpath)
+    def __init__(self, dockerhost, containerid, containerpath, store=None, stats=None,
+                 version=None):
+        self.source = _docker_source(dockerhost, containerid, containerpath)
         self.sourcetype = 'Docker container'
         self.dockerhost = dockerhost
         self.containerpath = containerpath
         self.containerid = containerid
         self.basename = os.path.basename(containerpath)
+        self.store = store
+        self.stats = stats
+        self.version = version
         super(LazyDockerCopy, self).__init__()
 
+    def _cache_key(self):
+        return _docker_cache_key('docker-file', self.source, self.version)
+
+    def download_from(self, store):
+        """ Get the file from a bulk download, unless it's already been downloaded
+
+        Args:
+            store (DockerOutputStore): the bulk download
+
+        Returns:
+            bool: False if the file isn't available from the store (it still needs to be fetched)
+        """
+        if not self._fetched:
+            digest = store.claim(self.containerpath)
+            if digest is None:
+                return False
+            self._set_cached(digest, pinned=True)
+            self._fetched = True
+        return True
+
     def _fetch(self):
-        import shutil
+        if self.store is not None and self.download_from(self.store):
+            return
 
-        # extracts the stream into a disk-spooled file-like object
-        tarfile_path = os.path.basename(self.containerpath)
-        stream = self._get_tarstream()
-        try:
-            with tempfile.SpooledTemporaryFile() as buffer:
-                for d in stream:
-                    buffer.write(d)
-                buffer.seek(0)
-                tar = tarfile.open(fileobj=buffer)
-                filestream = tar.extractfile(tarfile_path)
-
-                if filestream is None:
-                    fileinfo = tar.getmember(tarfile_path)
-                    if fileinfo.type == tarfile.DIRTYPE:
-                        from future.utils import PY2
-                        if PY2:
-                            import errno
-                            raise OSError(self, errno=errno.EISDIR)
-                        else:
-                            raise IsADirectoryError(self)
+        # parses the tar stream as it arrives, writing the file straight into the cache
+        from .. import docker_utils as du
 
+        stream = _MeteredStream(self._get_tarstream, self.stats)
+        try:
+            with tarfile.open(fileobj=du.IterStream(stream), mode='r|') as tar:
+                fileinfo = tar.next()
+                if fileinfo is None:
+                    raise IOError('Empty archive for %s' % self)
+                if fileinfo.isdir():
+                    from future.utils import PY2
+                    if PY2:
+                        import errno
+                        raise OSError(self, errno=errno.EISDIR)
                     else:
-                        raise exceptions.NotARegularFileError(self)
+                        raise IsADirectoryError(self)
+                elif not fileinfo.isfile():
+                    raise exceptions.NotARegularFileError(self)
 
                 self._open_tmpfile()
                 try:
-                    shutil.copyfileobj(filestream, self.tmpfile)
+                    shutil.copyfileobj(tar.extractfile(fileinfo), self.tmpfile)
                 finally:
                     self.tmpfile.close()
 
         finally:
             stream.close()
 
-        self.localpath = self.tmpfile.name
+        self._cache_tmpfile(self._cache_key())
         self._fetched = True
 
     def _get_tarstream(self):
+        return _get_docker_tarstream(self.dockerhost, self.containerid, self.containerpath)
+
+
+class DockerOutputStore(object):
+    """ Downloads many files from a container with a few archive requests.
+
+    Each file is assigned to a directory that contains it. The first time any file is requested
+    (see :meth:`claim`), its whole directory is streamed from the container, and the requested
+    files in it are extracted into the file cache (see :class:`pyccc.files.FileCache`); anything
+    else in the archive is skipped. This is much faster than copying files one at a time when
+    there are many of them.
+
+    Args:
+        dockerhost (dict): connection arguments for the docker client
+        containerid (str): container to copy the files from
+        archives (Mapping[str, Iterable[str]]): maps the absolute path of each directory to
+           download to the absolute paths of the files to extract from it
+        stats (TransferStats): record how long each download takes here
+        version (str): index the extracted files in the file cache under this version of the
+           container's filesystem (see :class:`LazyDockerCopy`)
+    """
+    def __init__(self, dockerhost, containerid, archives, stats=None, version=None):
+        self.dockerhost = dockerhost
+        self.containerid = containerid
+        self.stats = stats
+        self.version = version
+        self._directories = {}  # file path -> directory to download it from
+        for directory, paths in archives.items():
+            for path in paths:
+                self._directories[path] = posixpath.normpath(directory)
+        self._digests = {}  # file path -> digest, for downloaded files that haven't been claimed
+        self._lock = threading.Lock()
+        self._directory_locks = {directory: threading.Lock()
+                                 for directory in set(self._directories.values())}
+        self._downloaded = set()
+
+    @property
+    def directories(self):
+        """ List[str]: directories that this store downloads
+        """
+        return sorted(set(self._directories.values()))
+
+    def __contains__(self, containerpath):
+        return containerpath in self._directories
+
+    def claim(self, containerpath):
+        """ Get a file from the store, downloading its directory if necessary.
+
+        The file stays pinned in the file cache; the caller becomes responsible for unpinning it.
+
+        Args:
+            containerpath (str): absolute path of the file in the container
+
+        Returns:
+            str: digest of the file in the file cache, or None if it's not available from the
+               store (e.g., because it isn't a regular file)
+        """
+        directory = self._directories.get(containerpath)
+        if directory is None:
+            return None
+        # different directories can be downloaded at the same time (e.g., by dump_all_outputs)
+        with self._directory_locks[directory]:
+            if directory not in self._downloaded:
+                digests = self._download(directory)
+                with self._lock:
+                    self._digests.update(digests)
+                self._downloaded.add(directory)
+        with self._lock:
+            return self._digests.pop(containerpath, None)
+
+    def _download(self, directory):
+        from .. import docker_utils as du
+
+        wanted = set(path for path, dirname in self._directories.items() if dirname == directory)
+        stream = _MeteredStream(lambda: _get_docker_tarstream(self.dockerhost, self.containerid,
+                                                              directory),
+                                self.stats)
+        try:
+            with tarfile.open(fileobj=du.IterStream(stream), mode='r|') as tar:
+                return self._extract_members(tar, posixpath.dirname(directory), wanted)
+        finally:
+            stream.close()
+
+    def _extract_members(self, tar, parent, wanted):
+        """ Copy the wanted files from a (streamed) tar archive into the file cache
+
+        Args:
+            tar (tarfile.TarFile): the archive
+            parent (str): directory that the paths in the archive are relative to
+            wanted (Set[str]): absolute paths of the files to extract
+
+        Returns:
+            Dict[str, str]: digest of each extracted file in the file cache (each is pinned)
+        """
+        cache = get_file_cache()
+        digests = {}
+        try:
+            for member in tar:
+                path = posixpath.join(parent, posixpath.normpath(member.name))
+                if path not in wanted or not member.isfile():
+                    continue
+                with cache.tempfile(mode='wb') as tmp:
+                    shutil.copyfileobj(tar.extractfile(member), tmp)
+                source = _docker_cache_key('docker-file', _docker_source(
+                        self.dockerhost, self.containerid, path), self.version)
+                digests[path] = cache.add(tmp.name, source=source, pin=True)
+        except Exception:
+            for digest in digests.values():
+                cache.unpin(digest)
+            raise
+        return digests
+
+    def __del__(self):
+        if getattr(self, '_digests', None):
+            cache = get_file_cache()
+            for digest in self._digests.values():
+                cache.unpin(digest)
+
+
+class DockerCompressedOutputStore(DockerOutputStore):
+    """ Downloads files from a compressed tar archive that the job wrote inside its container.
+
+    The archive is streamed from the container (with a single request, the first time any file is
+    requested) and decompressed as it arrives; the requested files are extracted into the file
+    cache. Files that aren't in the archive - or all of them, if the archive doesn't exist - are
+    reported as unavailable, so that they're copied one at a time instead.
+
+    The compressed size isn't known in advance, and the time to decompress it would skew the
+    estimates, so these downloads aren't recorded in a :class:`TransferStats`.
+
+    Args:
+        dockerhost (dict): connection arguments for the docker client
+        containerid (str): container to copy the files from
+        archivepath (str): absolute path of the compressed archive in the container
+        root (str): directory that the paths in the archive are relative to
+        paths (Iterable[str]): absolute paths of the files to extract from it
+        compression (str): how the archive is compressed (``'gz'`` or ``'xz'``)
+        version (str): see :class:`DockerOutputStore`
+    """
+    def __init__(self, dockerhost, containerid, archivepath, root, paths, compression='gz',
+                 version=None):
+        super(DockerCompressedOutputStore, self).__init__(dockerhost, containerid,
+                                                          {archivepath: paths}, version=version)
+        self.root = root
+        self.compression = compression
+
+    def _download(self, archivepath):
+        import docker.errors
+        from .. import docker_utils as du
+
+        wanted = set(path for path, dirname in self._directories.items()
+                     if dirname == archivepath)
+        try:
+            stream = _get_docker_tarstream(self.dockerhost, self.containerid, archivepath)
+        except docker.errors.NotFound:  # the image couldn't create the archive
+            return {}
+
+        try:
+            with tarfile.open(fileobj=du.IterStream(stream), mode='r|') as outer:
+                member = outer.next()
+                if member is None or not member.isfile():
+                    return {}
+                with tarfile.open(fileobj=outer.extractfile(member),
+                                  mode='r|%s' % self.compression) as tar:
+                    return self._extract_members(tar, self.root, wanted)
+        finally:
+            stream.close()
+
+
+class TransferStats(object):
+    """ Running estimates of the time it takes to download files from a docker daemon: a fixed
+    latency for each request, plus the time to transfer the data at a given throughput.
+
+    Each download is recorded with :meth:`record`. Both parameters are fit together, as the
+    intercept and slope of an exponentially weighted least-squares line through the measured
+    (bytes, time) pairs. The initial estimates are included as two lightly weighted
+    pseudo-measurements, which fade out like any other measurement; while the measured downloads
+    are all about the same size, only the latency is refit.
+
+    Args:
+        latency (float): initial estimate of the time to make a request (in seconds)
+        throughput (float): initial estimate of the transfer rate (in bytes per second)
+        weight (float): weight of each new measurement, relative to the ones before it
+    """
+    LOCAL_DEFAULTS = {'latency': 0.005, 'throughput': 2.0**29}
+    """dict: initial estimates for a daemon on a local socket"""
+
+    REMOTE_DEFAULTS = {'latency': 0.05, 'throughput': 2.0**23}
+    """dict: initial estimates for a daemon on a remote host"""
+
+    MAX_THROUGHPUT = 2.0**40
+    """float: throughput estimates are capped at this (in bytes per second)"""
+
+    PRIOR_WEIGHT = 0.1
+    """float: initial weight of each pseudo-measurement from the initial estimates (a
+    measurement's weight starts at 1)"""
+
+    def __init__(self, latency, throughput, weight=0.2):
+        self.latency = latency
+        self.throughput = throughput
+        self.weight = weight
+        self.num_requests = 0
+        # decayed moments of the measurements, starting with a request with no data and one
+        # that takes twice as long as that (sizes are in MiB)
+        size = latency * throughput / 2.0**20
+        self._sums = self._moments([(0.0, latency), (size, 2.0 * latency)], self.PRIOR_WEIGHT)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _moments(points, weight):
+        """ Returns:
+            List[float]: weighted sums of 1, x, y, x*x and x*y over (x, y) points
+        """
+        return [weight * sum(term) for term in zip(*[(1.0, x, y, x*x, x*y) for x, y in points])]
+
+    @classmethod
+    def for_client(cls, client):
+        """ Create estimates with defaults appropriate for the daemon that a client connects to
+
+        Args:
+            client (docker.APIClient): client for the daemon
+        """
         from .. import docker_utils as du
-        client = du.get_docker_apiclient(**self.dockerhost)
-        args = (self.containerid, self.containerpath)
-        if hasattr(client, 'get_archive'):  # handle different docker-py versions
-            request, meta = client.get_archive(*args)
+        if du.is_local_client(client):
+            return cls(**cls.LOCAL_DEFAULTS)
+        else:
+            return cls(**cls.REMOTE_DEFAULTS)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_lock')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<%s: %.1f ms/request, %.1f MB/s (%d requests)>' % (
+            type(self).__name__, 1000.0 * self.latency, self.throughput / 1e6, self.num_requests)
+
+    def estimate(self, num_requests, nbytes):
+        """ Estimate how long a set of downloads will take
+
+        Args:
+            num_requests (int): number of requests
+            nbytes (float): total bytes transferred
+
+        Returns:
+            float: estimated time in seconds
+        """
+        return num_requests * self.latency + nbytes / self.throughput
+
+    def record(self, nbytes, elapsed):
+        """ Refine the estimates with a measured download
+
+        Args:
+            nbytes (int): bytes that were transferred
+            elapsed (float): time (in seconds) from making the request until the transfer finished
+        """
+        with self._lock:
+            self.num_requests += 1
+            point = self._moments([(nbytes / 2.0**20, elapsed)], 1.0)
+            self._sums = [(1.0 - self.weight) * total + new
+                          for total, new in zip(self._sums, point)]
+            w, x, y, xx, xy = self._sums
+            spread = w * xx - x * x
+            if spread > 1e-6 * w * xx:
+                slope = (w * xy - x * y) / spread
+                slope = max(slope, 2.0**20 / self.MAX_THROUGHPUT)  # noise can make it negative
+            else:  # every download was the same size, which says nothing about the throughput
+                slope = 2.0**20 / self.throughput
+            self.latency = max((y - slope * x) / w, 0.0)
+            self.throughput = 2.0**20 / slope
+
+
+class _MeteredStream(object):
+    """ Iterates over the chunks of a streamed download, and records its size and duration in a
+    :class:`TransferStats` when it's closed.
+
+    The duration only includes the time spent waiting for the daemon (making the request, and
+    waiting for each chunk), not the time the consumer spends processing the chunks. Only
+    complete downloads are recorded: when the stream is closed early, at most ``DRAIN_BYTES``
+    more are read to reach its end (e.g., the padding after the end of a tar archive).
+
+    Args:
+        request (callable): makes the request, returning the stream
+        stats (TransferStats): where to record the download (nothing's recorded if None)
+    """
+    DRAIN_BYTES = 2**16
+
+    def __init__(self, request, stats):
+        self.stats = stats
+        self.nbytes = 0
+        self.complete = False
+        start = time.time()
+        self._stream = request()
+        self.elapsed = time.time() - start
+        self._chunks = iter(self._stream)
+
+    def _next_chunk(self):
+        """ Returns:
+            bytes: the next chunk, or None at the end of the stream
+        """
+        start = time.time()
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.complete = True
+            chunk = None
         else:
-            request = client.copy(*args)
-        return request
+            self.nbytes += len(chunk)
+        self.elapsed += time.time() - start
+        return chunk
+
+    def __iter__(self):
+        chunk = self._next_chunk()
+        while chunk is not None:
+            yield chunk
+            chunk = self._next_chunk()
+
+    def close(self):
+        if self.stats is not None and not self.complete:
+            limit = self.nbytes + self.DRAIN_BYTES
+            try:
+                while not self.complete and self.nbytes <= limit:
+                    self._next_chunk()
+            except Exception:  # the download failed
+                pass
+        self._stream.close()
+        if self.stats is not None and self.complete:
+            self.stats.record(self.nbytes, self.elapsed)
+
+
+def _docker_source(dockerhost, containerid, containerpath):
+    return "%s (%s)://%s" % (dockerhost, containerid, containerpath)
+
+
+def _docker_cache_key(kind, source, version):
+    """ Key for a file from a container in the file cache's index (None if it shouldn't be indexed)
+    """
+    if version is None:
+        return None
+    return '%s %s @ %s' % (kind, source, version)
+
+
+def _get_docker_tarstream(dockerhost, containerid, containerpath):
+    from .. import docker_utils as du
+    client = du.get_shared_apiclient(**dockerhost)
+    args = (containerid, containerpath)
+    if hasattr(client, 'get_archive'):  # handle different docker-py versions
+        request, meta = client.get_archive(*args)
+    else:
+        request = client.copy(*args)
+    return request
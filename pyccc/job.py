@@ -22,11 +22,12 @@ from past.builtins import basestring
 
 import fnmatch
 import os
+import threading
 
 from mdtcollections import DotDict
 
 import pyccc
-from pyccc import files, status
+from pyccc import files, status, asynchronous
 from pyccc.utils import *
 
 
@@ -49,7 +50,7 @@ class EngineFunction(object):
 
     def __get__(self, obj, owner):
         func = getattr(obj.engine, self.name)
-        return lambda: func(obj)
+        return lambda *args, **kwargs: func(obj, *args, **kwargs)
 
 
 @exports
@@ -72,12 +73,17 @@ class Job(object):
         withdocker (bool): whether this job needs access to a docker daemon
         when_finished (callable): function that can be called as ``func(job)``; will be called
             locally once, when this job completes
-        numcpus (int): number of CPUs required (default:1)
+        numcpus (int): number of CPUs required (default:1); this is used by
+            :class:`pyccc.engines.Scheduler` to limit the number of concurrently running jobs
         runtime (int): kill job if the runtime exceeds this value (in seconds) (default: 1 hour)`
         engine_options (dict): additional engine-specific options
         workingdir (str): working directory in the execution environment (i.e., on the local
             system for a subprocess, or inside the container for a docker engine)
         env (Dict[str,str]): custom environment variables for the Job
+        outputs (List[str]): glob patterns (as used by :func:`fnmatch.fnmatch`) for the output
+            files that you need; paths are relative to the working directory unless absolute.
+            Other files the job creates are not listed or downloaded. By default, every file
+            that the job creates or changes is an output.
     """
     def __init__(self, engine=None,
                  image=None,
@@ -92,7 +98,8 @@ class Job(object):
                  when_finished=None,
                  workingdir=None,
                  engine_options=None,
-                 env=None):
+                 env=None,
+                 outputs=None):
 
         self.name = name
         self.engine = engine
@@ -102,6 +109,7 @@ class Job(object):
         self.workingdir = workingdir
         self.rundata = DotDict()
         self.env = if_not_none(env, {})
+        self.outputs = list(outputs) if outputs is not None else None
 
         self.inputs = if_not_none(inputs, {})
         if self.inputs:  # translate strings into file objects
@@ -117,6 +125,7 @@ class Job(object):
         self.runtime = runtime
         self.withdocker = withdocker
 
+        self._finish_lock = threading.RLock()
         self._reset()
 
         if submit and self.engine and self.image:
@@ -134,7 +143,7 @@ class Job(object):
 
     kill = EngineFunction('kill')
     get_stdout_stream = EngineFunction('get_stdoutstream')
-    get_stderr_stream = EngineFunction('get_stdoutstream')
+    get_stderr_stream = EngineFunction('get_stderrstream')
     get_engine_description = EngineFunction('get_engine_description')
     _get_final_stds = EngineFunction('_get_final_stds')
     _list_output_files = EngineFunction('_list_output_files')
@@ -156,8 +165,50 @@ class Job(object):
     def __getstate__(self):
         state = self.__dict__.copy()
         state.pop('subproc', None)
+        state.pop('_finish_lock', None)
         return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._finish_lock = threading.RLock()
+
+    def fingerprint(self):
+        """ Compute a hash of everything that determines this job's results: its image, command,
+        environment variables, working directory, and the contents of its inputs. (For
+        PythonJobs, the inputs include the pickled function call and its source code.)
+
+        Returns:
+            str: hex-encoded sha256 digest
+        """
+        import hashlib
+        import json
+
+        workingdir = self.workingdir
+        if workingdir is None:  # the engine will use its default
+            workingdir = getattr(self.engine, 'default_wdir', None)
+        spec = {'image': self.image,
+                'command': self.command,
+                'env': self.env,
+                'workingdir': workingdir,
+                'inputs': {path: ref.digest() for path, ref in self.inputs.items()}}
+        if self.outputs is not None:
+            spec['outputs'] = sorted(self.outputs)
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def declares_output(self, path):
+        """ Check whether a file should be treated as one of this job's outputs
+
+        Args:
+            path (str): path of the file (relative to the working directory, or absolute)
+
+        Returns:
+            bool: True if the path matches one of the job's ``outputs`` patterns (or if the job
+               doesn't declare any)
+        """
+        if self.outputs is None:
+            return True
+        return any(fnmatch.fnmatch(path, pattern) for pattern in self.outputs)
+
     def submit(self, wait=False, resubmit=False):
         """ Submit this job to the assigned engine.
 
@@ -168,15 +219,35 @@ class Job(object):
         Raises:
             ValueError: If the job has been previously submitted (and resubmit=False)
         """
+        self._check_resubmit(resubmit)
+        self.engine.submit(self)
+        self._submitted = True
+        if wait: self.wait()
+
+    def _check_resubmit(self, resubmit):
         if self._submitted:
             if resubmit:
                 self._reset()
             else:
                 raise ValueError('This job has already been submitted')
 
-        self.engine.submit(self)
+    def submit_async(self, resubmit=False):
+        """ Asynchronous version of :meth:`submit`
+
+        Args:
+            resubmit (bool): clear all job info and resubmit the job?
+
+        Returns:
+            asyncio.Future: completes once the job has been submitted
+
+        Raises:
+            ValueError: If the job has been previously submitted (and resubmit=False)
+        """
+        self._check_resubmit(resubmit)
+        return asynchronous.then(self.engine.submit_async(self), self._on_submitted)
+
+    def _on_submitted(self, _):
         self._submitted = True
-        if wait: self.wait()
 
     def wait(self):
         """Wait for job to finish"""
@@ -184,6 +255,21 @@ class Job(object):
         self._ensure_finished()
         return returncode
 
+    def wait_async(self):
+        """ Asynchronous version of :meth:`wait`
+
+        Returns:
+            asyncio.Future: the job's exit code, once it has finished and its outputs have
+               been listed
+        """
+        return asynchronous.then(self.engine.wait_async(self), self._finish_async)
+
+    def _finish_async(self, returncode):
+        if self._finished:
+            return returncode
+        return asynchronous.then(asynchronous.run_async(self.engine, self._ensure_finished),
+                                 lambda _: returncode)
+
     @property
     def exitcode(self):
         if not self._finished:
@@ -197,7 +283,7 @@ class Job(object):
         """
         if self._stopped:
             return self._stopped
-        elif self.jobid:
+        elif self.jobid or self._submitted:
             stat = self.engine.get_status(self)
             if stat in status.DONE_STATES:
                 self._stopped = stat
@@ -214,21 +300,25 @@ class Job(object):
         """
         To be called after job has finished.
         Retreives stdout, stderr, and list of available files
+        (thread-safe: engines may call this from their own threads, e.g., to run callbacks)
         :return:
         """
         if self._finished:
             return
-        stat = self.status
-        if stat not in status.DONE_STATES:
-            raise pyccc.JobStillRunning(self)
-        if stat != status.FINISHED:
-            raise pyccc.EngineError(self, 'Internal error while running job (status:%s)' %
-                                    stat)
-        self._output_files = self.engine._list_output_files(self)
-        self._final_stdout, self._final_stderr = self.engine._get_final_stds(self)
-        self._finished = True
-        if self.when_finished is not None:
-            self._callback_result = self.when_finished(self)
+        with self._finish_lock:
+            if self._finished:  # another thread finished it while we were waiting
+                return
+            stat = self.status
+            if stat not in status.DONE_STATES:
+                raise pyccc.JobStillRunning(self)
+            if stat != status.FINISHED:
+                raise pyccc.EngineError(self, 'Internal error while running job (status:%s)' %
+                                        stat)
+            self._output_files = self.engine._list_output_files(self)
+            self._final_stdout, self._final_stderr = self.engine._get_final_stds(self)
+            self._finished = True
+            if self.when_finished is not None:
+                self._callback_result = self.when_finished(self)
 
     @property
     def result(self):
@@ -241,13 +331,46 @@ class Job(object):
 
     @property
     def stdout(self):
-        self._ensure_finished()
-        return self._final_stdout
+        """ str: the job's standard output.
+
+        If the engine stored the output in a file, it is read each time this is accessed; use
+        :attr:`stdout_file` to access it without loading the whole thing into memory.
+        """
+        return self._read_std(self.stdout_file)
 
     @property
     def stderr(self):
+        """ str: the job's standard error (see :attr:`stdout`)
+        """
+        return self._read_std(self.stderr_file)
+
+    @property
+    def stdout_file(self):
+        """ files.FileReferenceBase: reference to the job's standard output
+        """
+        self._ensure_finished()
+        return self._std_reference(self._final_stdout, 'stdout')
+
+    @property
+    def stderr_file(self):
+        """ files.FileReferenceBase: reference to the job's standard error
+        """
         self._ensure_finished()
-        return self._final_stderr
+        return self._std_reference(self._final_stderr, 'stderr')
+
+    @staticmethod
+    def _std_reference(std, name):
+        if std is None or isinstance(std, files.FileReferenceBase):
+            return std
+        else:
+            return files.StringContainer(std, name=name)
+
+    @staticmethod
+    def _read_std(fileref):
+        if fileref is None:
+            return None
+        else:
+            return fileref.read(encoding='utf-8')
 
     def get_output(self, filename=None):
         """
@@ -274,7 +397,8 @@ class Job(object):
         return self.engine.get_directory(self, path)
 
     def glob_output(self, pattern):
-        """ Return dict of all files that match the glob pattern
+        """ Return dict of all files that match the glob pattern (only files that match the
+        job's declared ``outputs``, if any, are included)
         """
         self._ensure_finished()
         filenames = self.get_output()
@@ -289,26 +413,31 @@ class Job(object):
         else:
             return 'Job "%s" launched. id:%s' % (self.name, self.jobid)
 
-    def dump_all_outputs(self, target, abspaths=None, exist_ok=False, update_references=True):
+    def dump_all_outputs(self, target, abspaths=None, exist_ok=False, update_references=True,
+                         progress=None):
         """ Dump all job outputs to a given directory
 
         Output files under the workign directory will be written to the same relative
         path under the directory target
 
         Depending on engine implementation, this is often faster than iterating through
-        all outputs and writing them one-by-one
+        all outputs and writing them one-by-one. Files that are already in the target directory
+        with the same contents are not written again, so an interrupted dump can be resumed
+        by calling this again with ``exist_ok=True``.
 
         Params:
             target (str): directory to write outputs to.
             abspaths (str): subdirectory under target to write
-            exist_ok (bool): raise exception if directory already exists
+            exist_ok (bool): if False, raise an exception if the directory already exists
             update_references (bool): update internal outputs to reference the dumped files,
                 rather than their original locations
+            progress (callable): called as ``progress(outputpath, completed, total)`` as each
+                output is written
         """
         self._ensure_finished()
         if not os.path.exists(target) or not exist_ok:
             os.mkdir(target)
-        self.engine.dump_all_outputs(self, target, abspaths)
+        self.engine.dump_all_outputs(self, target, abspaths, progress)
 
         if update_references:
             self.use_local_output_tree(target, abspaths)
@@ -42,6 +42,9 @@ __all__ = []
 PYTHON_JOB_FILE = LocalFile('%s/static/run_job.py' % pyccc.PACKAGE_PATH)
 DEFAULT_INTERPRETER = 'python%s' % sys.version_info.major
 PICKLE_PROTOCOL = 2  # required for 2/3 compatibile pickle objects
+RESULT_FILES = ('_function_return.pkl', '_object_state.pkl', '_batch_results.pkl',
+                'exception.pkl', 'traceback.txt')
+"""Tuple[str]: files that run_job.py writes the results to"""
 
 if sys.version_info.major == 2:
     PYVERSION = 2
@@ -70,6 +73,54 @@ class PythonCall(object):
                 self.is_instancemethod = True
 
 
+@exports
+class BatchPythonCall(PythonCall):
+    """ Calls a function once for each set of arguments in a list, all in the same job.
+
+    This avoids paying the fixed cost of starting a job (provisioning, container and interpreter
+    startup) for every call when there are many small ones. The calls run one after another in
+    a single interpreter; an exception raised by one call doesn't stop the others.
+
+    Examples:
+        >>> call = pyccc.BatchPythonCall(pow, [(2, 3), (4, 5)])
+        >>> job = engine.launch(image, call)
+        >>> job.function_result
+        [8, 1024]
+
+    Args:
+        function (callable): function to call
+        arglist (Iterable[tuple]): positional arguments for each call
+        **kwargs: keyword arguments to pass to every call
+    """
+    def __init__(self, function, arglist, **kwargs):
+        super().__init__(function, **kwargs)
+        self.batch_args = [tuple(args) for args in arglist]
+
+    @classmethod
+    def chunked(cls, function, arglist, batch_size, **kwargs):
+        """ Split a (possibly very long) iterable of arguments into batches
+
+        Args:
+            function (callable): function to call
+            arglist (Iterable[tuple]): positional arguments for each call
+            batch_size (int): maximum number of calls in each batch
+            **kwargs: keyword arguments to pass to every call
+
+        Yields:
+            BatchPythonCall: batches of calls, in order
+        """
+        import itertools
+
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1')
+        arglist = iter(arglist)
+        while True:
+            batch = list(itertools.islice(arglist, batch_size))
+            if not batch:
+                return
+            yield cls(function, batch, **kwargs)
+
+
 @exports
 class PythonJob(job.Job):
 
@@ -84,6 +135,8 @@ class PythonJob(job.Job):
         self._traceback = None
         self.sendsource = sendsource
         self._function_result = None
+        self._batch_exceptions = None
+        self._batch_tracebacks = None
         self.interpreter = self._clean_interpreter_string(interpreter)
         self.persist_references = persist_references
 
@@ -99,6 +152,9 @@ class PythonJob(job.Job):
 
         command = '%s run_job.py' % self.interpreter
 
+        if kwargs.get('outputs') is not None:
+            kwargs['outputs'] = list(kwargs['outputs']) + list(RESULT_FILES)
+
         super(PythonJob, self).__init__(engine, image, command,
                                         **kwargs)
 
@@ -180,13 +236,25 @@ class PythonJob(job.Job):
         else:
             return self._callback_result
 
+    @property
+    def is_batch(self):
+        """ bool: whether this job runs a :class:`BatchPythonCall`
+        """
+        return getattr(self.function_call, 'batch_args', None) is not None
+
     @property
     def function_result(self):
-        """ The return value of the called python function
+        """ The return value of the called python function.
+
+        For a :class:`BatchPythonCall`, this is a list with one entry per call. Calls that raised
+        an exception have the exception object in their place (see :attr:`batch_exceptions`).
         """
         self._ensure_finished()
         if self._function_result is None:
             self.reraise_remote_exception(force=True)  # there's no result to return
+            if self.is_batch:
+                self._load_batch_results()
+                return self._function_result
             try:
                 returnval = self.get_output('_function_return.pkl')
             except KeyError:
@@ -199,6 +267,75 @@ class PythonJob(job.Job):
             self._function_result = loads(returnval.read('rb'))
         return self._function_result
 
+    def function_result_async(self):
+        """ Asynchronous version of :attr:`function_result`
+
+        Returns:
+            asyncio.Future: the return value of the called python function (or the exception
+               it raised)
+        """
+        from . import asynchronous
+        return asynchronous.then(
+                self.wait_async(),
+                lambda _: asynchronous.run_async(self.engine, getattr, self, 'function_result'))
+
+    @property
+    def batch_results(self):
+        """ List: return values for each call in a :class:`BatchPythonCall` (same as
+        :attr:`function_result`)
+        """
+        if not self.is_batch:
+            raise ValueError('This job did not run a BatchPythonCall')
+        return self.function_result
+
+    @property
+    def batch_exceptions(self):
+        """ Dict[int, Exception]: exceptions raised by individual calls in a
+        :class:`BatchPythonCall`, by index
+        """
+        _ = self.batch_results
+        return self._batch_exceptions
+
+    @property
+    def batch_tracebacks(self):
+        """ Dict[int, str]: remote tracebacks for the calls in :attr:`batch_exceptions`
+        """
+        _ = self.batch_results
+        return self._batch_tracebacks
+
+    def _load_batch_results(self):
+        import io
+
+        try:
+            resultfile = self.get_output('_batch_results.pkl')
+        except KeyError:
+            raise ProgramFailure(self)
+        if self.persist_references:
+            unpickler_class = picklers.ReturningUnpickler
+        else:
+            unpickler_class = pickle.Unpickler
+
+        numcalls = len(self.function_call.batch_args)
+        results = [None] * numcalls
+        found = set()
+        errors = {}
+        tracebacks = {}
+        stream = io.BytesIO(resultfile.read('rb'))
+        while stream.tell() < len(stream.getvalue()):
+            index, succeeded, value, traceback = unpickler_class(stream).load()
+            results[index] = value
+            found.add(index)
+            if not succeeded:
+                errors[index] = value
+                tracebacks[index] = traceback
+        if len(found) != numcalls:
+            raise ProgramFailure(self, 'Only %d of %d calls in the batch completed'
+                                 % (len(found), numcalls))
+
+        self._batch_exceptions = errors
+        self._batch_tracebacks = tracebacks
+        self._function_result = results
+
     @property
     def updated_object(self):
         """
@@ -268,6 +405,7 @@ class PackagedFunction(native.object):
             self.func_name = func.__name__
         self.args = function_call.args
         self.kwargs = function_call.kwargs
+        self.batch_args = getattr(function_call, 'batch_args', None)
         self.persist_references = persist_references
 
         globalvars = src.get_global_vars(func)
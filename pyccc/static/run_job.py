@@ -46,8 +46,11 @@ def main():
     os.environ['IS_PYCCC_JOB'] = '1'
     try:
         funcpkg, func = load_job()
-        result = funcpkg.run(func)
-        serialize_output(result, persistrefs=funcpkg.persist_references)
+        if getattr(funcpkg, 'batch_args', None) is not None:
+            run_batch(funcpkg, func)
+        else:
+            result = funcpkg.run(func)
+            serialize_output(result, persistrefs=funcpkg.persist_references)
 
         if funcpkg.is_imethod:
             with open('_object_state.pkl', 'wb') as ofp:
@@ -83,6 +86,45 @@ def serialize_output(result, persistrefs=False):
             pickle.dump(result, rp, PICKLE_PROTOCOL)
 
 
+def run_batch(funcpkg, func):
+    """ Call the function once for each item in the batch. Each item's result (or exception) is
+    appended to the results file as soon as it's available, as a pickled tuple
+    ``(index, succeeded, result_or_exception, traceback)``.
+    """
+    to_run = funcpkg.prepare_namespace(func)
+    with open('_batch_results.pkl', 'wb') as rp:
+        for index, args in enumerate(funcpkg.batch_args):
+            try:
+                record = (index, True, to_run(*args, **funcpkg.kwargs), None)
+            except Exception as exc:
+                record = (index, False, exc, tb.format_exc())
+            rp.write(dump_batch_record(record, funcpkg.persist_references))
+            rp.flush()
+
+
+def dump_batch_record(record, persistrefs):
+    import io
+
+    for attempt in range(3):
+        buff = io.BytesIO()
+        if persistrefs:
+            pickler = source.ReturningPickler(buff, PICKLE_PROTOCOL)
+        else:
+            pickler = pickle.Pickler(buff, PICKLE_PROTOCOL)
+        try:
+            pickler.dump(record)
+        except Exception as exc:
+            # report unpicklable results and exceptions as errors instead
+            index, succeeded, value, traceback = record
+            if succeeded:
+                record = (index, False, exc, tb.format_exc())
+            else:
+                record = (index, False, RuntimeError(repr(value)), traceback)
+        else:
+            return buff.getvalue()
+    raise RuntimeError('Failed to serialize the result of batch item %d' % record[0])
+
+
 def capture_exceptions(exc):
     with open('exception.pkl', 'wb') as excfile:
         pickle.dump(exc, excfile, protocol=PICKLE_PROTOCOL)
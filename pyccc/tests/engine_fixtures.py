@@ -1,7 +1,8 @@
 import pytest
 import pyccc
 
-__all__ = 'typedfixture fixture_types subprocess_engine local_docker_engine'.split()
+__all__ = ('typedfixture fixture_types subprocess_engine process_pool_engine '
+           'local_docker_engine').split()
 
 fixture_types = {}
 
@@ -27,6 +28,13 @@ def subprocess_engine():
     return pyccc.Subprocess()
 
 
+@typedfixture('engine')
+def process_pool_engine():
+    engine = pyccc.ProcessPool(max_workers=2)
+    yield engine
+    engine.shutdown()
+
+
 @typedfixture('engine')
 def local_docker_engine():
     return pyccc.Docker()
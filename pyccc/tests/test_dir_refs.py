@@ -114,3 +114,44 @@ def test_tar_archive_not_expanded(dir_archive):
     assert 'archive.tar' in files
     assert 'data' not in files
 
+
+
+def test_directory_digest(localdir, tmpdir):
+    tmpdir = str(tmpdir)
+    localdir.put(os.path.join(tmpdir, 'data'))
+    copied = pyccc.files.LocalDirectoryReference(os.path.join(tmpdir, 'data'))
+    assert copied.digest() == localdir.digest()
+
+    with open(os.path.join(tmpdir, 'data', 'a'), 'a') as afile:
+        afile.write('changed')
+    assert copied.digest() != localdir.digest()
+
+
+def test_docker_copies_are_extracted_from_the_stream(dir_archive, tmpdir, monkeypatch):
+    import subprocess
+    from pyccc.files import remotefiles
+
+    def fake_tarstream(dockerhost, containerid, containerpath):
+        if containerpath == '/test/data/a':
+            tarpath = str(tmpdir.join('a.tar'))
+            subprocess.check_call(['tar', 'cf', tarpath, 'a'], cwd=os.path.join(THISDIR, 'data'))
+        else:
+            tarpath = dir_archive.archive_path
+        with open(tarpath, 'rb') as tarfile:
+            data = tarfile.read()
+        return (data[i:i+512] for i in range(0, len(data), 512))
+
+    monkeypatch.setattr(remotefiles, '_get_docker_tarstream', fake_tarstream)
+    monkeypatch.setattr(pyccc.files.cache, '_default_cache',
+                        pyccc.files.FileCache(str(tmpdir.join('cache'))))
+
+    with open(os.path.join(THISDIR, 'data', 'a')) as afile:
+        assert pyccc.files.LazyDockerCopy({}, 'ctr', '/test/data/a').read() == afile.read()
+    with pytest.raises(IsADirectoryError):
+        pyccc.files.LazyDockerCopy({}, 'ctr', '/test/data').read()
+
+    archive = pyccc.files.DockerArchive({}, 'ctr', '/test/data')
+    archive.put(str(tmpdir.join('copy')))
+    assert not archive._fetched  # extracted without keeping a local copy of the archive
+    assert sorted(os.listdir(str(tmpdir.join('copy')))) == sorted(os.listdir(
+            os.path.join(THISDIR, 'data')))
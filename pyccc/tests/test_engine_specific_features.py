@@ -1,5 +1,8 @@
 import os
+import sys
+import time
 import pytest
+import pyccc
 from .engine_fixtures import subprocess_engine, local_docker_engine
 
 """
@@ -92,3 +95,1086 @@ def test_docker_socket_mount_withdocker_option(local_docker_engine):
     job.wait()
     running = job.stdout.strip().splitlines()
     assert job.jobid in running
+
+
+def test_docker_provisioned_image_is_reused():
+    engine = pyccc.Docker(staging='image')
+    inputs = {'a.txt': 'abc'}
+    job1 = engine.launch(image='alpine', command='cat a.txt', inputs=inputs)
+    job1.wait()
+    job2 = engine.launch(image='alpine', command='cat a.txt', inputs=inputs)
+    job2.wait()
+    assert job1.imageid == job2.imageid
+    assert job2.stdout.strip() == 'abc'
+
+    job3 = engine.launch(image='alpine', command='cat a.txt', inputs={'a.txt': 'def'})
+    job3.wait()
+    assert job3.imageid != job1.imageid
+    assert job3.stdout.strip() == 'def'
+
+
+def test_provisioned_image_cache_ignores_shared_layers():
+    from pyccc import docker_utils as du
+
+    GiB, MiB = 2**30, 2**20
+
+    class OldClient(object):
+        def images(self, name):
+            # 3 images built on the same 1 GiB base; the list doesn't report shared sizes
+            return [{'Id': 'img%d' % i, 'Created': 1000 + i, 'Size': GiB + 10 * MiB,
+                     'SharedSize': -1, 'RepoTags': ['%s:img%d' % (name, i)]}
+                    for i in range(3)]
+
+        def remove_image(self, tag):
+            pass
+
+    class FakeClient(OldClient):
+        def df(self):
+            return {'Images': [{'Id': 'img%d' % i, 'Size': GiB + 10 * MiB, 'SharedSize': GiB}
+                               for i in range(3)]}
+
+    client = FakeClient()
+    assert du.prune_provisioned_images(client, max_bytes=100 * MiB) == []
+    assert du.prune_provisioned_images(client, max_bytes=25 * MiB) == \
+        ['%s:img0' % du.PROVISIONED_IMAGE_REPO]
+
+    # without the disk usage summary, each image counts for its full size
+    assert len(du.prune_provisioned_images(OldClient(), max_bytes=2 * GiB)) == 2
+
+
+@pytest.mark.parametrize('staging', pyccc.Docker.STAGING_MODES)
+def test_docker_staging_modes(staging, tmpdir):
+    engine = pyccc.Docker(staging=staging)
+    job = engine.launch(image='alpine',
+                        command='cat a.txt sub/b.txt /opt/c.txt > out.txt',
+                        inputs={'a.txt': 'a', 'sub/b.txt': 'b', '/opt/c.txt': 'c'})
+    job.wait()
+    assert job.exitcode == 0
+    assert job.get_output('out.txt').read() == 'abc'
+    base_imageid = engine.client.inspect_image('alpine')['Id']
+    if staging == 'archive':
+        assert job.imageid == base_imageid
+    else:
+        assert job.imageid != base_imageid
+
+
+def test_docker_inputs_changed_in_place_are_outputs(local_docker_engine):
+    job = local_docker_engine.launch(image='alpine', command='echo more >> a.txt',
+                                     inputs={'a.txt': 'a\n', 'b.txt': 'b\n'})
+    job.wait()
+    assert job.get_output('a.txt').read() == 'a\nmore\n'
+    assert 'b.txt' not in job.get_output()
+
+
+def test_docker_staged_inputs_are_outputs_only_if_changed():
+    import base64
+    import json
+    import docker.errors
+
+    class FakeResponse(object):
+        def __init__(self, stat):
+            self.status_code = 200
+            self.headers = {'X-Docker-Container-Path-Stat':
+                            base64.b64encode(json.dumps(stat).encode('utf-8'))}
+
+        def raise_for_status(self):
+            pass
+
+    class FakeClient(object):
+        base_url = 'http+docker://localhost'
+        api_version = '1.35'
+        stats = {'/wdir/same': {'size': 3, 'mtime': '1970-01-01T01:00:10+01:00'},
+                 '/wdir/appended': {'size': 9, 'mtime': '2018-01-01T00:00:00Z'},
+                 '/wdir/touched': {'size': 3, 'mtime': '2018-01-01T00:00:00Z'}}
+
+        def head(self, url, params):
+            assert url == 'http+docker://localhost/v1.35/containers/ctr/archive'
+            return FakeResponse(self.stats[params['path']])
+
+    engine = pyccc.Docker.__new__(pyccc.Docker)
+    engine.client = FakeClient()
+    job = pyccc.Job(image='alpine', command='true', workingdir='/wdir')
+    job.rundata.containerid = 'ctr'
+    job.rundata.staged_paths = {'/wdir': None, '/wdir/same': (3, 10),
+                                '/wdir/appended': (3, 10), '/wdir/touched': (3, 10)}
+    paths = ['/wdir', '/wdir/same', '/wdir/appended', '/wdir/touched', '/wdir/output']
+    assert engine._unchanged_staged_paths(job, paths) == {'/wdir', '/wdir/same'}
+    # known stats are used instead of asking the daemon
+    assert engine._unchanged_staged_paths(job, ['/wdir/touched'],
+                                          stats={'/wdir/touched': (3, 10)}) == {'/wdir/touched'}
+
+
+def test_docker_staging_removes_container_on_failure():
+    import requests.exceptions
+
+    class FakeClient(object):
+        base_url = 'http+docker://localhost'
+        removed = []
+
+        def create_container(self, image, **kwargs):
+            return {'Id': 'ctr'}
+
+        def put_archive(self, container, path, data):
+            raise requests.exceptions.ConnectionError('connection reset')
+
+        def remove_container(self, container, force=False):
+            self.removed.append(container['Id'])
+
+    engine = pyccc.Docker(client=FakeClient())
+    job = pyccc.Job(engine=engine, image='alpine', command='true', inputs={'a.txt': 'a'},
+                    submit=False)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        engine.submit(job)
+    assert engine.client.removed == ['ctr']
+
+
+def test_subprocess_large_output_does_not_deadlock(subprocess_engine):
+    nbytes = 2**20  # much larger than a pipe buffer
+    job = subprocess_engine.launch(
+            command='head -c %d /dev/zero | tr "\\0" "x"; echo err 1>&2' % nbytes)
+    job.wait()
+    assert len(job.stdout) == nbytes
+    assert job.stdout_file.size_bytes() == nbytes
+    assert job.stderr.strip() == 'err'
+
+
+def test_subprocess_live_output_streams(subprocess_engine):
+    job = subprocess_engine.launch(
+            command='echo 1; sleep 0.5; echo 2; echo e 1>&2; sleep 0.5; printf 3')
+    assert list(job.get_stdout_stream()) == ['1\n', '2\n', '3']
+    assert list(job.get_stderr_stream()) == ['e\n']
+    job.wait()
+    assert job.stdout == '1\n2\n3'
+    assert list(job.get_stderr_stream()) == ['e\n']  # still readable once finished
+
+
+def test_subprocess_stds_directory_is_removed(subprocess_engine):
+    job = subprocess_engine.launch(command='echo out; echo err 1>&2')
+    stdsdir = os.path.dirname(job.rundata.stdoutpath)
+    job.wait()
+    assert job.stdout == 'out\n'
+    assert job.stderr == 'err\n'
+    assert not os.path.exists(stdsdir)
+
+
+def test_subprocess_unchanged_inputs_are_not_outputs(subprocess_engine):
+    job = subprocess_engine.launch(command='cat a > c; echo more >> b',
+                                   inputs={'a': 'a', 'b': 'b', 'd': 'd'})
+    job.wait()
+    assert set(job.get_output()) == {'b', 'c'}
+    assert job.get_output('b').read() == 'bmore\n'
+
+
+def test_subprocess_links_readonly_inputs(tmpdir):
+    source = os.path.join(str(tmpdir), 'readonly')
+    with open(source, 'w') as srcfile:
+        srcfile.write('hello')
+    os.chmod(source, 0o444)
+
+    engine = pyccc.Subprocess(staging=('hardlink', 'copy'))
+    job = engine.launch(command='cat linked', inputs={'linked': pyccc.LocalFile(source)})
+    job.wait()
+    assert job.stdout == 'hello'
+    linked = os.path.join(job.rundata.localdir, 'linked')
+    assert os.stat(linked).st_ino == os.stat(source).st_ino
+    assert 'linked' not in job.get_output()
+
+
+def _getpid():
+    import os
+    return os.getpid()
+
+
+def test_process_pool_reuses_workers():
+    engine = pyccc.ProcessPool(max_workers=1, preload=['json'])
+    try:
+        jobs = [engine.launch(command=pyccc.PythonCall(_getpid)) for i in range(2)]
+        for job in jobs:
+            job.wait()
+            assert job.rundata.pooled
+        assert jobs[0].result == jobs[1].result != os.getpid()
+    finally:
+        engine.shutdown()
+
+
+def _sleep(seconds):
+    import time
+    time.sleep(seconds)
+
+
+def test_process_pool_kills_running_job():
+    import pickle
+    import time
+
+    engine = pyccc.ProcessPool(max_workers=1)
+    try:
+        job = engine.launch(command=pyccc.PythonCall(_sleep, 60))
+        queued = engine.launch(command=pyccc.PythonCall(_sleep, 60))
+        for i in range(100):
+            if job.status == pyccc.status.RUNNING:
+                break
+            time.sleep(0.1)
+        assert job.status == pyccc.status.RUNNING
+        assert queued.status == pyccc.status.QUEUED
+
+        job.kill()
+        queued.kill()
+        assert job.status == queued.status == pyccc.status.KILLED
+        pickle.dumps(job)
+
+        # the pool replaces the terminated worker
+        job = engine.launch(command=pyccc.PythonCall(_getpid))
+        job.wait()
+        assert job.result != os.getpid()
+        job.kill()  # it already finished, so this does nothing
+        assert job.status == pyccc.status.FINISHED
+
+        # results that arrive after a job was killed (or finished) are ignored
+        from pyccc.engines.processpool import _resolve
+        _resolve(engine._future(queued), engine._lock, result=0)
+        _resolve(engine._future(job), engine._lock, exception=RuntimeError())
+        assert (queued.status, job.status) == (pyccc.status.KILLED, pyccc.status.FINISHED)
+    finally:
+        engine.shutdown()
+
+
+def test_process_pool_captures_output():
+    engine = pyccc.ProcessPool(max_workers=1)
+    try:
+        job = engine.launch(command=pyccc.PythonCall(print, u'hello Å'))
+        job.wait()
+        assert job.exitcode == 0
+        assert job.stdout == u'hello Å\n'
+    finally:
+        engine.shutdown()
+
+
+@pytest.fixture
+def docker_pool_engine():
+    engine = pyccc.DockerPool(pool_size=1, max_jobs_per_container=2)
+    yield engine
+    engine.shutdown()
+
+
+def test_docker_pool_reuses_containers(docker_pool_engine):
+    engine = docker_pool_engine
+    jobs = [engine.launch(image='alpine', command='cat a.txt > out.txt; echo done',
+                          inputs={'a.txt': 'job%d' % i})
+            for i in range(3)]
+    for i, job in enumerate(jobs):
+        job.wait()
+        assert job.exitcode == 0
+        assert job.stdout.strip() == 'done'
+        assert set(job.get_output()) == {'out.txt'}
+        assert job.get_output('out.txt').read() == 'job%d' % i
+
+    # the first container is retired after two jobs
+    assert jobs[0].rundata.containerid == jobs[1].rundata.containerid
+    assert jobs[2].rundata.containerid != jobs[0].rundata.containerid
+
+
+class _FakePoolClient(object):  # just enough of the docker API to submit pooled jobs
+    def __init__(self):
+        self.containers = []
+        self.stopped = set()
+
+    def create_container(self, image, **kwargs):
+        self.containers.append('ctr%d' % len(self.containers))
+        return {'Id': self.containers[-1]}
+
+    def start(self, container):
+        pass
+
+    def stop(self, containerid, timeout=None):
+        self.stopped.add(containerid)
+
+    def inspect_image(self, image):
+        return {'Id': 'sha256:' + image}
+
+    def inspect_container(self, containerid):
+        return {'State': {'Running': containerid not in self.stopped}}
+
+    def exec_create(self, containerid, cmd, **kwargs):
+        return {'Id': 'exec-%s' % containerid}
+
+    def exec_start(self, execid, detach=False):
+        pass
+
+
+def _fake_docker_pool(client, pool_size=2):
+    engine = pyccc.DockerPool.__new__(pyccc.DockerPool)
+    engine.__setstate__(dict(client=client, pool_size=pool_size, max_jobs_per_container=10,
+                             poll_interval=1.0, _pools={}))
+    return engine
+
+
+def test_docker_pool_replaces_stopped_containers():
+    engine = _fake_docker_pool(_FakePoolClient())
+    engine.prestart('alpine', count=1)
+    stopped = engine._pools['alpine'][0]
+    engine.client.stopped.add(stopped.id)
+
+    job = pyccc.Job(engine=engine, image='alpine', command='true', submit=False)
+    engine.submit(job)
+    assert (stopped.retired, stopped.active, stopped.jobs_run) == (True, 0, 0)
+    container = job.rundata.pooled_container
+    assert container is not stopped
+    assert job.rundata.containerid == container.id
+    assert job.imageid == 'sha256:alpine'
+    assert job.workingdir.startswith(engine.POOL_ROOT)
+
+    # a resubmitted job is pooled again, in a new directory
+    workingdir = job.workingdir
+    engine.submit(job)
+    assert job.rundata.pooled_container is container
+    assert (container.active, container.jobs_run) == (1, 2)
+    assert job.workingdir.startswith(engine.POOL_ROOT) and job.workingdir != workingdir
+
+
+def test_docker_pool_kill_stops_child_processes(docker_pool_engine):
+    job = docker_pool_engine.launch(image='alpine', command='sleep 301 & sleep 302')
+    time.sleep(1)
+    job.kill()
+    job.wait()
+    execinfo = docker_pool_engine.client.exec_create(
+            job.rundata.containerid, ['sh', '-c', "ps -o args | grep -c '^sleep 30[12]'"])
+    assert docker_pool_engine.client.exec_start(execinfo['Id']).strip() == b'0'
+
+
+def test_docker_pool_starts_containers_without_blocking_the_pool():
+    import threading
+
+    class SlowClient(_FakePoolClient):
+        def __init__(self):
+            super().__init__()
+            self.starting = threading.Event()
+            self.proceed = threading.Event()
+            self.fail = False
+
+        def start(self, container):
+            if container['Id'] == 'ctr0':
+                self.starting.set()
+                assert self.proceed.wait(30)
+                if self.fail:
+                    raise RuntimeError('could not start')
+
+    for fail in (False, True):
+        engine = _fake_docker_pool(SlowClient(), pool_size=1)
+        engine.client.fail = fail
+        jobs = [pyccc.Job(engine=engine, image='alpine', command='true', submit=False)
+                for i in range(2)]
+        errors = []
+
+        def submit(job):
+            try:
+                engine.submit(job)
+            except RuntimeError as exc:
+                errors.append(exc)
+
+        first = threading.Thread(target=submit, args=(jobs[0],))
+        first.start()
+        assert engine.client.starting.wait(30)
+        second = threading.Thread(target=submit, args=(jobs[1],))
+        second.start()  # waits for the same container, since the pool is full
+
+        other = pyccc.Job(engine=engine, image='busybox', command='true', submit=False)
+        engine.submit(other)  # other images aren't held up
+        assert other.rundata.containerid == 'ctr1'
+
+        engine.client.proceed.set()
+        first.join(30)
+        second.join(30)
+        container = engine._pools['alpine'][0]
+        if fail:
+            # the first job's error is raised, and the second job starts a new container
+            assert len(errors) == 1 and 'containerid' not in jobs[0].rundata
+            assert jobs[1].rundata.containerid == container.id == 'ctr2'
+            assert (container.active, container.jobs_run) == (1, 1)
+        else:
+            assert not errors
+            assert jobs[0].rundata.containerid == jobs[1].rundata.containerid == 'ctr0'
+            assert (container.active, container.jobs_run) == (2, 2)
+
+
+def test_docker_pool_finds_the_same_changed_files_either_way(tmpdir):
+    import io
+    import subprocess
+    import tarfile
+
+    class LocalClient(_FakePoolClient):
+        """ Runs execs and reads archives on the local filesystem """
+        base_url = 'http+docker://localhost'
+        api_version = '1.35'
+        running = True
+
+        def head(self, url, params):
+            import base64
+            import json
+            import requests
+
+            stat = os.stat(params['path'])
+            mtime = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(stat.st_mtime))
+            response = requests.Response()
+            response.status_code = 200
+            response.headers['X-Docker-Container-Path-Stat'] = base64.b64encode(
+                    json.dumps({'size': stat.st_size, 'mtime': mtime}).encode('utf-8'))
+            return response
+
+        def inspect_container(self, containerid):
+            return {'State': {'Running': self.running}}
+
+        def exec_create(self, containerid, cmd, **kwargs):
+            return {'Id': cmd}
+
+        def exec_start(self, execid, detach=False):
+            return subprocess.check_output(execid)
+
+        def get_archive(self, containerid, path):
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode='w') as tar:
+                tar.add(path, arcname=os.path.basename(path))
+            return iter([buffer.getvalue()]), {}
+
+    jobdir = str(tmpdir.join('job'))
+    os.mkdir(jobdir)
+    stamptime = int(time.time()) - 10
+    for name, mtime in (('.stamp', stamptime), ('/input.txt', stamptime - 100),
+                        ('/same_second.txt', stamptime), ('/output.txt', stamptime + 1),
+                        ('/recent_input.txt', stamptime + 1)):
+        with open(jobdir + name, 'w') as outfile:
+            outfile.write('x')
+        os.utime(jobdir + name, (mtime, mtime))
+
+    engine = _fake_docker_pool(LocalClient())
+    engine.transfer_stats = None
+    job = pyccc.Job(engine=engine, image='alpine', command='true', submit=False)
+    job.workingdir = jobdir
+    job.rundata.execid = job.rundata.containerid = 'ctr'
+    job.rundata.staged_paths = {jobdir: None, jobdir + '/input.txt': (1, stamptime - 100),
+                                jobdir + '/recent_input.txt': (1, stamptime + 1)}
+
+    found = sorted(engine._find_changed_files(job))
+    scanned, stats = engine._scan_changed_files(job)
+    assert found == sorted(scanned) == [jobdir + '/output.txt', jobdir + '/recent_input.txt']
+    for running in (True, False):
+        engine.client.running = running
+        assert list(engine._list_output_files(job)) == ['output.txt']
+
+
+def test_docker_pool_exitcode_and_stderr(docker_pool_engine):
+    job = docker_pool_engine.launch(image='alpine', command='echo oops >&2; exit 3')
+    job.wait()
+    assert job.exitcode == 3
+    assert job.stderr.strip() == 'oops'
+
+
+def test_docker_status_refreshed_in_batch(monkeypatch):
+    engine = pyccc.Docker(watch_events=False)
+    jobs = [engine.launch(image='alpine', command='sleep 2') for i in range(3)]
+
+    calls = []
+    original = engine.client.containers
+    monkeypatch.setattr(engine.client, 'containers',
+                        lambda *args, **kwargs: calls.append(1) or original(*args, **kwargs))
+    monkeypatch.setattr(engine.client, 'inspect_container', None)  # should not be called
+    engine.status_ttl = 0.0
+
+    assert [job.status for job in jobs] == [pyccc.status.RUNNING] * 3
+    assert len(calls) == 3  # one per expired lookup, each refreshing every job
+    engine.status_ttl = 60.0
+    assert [job.status for job in jobs] == [pyccc.status.RUNNING] * 3
+    assert len(calls) == 3  # served from the cache
+
+    for job in jobs:
+        job.wait()
+        assert job.status == pyccc.status.FINISHED
+
+
+def test_docker_status_refresh_before_container_starts():
+    import threading
+
+    class FakeClient(object):  # just enough of the docker API to submit a job
+        base_url = 'http+docker://localhost'
+
+        def __init__(self):
+            self.running = set()
+
+        def create_container(self, image, **kwargs):
+            return {'Id': 'ctr'}
+
+        def inspect_image(self, image):
+            return {'Id': 'sha256:' + image}
+
+        def start(self, container):
+            # another thread refreshes all statuses while the container is still "created"
+            refresh = threading.Thread(target=engine.refresh_statuses)
+            refresh.start()
+            refresh.join()
+            self.running.add(container['Id'])
+
+        def containers(self, **kwargs):
+            return [{'Id': containerid} for containerid in self.running]
+
+    engine = pyccc.Docker(client=FakeClient())
+    job = pyccc.Job(engine=engine, image='alpine', command='sleep 10', submit=False)
+    engine.submit(job)
+    assert engine.get_status(job) == pyccc.status.RUNNING
+    engine.client.running.clear()
+    engine.status_ttl = 0.0
+    assert engine.get_status(job) == pyccc.status.FINISHED
+
+
+def test_docker_events_finish_jobs(monkeypatch):
+    engine = pyccc.Docker(watch_events=True)
+    finished = []
+    jobs = [engine.launch(image='alpine', command='sleep 1 && exit %d' % i,
+                          on_status_update=finished.append)
+            for i in range(3)]
+    monkeypatch.setattr(engine.client, 'wait', None)  # exit codes come from the events
+    monkeypatch.setattr(engine.client, 'containers', None)  # so do statuses
+
+    assert engine.wait_all(jobs, timeout=30) == jobs
+    assert [job.wait() for job in jobs] == [0, 1, 2]
+    for job in jobs:
+        assert 'die' in job.rundata.container_events
+    time.sleep(0.5)
+    assert set(finished) == set(jobs)
+
+    engine.close()
+    assert engine._event_thread is None and engine._callback_executor is None
+
+
+def test_jobs_finish_once_across_threads(subprocess_engine, monkeypatch):
+    import threading
+
+    finished = []
+    job = subprocess_engine.launch(command='echo hello', when_finished=finished.append)
+    subprocess_engine.wait(job)  # (job.wait would finish the job)
+
+    list_output_files = subprocess_engine._list_output_files
+    def slow_list_output_files(job):
+        time.sleep(0.2)
+        return list_output_files(job)
+    monkeypatch.setattr(subprocess_engine, '_list_output_files', slow_list_output_files)
+
+    threads = [threading.Thread(target=job._ensure_finished) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert finished == [job]
+    assert job.stdout.strip() == 'hello'
+
+
+def test_result_cache_reuses_finished_jobs(subprocess_engine, tmpdir):
+    cache = pyccc.ResultCache(subprocess_engine, path=str(tmpdir))
+    command = 'echo hello; cat in.txt in.txt > out.txt'
+    job = cache.launch(command=command, inputs={'in.txt': 'abc'})
+    job.wait()
+    assert 'cache_entry' not in job.rundata
+    assert cache.lookup(job.fingerprint()) is not None
+
+    cached = cache.launch(command=command, inputs={'in.txt': 'abc'})
+    assert 'cache_entry' in cached.rundata
+    assert cached.status == pyccc.status.FINISHED
+    assert cached.wait() == 0
+    assert cached.stdout.strip() == 'hello'
+    assert cached.get_output('out.txt').read() == 'abcabc'
+
+    different = cache.launch(command=command, inputs={'in.txt': 'xyz'})
+    assert 'cache_entry' not in different.rundata
+    different.wait()
+
+    cache.invalidate(job)
+    assert cache.lookup(job.fingerprint()) is None
+    assert cache.prune(max_bytes=0) == [different.fingerprint()]
+
+
+def test_result_cache_skips_large_results_early(subprocess_engine, tmpdir):
+    class RemoteOutput(object):  # size unknown until it's downloaded
+        copies = []
+
+        def size_bytes(self):
+            raise NotImplementedError()
+
+        def put(self, target):
+            self.copies.append(target)
+            with open(target, 'wb') as outfile:
+                outfile.write(b'0' * 10)
+
+    cache = pyccc.ResultCache(subprocess_engine, path=str(tmpdir.join('cache')), max_bytes=15)
+    job = cache.launch(command='true')
+    job.wait()
+    cache.invalidate(job)
+
+    outputs = {name: RemoteOutput() for name in ('a', 'b', 'c')}
+    cache._store(job, outputs, ('', ''))
+    assert len(RemoteOutput.copies) == 2  # stopped once the total went over
+    assert cache.lookup(job.fingerprint()) is None
+
+    # files whose sizes are known aren't copied at all
+    big = tmpdir.join('big.txt')
+    big.write('0' * 100)
+    del RemoteOutput.copies[:]
+    cache._store(job, {'big.txt': pyccc.LocalFile(str(big)), 'a': RemoteOutput()}, ('', ''))
+    assert RemoteOutput.copies == [] and not tmpdir.join('cache').listdir('.tmp-*')
+    assert cache.lookup(job.fingerprint()) is None
+
+
+def test_result_cache_fingerprints_engine_defaults(tmpdir):
+    class DefaultWorkingDir(pyccc.Subprocess):  # fills in the working directory, like Docker
+        default_wdir = '/workingdir'
+
+        def submit(self, job):
+            if job.workingdir is None:
+                job.workingdir = self.default_wdir
+            return super().submit(job)
+
+    cache = pyccc.ResultCache(DefaultWorkingDir(), path=str(tmpdir))
+    unsubmitted = cache.launch(command='echo hello', submit=False)
+    job = cache.launch(command='echo hello')
+    job.wait()
+    assert job.workingdir == '/workingdir'
+    assert job.fingerprint() == unsubmitted.fingerprint() == job.rundata.fingerprint
+    assert cache.lookup(unsubmitted.fingerprint()) is not None
+
+    job.workingdir = '/elsewhere'  # e.g., assigned by a DockerPool
+    cache.invalidate(job)
+    assert cache.lookup(unsubmitted.fingerprint()) is None
+
+
+def test_single_flight_coalesces_duplicate_jobs(subprocess_engine):
+    engine = pyccc.SingleFlight(subprocess_engine)
+    command = 'sleep 1; echo $$ > pid.txt; echo done'
+    leader = engine.launch(command=command)
+    duplicate = engine.launch(command=command)
+    other = engine.launch(command='echo other')
+    assert duplicate.rundata.leader is leader
+    assert 'leader' not in other.rundata
+    assert duplicate.status == pyccc.status.RUNNING
+
+    assert duplicate.wait() == 0
+    assert duplicate.stdout == leader.stdout == 'done\n'
+    assert duplicate.get_output('pid.txt').read() == leader.get_output('pid.txt').read()
+    assert leader not in engine.inflight_jobs
+
+    rerun = engine.launch(command=command)  # the leader has finished, so this runs again
+    assert 'leader' not in rerun.rundata
+    rerun.wait()
+    assert rerun.get_output('pid.txt').read() != leader.get_output('pid.txt').read()
+
+
+def test_single_flight_submits_outside_the_lock(tmpdir):
+    import threading
+
+    class GatedEngine(pyccc.Subprocess):
+        """ Blocks submissions of the "gated" command until the gate opens """
+        gate = threading.Event()
+        entered = threading.Event()
+        failures = 0
+
+        def submit(self, job):
+            if 'gated' in job.command:
+                self.entered.set()
+                assert self.gate.wait(30)
+                if self.failures:
+                    self.failures -= 1
+                    raise RuntimeError('submission failed')
+            return super().submit(job)
+
+    wrapped = GatedEngine()
+    wrapped.failures = 1
+    engine = pyccc.SingleFlight(wrapped)
+    command = 'echo gated'
+    jobs = [pyccc.Job(engine=engine, command=command, submit=False) for i in range(2)]
+    errors = []
+
+    def submit(job):
+        try:
+            engine.submit(job)
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    first = threading.Thread(target=submit, args=(jobs[0],))
+    first.start()
+    assert wrapped.entered.wait(30)
+    duplicate = threading.Thread(target=submit, args=(jobs[1],))
+    duplicate.start()
+
+    other = engine.launch(command='echo other')  # not held up by the gated submission
+    assert other.wait() == 0
+    assert 'leader' not in other.rundata
+
+    wrapped.gate.set()
+    first.join(30)
+    duplicate.join(30)
+    # the first submission failed, so the duplicate was submitted in its place
+    assert len(errors) == 1
+    assert 'leader' not in jobs[1].rundata
+    assert jobs[1].wait() == 0
+    assert jobs[1].stdout == 'gated\n'
+
+
+def test_docker_bulk_outputs_skip_input_directories(local_docker_engine, tmpdir):
+    engine = local_docker_engine
+    job = engine.launch(image='alpine',
+                        inputs={'big.dat': pyccc.BytesContainer(b'0' * (2**20))},
+                        command='mkdir -p results/sub /opt/extra && '
+                                'for i in 1 2 3 4 5; do echo $i > results/$i.txt; done && '
+                                'echo sub > results/sub/file.txt && echo x > /opt/extra/x.txt')
+    engine.BULK_OUTPUT_MAX_EXTRA_BYTES = 2**10  # don't download the input with the outputs
+    job.wait()
+
+    outputs = job.get_output()
+    store = outputs['results/1.txt'].store
+    assert store.directories == ['/workingdir/results']  # a single file isn't worth archiving
+
+    target = tmpdir.join('dump')
+    job.dump_all_outputs(str(target), abspaths='abs')
+    assert target.join('results', 'sub', 'file.txt').read() == 'sub\n'
+    assert target.join('results', '5.txt').read() == '5\n'
+    assert target.join('abs', 'opt', 'extra', 'x.txt').read() == 'x\n'
+    assert not target.join('big.dat').exists()
+
+
+def test_docker_output_transfer_plan_depends_on_measured_speeds():
+    engine = pyccc.Docker.__new__(pyccc.Docker)  # planning doesn't need a daemon
+    job = pyccc.Job(image='alpine', command='true', workingdir='/wdir',
+                    inputs={'big.dat': pyccc.BytesContainer(b'0' * 2**20)})
+    job.rundata.containerid = 'ctr'
+    outputs = (['/wdir/out%d.txt' % i for i in range(4)] +
+               ['/wdir/results/%d.txt' % i for i in range(3)])
+    added = {'/wdir', '/wdir/results'}
+
+    def plan(**stats):
+        engine.transfer_stats = pyccc.files.TransferStats(**stats)
+        store = engine._get_output_store(job, {}, outputs, added)
+        return store.directories if store else []
+
+    # on a fast local socket, transferring the input is cheaper than 6 more requests
+    assert plan(latency=0.005, throughput=2.0**29) == ['/wdir']
+    # on a slow link, only the directory without inputs is worth archiving
+    assert plan(latency=0.05, throughput=2.0**20) == ['/wdir/results']
+    # scratch files of unknown size are never transferred with the outputs
+    engine.transfer_stats = pyccc.files.TransferStats(latency=0.05, throughput=2.0**20)
+    store = engine._get_output_store(job, {}, outputs, added,
+                                     other_paths=['/wdir/results/scratch.dat'])
+    assert store is None
+
+
+def test_docker_output_manifest(monkeypatch):
+    import io
+    import tarfile
+    import docker.errors
+    from pyccc.engines import dockerengine
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, paths in (('outputs', ['/wdir/new/a', '/wdir/old/b', '/wdir/in.txt']),
+                            ('others', ['/wdir/old/from_image', '/wdir/in.txt'])):
+            content = '\0'.join(paths).encode('utf-8') + b'\0'
+            info = tarfile.TarInfo('.pyccc_manifest/' + name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+    engine = pyccc.Docker.__new__(pyccc.Docker)
+    engine.client = None
+    job = pyccc.Job(image='alpine', command='true', workingdir='/wdir', inputs={'in.txt': 'x'})
+    job.rundata.containerid = 'ctr'
+    monkeypatch.setattr(dockerengine, '_get_archive_stream',
+                        lambda client, containerid, path: io.BytesIO(buffer.getvalue()))
+    file_paths, added_paths = engine._read_output_manifest(job)
+    assert file_paths == ['/wdir/new/a', '/wdir/old/b']
+    assert added_paths == {'/wdir/new'}  # the others contain files from the image
+
+    def missing(client, containerid, path):
+        raise docker.errors.NotFound('no manifest')
+    monkeypatch.setattr(dockerengine, '_get_archive_stream', missing)
+    monkeypatch.setattr(engine, '_diff_outputs', lambda job, workdir_only: (['diffed'], set()))
+    assert engine._read_output_manifest(job) == (['diffed'], set())
+
+
+def test_transfer_stats_refine_estimates():
+    stats = pyccc.files.TransferStats(latency=0.1, throughput=1e6)
+    for i in range(10):
+        stats.record(100, 0.01)  # dominated by latency
+    assert stats.latency < 0.02
+    for i in range(10):
+        stats.record(10**8, 10.01)  # dominated by throughput
+    assert 5e6 < stats.throughput < 1.1e7
+    assert stats.num_requests == 20
+    assert stats.estimate(2, 10**7) == pytest.approx(2 * stats.latency + 10**7 / stats.throughput)
+
+    # both parameters are recovered, however far off the initial estimates are
+    for latency, throughput in ((10.0, 1e3), (1e-6, 1e12)):
+        stats = pyccc.files.TransferStats(latency=latency, throughput=throughput)
+        for i in range(60):
+            nbytes = [10**3, 10**6, 10**7][i % 3]
+            stats.record(nbytes, 0.02 + nbytes / 1e7)
+        assert stats.latency == pytest.approx(0.02, rel=0.05)
+        assert stats.throughput == pytest.approx(1e7, rel=0.05)
+
+
+def test_metered_streams_exclude_consumer_time():
+    from pyccc.files.remotefiles import _MeteredStream
+
+    class Stream(object):
+        def __init__(self, chunks):
+            self.chunks = chunks
+
+        def __iter__(self):
+            for chunk in self.chunks:
+                time.sleep(0.01)
+                yield chunk
+
+        def close(self):
+            pass
+
+    recorded = []
+    stats = pyccc.files.TransferStats(latency=0.1, throughput=1e6)
+    stats.record = lambda nbytes, elapsed: recorded.append((nbytes, elapsed))
+
+    stream = _MeteredStream(lambda: Stream([b'x' * 10] * 5), stats)
+    for chunk in stream:
+        time.sleep(0.05)  # the consumer is slow
+    stream.close()
+    assert recorded[0][0] == 50
+    assert 0.05 <= recorded[0][1] < 0.2
+
+    # the rest of the stream is read to finish it, unless too much is left
+    stream = _MeteredStream(lambda: Stream([b'x' * 10] * 5), stats)
+    next(iter(stream))
+    stream.close()
+    assert recorded[1][0] == 50
+    stream = _MeteredStream(lambda: Stream([b'x' * 2**16] * 5), stats)
+    next(iter(stream))
+    stream.close()
+    assert len(recorded) == 2
+
+
+def test_docker_log_stream_is_demultiplexed():
+    import io
+    import struct
+    from pyccc import docker_utils as du
+
+    frames = [(1, b'out 1\nout'), (2, b'err 1\n'), (1, b' 2\n')]
+    payload = b''.join(struct.pack('>BxxxL', channel, len(data)) + data
+                       for channel, data in frames)
+
+    class FakeResponse(object):
+        raw = io.BytesIO(payload)
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+        def raise_for_status(self):
+            pass
+
+    class FakeClient(object):
+        base_url = 'http+docker://localhost'
+        api_version = '1.35'
+
+        def inspect_container(self, container):
+            return {'Config': {'Tty': False}}
+
+        def get(self, url, params, stream):
+            self.request = (url, params)
+            return response
+
+    client = FakeClient()
+    response = FakeResponse()
+    chunks = list(du.stream_logs(client, 'abc', tail=5, chunk_size=4))
+    assert client.request[0] == 'http+docker://localhost/v1.35/containers/abc/logs'
+    assert client.request[1]['tail'] == 5
+    assert b''.join(data for channel, data in chunks if channel == du.STDOUT_CHANNEL) == \
+        b'out 1\nout 2\n'
+    assert b''.join(data for channel, data in chunks if channel == du.STDERR_CHANNEL) == \
+        b'err 1\n'
+    assert max(len(data) for _, data in chunks) <= 4
+    assert response.closed
+
+
+def test_docker_log_stream_passes_tty_output_through():
+    from pyccc import docker_utils as du
+
+    class FakeClient(object):
+        def inspect_container(self, container):
+            return {'Config': {'Tty': True}}
+
+        def logs(self, container, stream, **kwargs):
+            self.request = kwargs
+            return iter([b'\x01\x00\x00\x00out', b'put\n'])
+
+    client = FakeClient()
+    chunks = list(du.stream_logs(client, 'abc', chunk_size=4))
+    assert client.request['stdout'] and client.request['stderr']
+    assert {channel for channel, _ in chunks} == {du.STDOUT_CHANNEL}
+    assert b''.join(data for _, data in chunks) == b'\x01\x00\x00\x00output\n'
+    assert max(len(data) for _, data in chunks) <= 4
+
+
+def test_docker_follow_logs(local_docker_engine):
+    job = local_docker_engine.launch(image='alpine',
+                                     command='for i in 1 2 3; do echo $i; echo e$i >&2; '
+                                             'sleep 1; done')
+    assert list(job.get_stdout_stream()) == ['1\n', '2\n', '3\n']
+    assert list(job.get_stderr_stream(tail=1)) == ['e3\n']
+    assert job.stdout == '1\n2\n3\n'
+    assert job.stderr == 'e1\ne2\ne3\n'
+    assert isinstance(job.stdout_file, pyccc.files.CachedFile)
+
+
+def _process_is_gone(pid):
+    try:
+        with open('/proc/%d/status' % pid) as statusfile:
+            return 'State:\tZ' in statusfile.read()  # a zombie that nothing has reaped yet
+    except IOError:
+        return True
+
+
+def test_docker_pool_kill_script_kills_child_processes(tmpdir):
+    import subprocess
+    from pyccc.engines import dockerpool
+
+    jobdir = str(tmpdir.join('job'))
+    command = 'sleep 60 & echo $! > %s.child; wait' % jobdir
+    execproc = subprocess.Popen(['sh', '-c', dockerpool.EXEC_SCRIPT.format(d=jobdir), command])
+    for i in range(100):
+        if os.path.exists(jobdir + '.child') and os.path.getsize(jobdir + '.child'):
+            break
+        time.sleep(0.1)
+    with open(jobdir + '.child') as childfile:
+        child = int(childfile.read())
+    assert not _process_is_gone(child)
+
+    subprocess.check_call(['sh', '-c', dockerpool.KILL_SCRIPT.format(d=jobdir)])
+    assert execproc.wait(timeout=30) != 0
+    for i in range(100):
+        if _process_is_gone(child):
+            break
+        time.sleep(0.1)
+    assert _process_is_gone(child)
+
+
+def test_docker_pool_follow_script(tmpdir):
+    import subprocess
+    from pyccc.engines import dockerpool
+
+    jobdir = str(tmpdir.join('job'))
+    # run the "job" in the background, so that it's reaped by init (as in a container) rather
+    # than left as a zombie that still looks like it's running
+    job = 'echo $$ > %s.pid; echo 1; sleep 1; echo 2; sleep 1; printf 3' % jobdir
+    subprocess.check_call(['sh', '-c', 'sh -c "$0" > %s.stdout &' % jobdir, job])
+    script = dockerpool.FOLLOW_SCRIPT.format(d=jobdir)
+    output = subprocess.check_output(['sh', '-c', script, jobdir + '.stdout', '0', 'follow'],
+                                     timeout=30)
+    assert output == b'1\n2\n3'
+
+    # without following, just the output after the offset is printed
+    output = subprocess.check_output(['sh', '-c', script, jobdir + '.stdout', '2', 'once'])
+    assert output == b'2\n3'
+
+
+def test_docker_manifest_script(tmpdir):
+    import subprocess
+    from pyccc.engines import dockerengine
+
+    wdir = tmpdir.mkdir('wdir')
+    wdir.join('input.txt').write('in')
+    wdir.join('input.txt').setmtime(time.time() - 60)
+    script = dockerengine.MANIFEST_SCRIPT.format(stamp=str(tmpdir.join('stamp')),
+                                                 manifest=str(tmpdir.join('manifest')),
+                                                 wdir=str(wdir))
+    exitcode = subprocess.call(['sh', '-c', script, 'mkdir sub && echo a > sub/a && exit 3'],
+                               cwd=str(wdir))
+    assert exitcode == 3
+    outputs = tmpdir.join('manifest', 'outputs').read().split('\0')
+    assert [path for path in outputs if path] == [str(wdir.join('sub', 'a'))]
+    others = tmpdir.join('manifest', 'others').read().split('\0')
+    assert [path for path in others if path] == [str(wdir.join('input.txt'))]
+    assert not tmpdir.join('manifest.tmp').exists()
+
+    # without a stamp to compare against, no manifest is written at all
+    script = dockerengine.MANIFEST_SCRIPT.format(stamp='/nonexistent/stamp',
+                                                 manifest=str(tmpdir.join('missing')),
+                                                 wdir=str(wdir))
+    assert subprocess.call(['sh', '-c', script, 'true'], cwd=str(wdir)) == 0
+    assert not tmpdir.join('missing').exists()
+
+
+def test_docker_compress_outputs_script(tmpdir):
+    import subprocess
+    import tarfile
+    from pyccc.engines import dockerengine
+
+    wdir = tmpdir.mkdir('wdir')
+    wdir.join('input.txt').write('in')
+    wdir.join('input.txt').setmtime(time.time() - 60)
+    stamp = str(tmpdir.join('stamp'))
+    archive = str(tmpdir.join('outputs.tar.gz'))
+    script = (dockerengine.RUN_SCRIPT.format(stamp=stamp) +
+              dockerengine.COMPRESS_OUTPUTS_SCRIPT.format(
+                      wdir=str(wdir), stamp=stamp, filters="\\( -path './sub/*' \\) ",
+                      filelist=str(tmpdir.join('list')), compressor='gzip -c', archive=archive) +
+              'exit $status')
+    exitcode = subprocess.call(['sh', '-c', script,
+                                'mkdir sub && echo a > sub/a && echo b > b && exit 3'],
+                               cwd=str(wdir))
+    assert exitcode == 3
+    assert not tmpdir.join('list').exists()
+    with tarfile.open(archive, 'r:gz') as tar:
+        assert [member.name for member in tar if member.isfile()] == ['./sub/a']
+
+
+def test_docker_compressed_outputs(tmpdir):
+    engine = pyccc.Docker(compress_outputs='gzip')
+    job = engine.launch(image='alpine',
+                        inputs={'in.txt': 'input'},
+                        command='mkdir -p out && echo a > out/a.txt && seq 10000 > b.txt',
+                        outputs=['out/*', '*.txt'])
+    job.wait()
+    outputs = job.get_output()
+    assert set(outputs) == {'out/a.txt', 'b.txt'}
+    assert not isinstance(outputs['b.txt'].store, pyccc.files.DockerCompressedOutputStore)
+
+    job.dump_all_outputs(str(tmpdir), update_references=False)
+    assert all(output._fetched for output in outputs.values())
+    assert tmpdir.join('out', 'a.txt').read() == 'a\n'
+    assert tmpdir.join('b.txt').read().split() == [str(i) for i in range(1, 10001)]
+
+    pyjob = engine.launch('python:%s.%s-slim' % sys.version_info[:2],
+                          pyccc.PythonCall(pow, 2, 10))
+    assert pyjob.result == 1024
+
+
+def test_docker_output_compression_defaults_to_remote_daemons():
+    engine = pyccc.Docker.__new__(pyccc.Docker)  # choosing doesn't need a daemon
+    job = pyccc.Job(image='alpine', command='true')
+
+    class FakeClient(object):
+        base_url = 'http+docker://localhost'
+
+    engine.client = FakeClient()
+    for compress_outputs, local, remote in ((None, None, 'gzip'), (False, None, None),
+                                            ('xz', 'xz', 'xz')):
+        engine.compress_outputs = compress_outputs
+        engine.client.base_url = 'http+docker://localhost'
+        assert engine._output_compression(job) == local
+        engine.client.base_url = 'https://remote.example.com:2376'
+        assert engine._output_compression(job) == remote
+
+
+@pytest.mark.parametrize('mode', pyccc.Docker.OUTPUT_DISCOVERY_MODES)
+def test_docker_output_discovery_modes(mode):
+    engine = pyccc.Docker(output_discovery=mode)
+    job = engine.launch(image='alpine',
+                        inputs={'in.txt': 'input'},
+                        command='mkdir -p out /opt/stray && echo a > out/a.txt && '
+                                'echo b > b.txt && echo stray > /opt/stray/file')
+    job.wait()
+    outputs = job.get_output()
+    assert outputs['out/a.txt'].read() == 'a\n'
+    assert outputs['b.txt'].read() == 'b\n'
+    assert 'in.txt' not in outputs
+    assert ('/opt/stray/file' in outputs) == (mode == 'diff')
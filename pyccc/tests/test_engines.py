@@ -41,6 +41,12 @@ def _raise_valueerror(msg):
     raise ValueError(msg)
 
 
+def _raise_valueerror_on_negative(x):
+    if x < 0:
+        raise ValueError(x)
+    return x * x
+
+
 ###################
 # Tests           #
 ###################
@@ -78,6 +84,24 @@ def test_file_glob(fixture, request):
     assert set(job.glob_output('*.txt').keys()) == set('a.txt d.txt'.split())
 
 
+@pytest.mark.parametrize('fixture', fixture_types['engine'])
+def test_declared_outputs(fixture, request, tmpdir):
+    engine = request.getfixturevalue(fixture)
+    job = engine.launch('alpine', 'mkdir -p out && touch a.txt scratch.dat out/b.txt out/c.dat',
+                        outputs=['*.txt', 'out/*'])
+    job.wait()
+    assert set(job.get_output()) == {'a.txt', 'out/b.txt', 'out/c.dat'}
+    assert set(job.glob_output('*.dat')) == {'out/c.dat'}
+    job.dump_all_outputs(str(tmpdir.join('dump')))
+    assert not tmpdir.join('dump', 'scratch.dat').exists()
+
+    pyjob = engine.launch(PYIMAGE, pyccc.PythonCall(function_tests.fn, 5),
+                          interpreter=PYVERSION, outputs=['nothing'])
+    pyjob.wait()
+    assert pyjob.result == 6
+    assert 'run_job.py' not in pyjob.get_output()
+
+
 @pytest.mark.parametrize('fixture', fixture_types['engine'])
 def test_output_dump(fixture, request, tmpdir):
     from pathlib import Path
@@ -126,6 +150,28 @@ def _verify_output_dump(dirpath, expected_files, job, outputs_updated):
                     or os.path.normpath(ref.localpath) != os.path.normpath(str(dirpath/ff)))
 
 
+@pytest.mark.parametrize('fixture', fixture_types['engine'])
+def test_output_dump_resumes(fixture, request, tmpdir):
+    from pathlib import Path
+    engine = request.getfixturevalue(fixture)
+    dirpath = Path(str(tmpdir))
+    job = engine.launch('alpine', 'echo a > a.txt && echo b > b.txt && echo c > c.txt')
+    job.wait()
+
+    # simulate an interrupted dump: one file is complete, another was only partly written
+    (dirpath / 'a.txt').write_text(u'a\n')
+    (dirpath / 'b.txt').write_text(u'partial')
+    unchanged_mtime = (dirpath / 'a.txt').stat().st_mtime
+
+    reported = []
+    job.dump_all_outputs(str(dirpath), exist_ok=True, update_references=False,
+                         progress=lambda path, completed, total: reported.append((path, total)))
+    assert sorted(reported) == [('a.txt', 3), ('b.txt', 3), ('c.txt', 3)]
+    assert (dirpath / 'a.txt').stat().st_mtime == unchanged_mtime
+    assert (dirpath / 'b.txt').read_text() == u'b\n'
+    assert (dirpath / 'c.txt').read_text() == u'c\n'
+
+
 @pytest.mark.parametrize('fixture', fixture_types['engine'])
 def test_output_dump_abspaths(fixture, request, tmpdir):
     from pathlib import Path
@@ -558,3 +604,84 @@ def test_get_job(fixture, request):
     assert newjob.stdout == job.stdout
     assert newjob.stderr == job.stderr
 
+
+
+@pytest.mark.parametrize('fixture', fixture_types['engine'])
+def test_wait_any_and_wait_all(fixture, request):
+    engine = request.getfixturevalue(fixture)
+    fast = engine.launch('alpine', 'sleep 1')
+    slow = engine.launch('alpine', 'sleep 4')
+
+    assert engine.wait_any([fast, slow], poll_interval=0.1) == [fast]
+    assert slow.status == pyccc.status.RUNNING
+    assert engine.wait_all([fast, slow], timeout=0.1, poll_interval=0.1) == [fast]
+    assert engine.wait_all([fast, slow], poll_interval=0.1) == [fast, slow]
+    assert slow.wait() == 0
+
+
+@pytest.mark.skipif(PY2, reason='asyncio requires python 3')
+@pytest.mark.parametrize('fixture', fixture_types['engine'])
+def test_async_api(fixture, request):
+    import asyncio
+    engine = request.getfixturevalue(fixture)
+    slow = engine.launch('alpine', 'sleep 3 && exit 3', submit=False)
+    fast = engine.launch(PYIMAGE, pyccc.PythonCall(function_tests.fn, 5),
+                         interpreter=PYVERSION, submit=False)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(asyncio.gather(slow.submit_async(), fast.submit_async()))
+        completions = pyccc.as_completed_async([slow, fast])
+        assert loop.run_until_complete(completions.__anext__()) is fast
+        assert not slow.stopped
+        assert loop.run_until_complete(fast.function_result_async()) == 6
+        assert loop.run_until_complete(completions.__anext__()) is slow
+        with pytest.raises(StopAsyncIteration):
+            loop.run_until_complete(completions.__anext__())
+        assert loop.run_until_complete(slow.wait_async()) == 3
+        assert slow.stopped
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+@pytest.mark.parametrize('fixture', fixture_types['engine'])
+def test_executor(fixture, request):
+    from concurrent.futures import as_completed
+    engine = request.getfixturevalue(fixture)
+
+    with pyccc.Executor(engine, PYIMAGE, max_workers=2, poll_interval=0.1,
+                        interpreter=PYVERSION) as executor:
+        assert list(executor.map(function_tests.fn, [1, 2, 3])) == [2, 3, 4]
+
+        futures = [executor.submit(function_tests.fn, 10),
+                   executor.submit(_raise_valueerror, 'oops')]
+        assert set(as_completed(futures)) == set(futures)
+        assert futures[0].result() == 11
+        assert isinstance(futures[0].job, pyccc.PythonJob)
+        with pytest.raises(ValueError):
+            futures[1].result()
+
+    with pytest.raises(RuntimeError):
+        executor.submit(function_tests.fn, 1)
+
+
+@pytest.mark.parametrize('fixture', fixture_types['engine'])
+def test_batch_python_call(fixture, request):
+    engine = request.getfixturevalue(fixture)
+    calls = list(pyccc.BatchPythonCall.chunked(_raise_valueerror_on_negative,
+                                               [(i,) for i in range(-1, 4)], batch_size=3))
+    assert [len(call.batch_args) for call in calls] == [3, 2]
+
+    jobs = [engine.launch(PYIMAGE, call, interpreter=PYVERSION) for call in calls]
+    for job in jobs:
+        job.wait()
+    assert jobs[1].function_result == [4, 9]
+    assert jobs[1].batch_exceptions == {}
+
+    results = jobs[0].batch_results
+    assert isinstance(results[0], ValueError)
+    assert results[1:] == [0, 1]
+    assert list(jobs[0].batch_exceptions) == [0]
+    assert 'ValueError' in jobs[0].batch_tracebacks[0]
@@ -187,3 +187,157 @@ def test_put_file_to_location(request, fixture, tmpdir, putdir):
         assert ff.read() == STRING_CONTENT
     with open(target, 'rb') as ff:
         assert ff.read() == BYTES_CONTENT
+
+
+@pytest.mark.parametrize('fixture', fixture_types['file_ref'])
+def test_file_digest(fixture, request):
+    import hashlib
+    ctr = request.getfixturevalue(fixture)
+    assert ctr.digest() == hashlib.sha256(BYTES_CONTENT).hexdigest()
+
+
+@pytest.mark.parametrize('method', pyccc.files.STAGING_METHODS)
+def test_stage_file(method, tmpdir):
+    source = os.path.join(str(tmpdir), 'source')
+    target = os.path.join(str(tmpdir), 'target')
+    with open(source, 'wb') as srcfile:
+        srcfile.write(BYTES_CONTENT)
+    os.chmod(source, 0o444)
+
+    used = pyccc.files.stage_file(source, target, methods=(method, 'copy'))
+    assert used in (method, 'copy')
+    with open(target, 'rb') as targetfile:
+        assert targetfile.read() == BYTES_CONTENT
+
+
+def test_short_in_kernel_copy_falls_back_to_copy(tmpdir, monkeypatch):
+    source = os.path.join(str(tmpdir), 'source')
+    target = os.path.join(str(tmpdir), 'target')
+    with open(source, 'wb') as srcfile:
+        srcfile.write(BYTES_CONTENT)
+
+    def short_copy(*args):
+        return 0  # as if the source were truncated before anything was copied
+    monkeypatch.setattr(os, 'copy_file_range', short_copy, raising=False)
+
+    assert pyccc.files.stage_file(source, target, methods=('copy_file_range', 'copy')) == 'copy'
+    with open(target, 'rb') as targetfile:
+        assert targetfile.read() == BYTES_CONTENT
+
+
+def test_writable_files_are_not_linked(tmpdir):
+    source = os.path.join(str(tmpdir), 'source')
+    target = os.path.join(str(tmpdir), 'target')
+    with open(source, 'wb') as srcfile:
+        srcfile.write(BYTES_CONTENT)
+
+    assert pyccc.files.stage_file(source, target, methods=('hardlink', 'symlink', 'copy')) == 'copy'
+    assert not os.path.islink(target)
+    assert os.stat(target).st_ino != os.stat(source).st_ino
+
+
+def test_failed_staging_keeps_existing_target(tmpdir):
+    source = os.path.join(str(tmpdir), 'missing')
+    target = os.path.join(str(tmpdir), 'target')
+    with open(target, 'wb') as targetfile:
+        targetfile.write(BYTES_CONTENT)
+
+    with pytest.raises(OSError):
+        pyccc.files.stage_file(source, target, methods=('reflink', 'copy'))
+    assert os.path.exists(target)
+    assert 'hardlink' not in pyccc.files.DEFAULT_STAGING
+
+
+def test_file_cache_deduplicates_and_evicts(tmpdir):
+    cache = pyccc.files.FileCache(str(tmpdir.join('cache')), max_bytes=10)
+    clock = itertools.count(1000)
+
+    def add(content, source=None, pin=False):
+        with cache.tempfile(mode='wb') as tmp:
+            tmp.write(content)
+        digest = cache.add(tmp.name, source=source, pin=pin)
+        now = next(clock)
+        os.utime(cache.object_path(digest), (now, now))
+        return digest
+
+    first = add(b'12345', source='source-a', pin=True)
+    assert add(b'12345', source='source-b') == first  # stored once
+    assert cache.size_bytes() == 5
+    assert cache.lookup('source-a') == cache.lookup('source-b') == first
+    assert cache.lookup('source-c') is None
+
+    second = add(b'xyz')
+    third = add(b'ab')
+    assert cache.size_bytes() == 10
+    fourth = add(b'pq')  # over budget: evicts the least recently used unpinned file
+    assert not os.path.exists(cache.object_path(second))
+    for digest in (first, third, fourth):
+        assert os.path.exists(cache.object_path(digest))
+
+    cache.unpin(first)
+    assert cache.prune(max_bytes=0) == [third, fourth, first]  # lookup() marked `first` as used
+    assert cache.lookup('source-a') is None
+
+
+def test_docker_output_store_fetches_directory_once(tmpdir, monkeypatch):
+    import io
+    import tarfile
+    from pyccc.files import remotefiles
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for name, content in (('wdir/a.txt', b'a'), ('wdir/sub/b.txt', b'bb'),
+                              ('wdir/input.txt', b'not an output')):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+    requests = []
+
+    def fake_tarstream(dockerhost, containerid, containerpath):
+        requests.append(containerpath)
+        data = buffer.getvalue()
+        return (data[i:i+100] for i in range(0, len(data), 100))
+
+    monkeypatch.setattr(remotefiles, '_get_docker_tarstream', fake_tarstream)
+    monkeypatch.setattr(pyccc.files.cache, '_default_cache',
+                        pyccc.files.FileCache(str(tmpdir.join('cache'))))
+
+    paths = ['/wdir/a.txt', '/wdir/sub/b.txt']
+    store = pyccc.files.DockerOutputStore({}, 'ctr', {'/wdir': paths}, version='finished')
+    refs = [pyccc.files.LazyDockerCopy({}, 'ctr', path, store=store, version='finished')
+            for path in paths]
+    assert refs[1].read() == 'bb'
+    assert refs[0].read() == 'a'
+    assert requests == ['/wdir']
+
+    # the extracted files are indexed in the file cache, so new references don't download them
+    assert pyccc.files.LazyDockerCopy({}, 'ctr', '/wdir/a.txt', version='finished').read() == 'a'
+    assert requests == ['/wdir']
+
+    # ... unless the container's filesystem may have changed since
+    pyccc.files.LazyDockerCopy({}, 'ctr', '/wdir/a.txt', version='restarted').read()
+    pyccc.files.LazyDockerCopy({}, 'ctr', '/wdir/a.txt').read()  # running
+    assert requests == ['/wdir', '/wdir/a.txt', '/wdir/a.txt']
+
+
+def test_cached_file_copies_hold_their_own_pins(tmpdir, monkeypatch):
+    import copy
+
+    cache = pyccc.files.FileCache(str(tmpdir.join('cache')))
+    monkeypatch.setattr(pyccc.files.cache, '_default_cache', cache)
+    with cache.tempfile(mode='w') as tmp:
+        tmp.write('contents')
+    digest = cache.add(tmp.name)
+
+    ref = pyccc.files.CachedFile.from_cache(digest, 'test', 'test')
+    duplicate = copy.copy(ref)
+    restored = ref.__class__.__new__(ref.__class__)
+    restored.__setstate__(ref.__getstate__())
+    assert cache._pins[digest] == 3
+
+    del ref, duplicate
+    assert cache._pins[digest] == 1
+    assert restored.read() == 'contents'
+    del restored
+    assert digest not in cache._pins
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+import pyccc
+from pyccc import status
+from .engine_fixtures import subprocess_engine
+
+
+@pytest.fixture
+def scheduler(subprocess_engine):
+    return pyccc.Scheduler(subprocess_engine, maxcpus=2, poll_interval=0.1)
+
+
+@pytest.fixture
+def gate(tmpdir):
+    """ Shell command that blocks until ``gate.open()`` is called
+    """
+    class Gate(object):
+        path = tmpdir.join('gate')
+        command = 'while [ ! -e %s ]; do sleep 0.05; done' % path
+
+        def open(self):
+            self.path.write('')
+
+    return Gate()
+
+
+def test_jobs_are_queued_until_capacity_is_available(scheduler, gate):
+    jobs = [scheduler.launch(command=gate.command) for i in range(3)]
+    assert [job.status for job in jobs] == [status.RUNNING, status.RUNNING, status.QUEUED]
+    assert scheduler.cpus_in_use == 2
+
+    gate.open()
+    jobs[0].wait()
+    jobs[1].wait()
+    assert jobs[2].status in (status.RUNNING, status.FINISHED)
+    jobs[2].wait()
+    assert all(job.status == status.FINISHED for job in jobs)
+    assert scheduler.cpus_in_use == 0
+
+
+def test_numcpus_limits_admission(scheduler, gate):
+    big = scheduler.launch(command=gate.command, numcpus=2)
+    small = scheduler.launch(command='echo small')
+    assert small.status == status.QUEUED
+    gate.open()
+    small.wait()
+    assert big.stopped
+    assert small.stdout.strip() == 'small'
+
+
+def test_oversized_job_runs_alone(scheduler):
+    job = scheduler.launch(command='echo big', numcpus=16)
+    job.wait()
+    assert job.stdout.strip() == 'big'
+
+
+def test_queue_priority(scheduler, gate):
+    blockers = [scheduler.launch(command=gate.command) for i in range(2)]
+    low = scheduler.launch(command='echo low')
+    high = scheduler.launch(command='echo high', engine_options={'priority': 10})
+    assert scheduler.queued_jobs == [high, low]
+    gate.open()
+    for job in blockers + [low, high]:
+        job.wait()
+
+
+def test_kill_queued_job(scheduler, gate):
+    blockers = [scheduler.launch(command=gate.command) for i in range(2)]
+    job = scheduler.launch(command='echo never')
+    job.kill()
+    assert job.status == status.KILLED
+    assert scheduler.queued_jobs == []
+    gate.open()
+    for blocker in blockers:
+        blocker.wait()
+
+
+def test_slow_submit_does_not_block_scheduler(subprocess_engine):
+    submitted = threading.Event()
+    proceed = threading.Event()
+
+    class SlowSubmit(pyccc.Subprocess):
+        def submit(self, job):
+            submitted.set()
+            assert proceed.wait(10)
+            return super(SlowSubmit, self).submit(job)
+
+    scheduler = pyccc.Scheduler(SlowSubmit(), maxcpus=2, poll_interval=0.1)
+    job = scheduler.launch(command='echo hi', submit=False)
+    submitter = threading.Thread(target=job.submit)
+    submitter.start()
+    assert submitted.wait(10)
+
+    # the scheduler stays responsive while the engine is busy submitting
+    assert scheduler.get_status(job) == status.QUEUED
+    assert scheduler.queued_jobs == []
+    assert scheduler.cpus_in_use == 1
+
+    proceed.set()
+    submitter.join()
+    assert job.wait() == 0
+    assert job.stdout.strip() == 'hi'
+
+
+def test_slots_released_without_waiting(scheduler):
+    jobs = [scheduler.launch(command='echo hi') for i in range(4)]
+    deadline = time.time() + 10
+    while not all(job.stopped for job in jobs):
+        assert time.time() < deadline
+        time.sleep(0.1)
+    assert scheduler.cpus_in_use == 0